@@ -1,20 +1,110 @@
+import asyncio
+import importlib
+import importlib.util
+import contextlib
 import logging
+import logging.handlers
 import json
+import math
 import os
 import base64
+import hashlib
+import heapq
+import itertools
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-import requests
-from openai import OpenAI
-from PIL import Image
 import io
 
+# --- 冷启动计时与延迟导入 ---
+class StartupTimer:
+    """冷启动计时：按导入与初始化阶段记录耗时，设置环境变量PVENUS_STARTUP_TIMING=1或传入--startup-timing时输出报告"""
+    def __init__(self):
+        self.enabled = os.environ.get("PVENUS_STARTUP_TIMING") == "1" or "--startup-timing" in sys.argv
+        self.begin = time.perf_counter()
+        self.last = self.begin
+        self.phases = [] # [(阶段, 耗时ms)]
+        self.lazy_imports = [] # [(模块, 导入耗时ms, 距启动ms)]
+        self.reported = False
+    
+    def mark(self, phase):
+        """记录从上一个标记到现在的阶段耗时"""
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self.last) * 1000))
+        self.last = now
+    
+    def skip(self):
+        """跳过从上一个标记到现在的时间（如等待用户输入），不计入任何阶段"""
+        self.last = time.perf_counter()
+    
+    def record_import(self, name, elapsed_ms):
+        """记录一次延迟导入"""
+        self.lazy_imports.append((name, elapsed_ms, (time.perf_counter() - self.begin) * 1000))
+    
+    def as_dict(self):
+        """以字典形式返回计时结果，供基准测试使用"""
+        return {
+            "total_ms": sum(ms for _, ms in self.phases),
+            "phases": [{"phase": phase, "ms": ms} for phase, ms in self.phases],
+            "lazy_imports": [{"module": name, "ms": ms, "at_ms": at} for name, ms, at in self.lazy_imports]
+        }
+    
+    def report(self):
+        """输出冷启动报告，只输出一次"""
+        if not self.enabled or self.reported:
+            return
+        self.reported = True
+        lines = ["冷启动耗时报告:"]
+        for phase, ms in self.phases:
+            lines.append(f"  {phase}: {ms:.1f} ms")
+        lines.append(f"  合计: {sum(ms for _, ms in self.phases):.1f} ms")
+        for name, ms, at in self.lazy_imports:
+            lines.append(f"  延迟导入 {name}: {ms:.1f} ms (启动后 {at:.0f} ms)")
+        print("\n".join(lines), file=sys.stderr)
+
+startup_timer = StartupTimer()
+
+class LazyModule:
+    """延迟导入的模块代理：首次访问属性时才真正导入"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def load(self):
+        """导入并返回真实模块"""
+        if self._module is None:
+            start = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            startup_timer.record_import(self._name, (time.perf_counter() - start) * 1000)
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+# 重量级依赖推迟到功能首次使用时再导入
+requests = LazyModule("requests")
+openai = LazyModule("openai")
+Image = LazyModule("PIL.Image")
+ImageOps = LazyModule("PIL.ImageOps")
+np = LazyModule("numpy")
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None # 未安装NumPy时记忆检索退化为全量注入
+
 # 创建一个 Logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 # 创建文件Handler，保存为 UTF-8 编码，等级为 DEBUG
-file_handler = logging.FileHandler("app.log", encoding="utf-8")
+file_handler = logging.FileHandler("app.log", encoding="utf-8", delay=True) # 第一条日志写入时才创建文件
 file_handler.setLevel(logging.DEBUG)
 
 # 创建控制台Handler，等级为 INFO
@@ -31,19 +121,50 @@ console_handler.setFormatter(formatter)
 # 添加Handler到Logger中
 logger.addHandler(file_handler)
 logger.addHandler(console_handler)
+startup_timer.mark("日志初始化")
 
-class ConfigManager:
-    """配置管理类"""
-    def __init__(self):
-        self.config_file = "config.json"
-        self.memory_file = "memory.json"
-        self.chat_history_file = "chat_history.json"
+class JsonStorage:
+    """JSON文件存储（旧版格式）"""
+    def __init__(self, base_dir=".", history_limit=8):
+        self.history_limit = history_limit
+        self.config_file = os.path.join(base_dir, "config.json")
+        self.memory_file = os.path.join(base_dir, "memory.json")
+        self.chat_history_file = os.path.join(base_dir, "chat_history.json")
+        self.memory_journal_file = os.path.join(base_dir, "memory.journal")
+        self.summary_file = os.path.join(base_dir, "chat_summary.json")
+        self.journal_compact_threshold = 200
+        self._journal_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._journal_count = 0
+        self._snapshot_generation = 0
+        self._compacting = False
+        self.fsync = "normal"
+    
+    def set_fsync(self, policy):
+        """always: 每次写入都落盘（含目录项）；normal: 快照文件落盘，日志追加交给系统；off: 全部交给系统"""
+        self.fsync = policy
+    
+    def _write_json_atomic(self, path, data):
+        """先写临时文件再原子替换，避免写入中途崩溃损坏原文件"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            if self.fsync != "off":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if self.fsync == "always" and hasattr(os, "O_DIRECTORY"):
+            # 同步目录项，保证替换本身在断电后可见
+            dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
     
     def save_config(self, config):
         """保存配置到本地文件"""
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(config, f, ensure_ascii=False, indent=2)
+            self._write_json_atomic(self.config_file, config)
             logger.debug("配置已保存到本地")
         except Exception as e:
             logger.error(f"保存配置失败: {e}")
@@ -59,50 +180,1146 @@ class ConfigManager:
         return None
     
     def save_memory(self, memory):
-        """保存永久记忆"""
+        """保存永久记忆（完整快照，并清空日志）"""
         try:
-            with open(self.memory_file, 'w', encoding='utf-8') as f:
-                json.dump(memory, f, ensure_ascii=False, indent=2)
+            with self._snapshot_lock, self._journal_lock:
+                self._snapshot_generation += 1
+                self._write_json_atomic(self.memory_file, memory)
+                for path in (self.memory_journal_file, f"{self.memory_journal_file}.compacting"):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._journal_count = 0
             logger.debug("记忆已保存")
         except Exception as e:
             logger.error(f"保存记忆失败: {e}")
     
+    def append_memory_journal(self, record, memory):
+        """向记忆日志追加一条操作记录"""
+        self.append_memory_records([record], memory)
+    
+    def append_memory_records(self, records, memory):
+        """向记忆日志追加一批操作记录（一次写入），达到阈值时在后台压缩为快照"""
+        try:
+            lines = "".join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n" for record in records)
+            with self._journal_lock:
+                with open(self.memory_journal_file, 'a', encoding='utf-8') as f:
+                    f.write(lines)
+                    if self.fsync == "always":
+                        f.flush()
+                        os.fsync(f.fileno())
+                self._journal_count += len(records)
+                if self._journal_count >= self.journal_compact_threshold and not self._compacting:
+                    self._start_compaction(memory)
+        except Exception as e:
+            logger.error(f"写入记忆日志失败: {e}")
+    
+    def _start_compaction(self, memory):
+        """轮换日志文件并启动后台压缩（调用方需持有日志锁）"""
+        compacting_file = f"{self.memory_journal_file}.compacting"
+        if os.path.exists(compacting_file):
+            # 上次压缩未完成，先把残留记录并回当前日志之前
+            with open(compacting_file, 'r', encoding='utf-8') as f:
+                pending = f.read()
+            with open(self.memory_journal_file, 'r', encoding='utf-8') as f:
+                current = f.read()
+            with open(compacting_file, 'w', encoding='utf-8') as f:
+                f.write(pending + current)
+            os.remove(self.memory_journal_file)
+        else:
+            os.replace(self.memory_journal_file, compacting_file)
+        # 快照在持锁时复制，之后的操作写入新日志；记忆字典可能正被其他线程修改，先整体复制再逐条复制
+        snapshot = {mem_id: dict(mem_data) for mem_id, mem_data in dict(memory).items()}
+        generation = self._snapshot_generation
+        self._journal_count = 0
+        self._compacting = True
+        thread = threading.Thread(target=self._compact_memory, args=(snapshot, generation, compacting_file))
+        thread.daemon = True
+        thread.start()
+    
+    def _compact_memory(self, snapshot, generation, compacting_file):
+        """后台线程：写入新快照并删除已合并的日志"""
+        try:
+            with self._snapshot_lock:
+                # 期间若已有完整保存，则这份快照已过时
+                if generation == self._snapshot_generation:
+                    self._write_json_atomic(self.memory_file, snapshot)
+                    if os.path.exists(compacting_file):
+                        os.remove(compacting_file)
+            logger.debug(f"记忆日志已压缩，共 {len(snapshot)} 条记忆")
+        except Exception as e:
+            logger.error(f"压缩记忆日志失败: {e}")
+        finally:
+            self._compacting = False
+    
+    def _replay_memory_journal(self, memory, path):
+        """将日志中的操作记录重放到记忆字典上，返回记录条数"""
+        count = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        if lines and not lines[-1].endswith("\n"):
+            # 崩溃时可能残留半行记录，补上换行避免与后续记录粘连
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write("\n")
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("op") == "put":
+                memory[record["id"]] = record["data"]
+            elif record.get("op") == "del":
+                memory.pop(record["id"], None)
+            count += 1
+        return count
+    
     def load_memory(self):
-        """加载永久记忆"""
+        """加载永久记忆（快照 + 日志重放）"""
+        memory = {}
         try:
             if os.path.exists(self.memory_file):
                 with open(self.memory_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                    memory = json.load(f)
+            count = 0
+            for path in (f"{self.memory_journal_file}.compacting", self.memory_journal_file):
+                if os.path.exists(path):
+                    count += self._replay_memory_journal(memory, path)
+            with self._journal_lock:
+                self._journal_count = count
         except Exception as e:
             logger.error(f"加载记忆失败: {e}")
-        return {}
+        return memory
     
     def save_chat_history(self, history):
         """保存聊天记录"""
         try:
-            # 只保存最新的8条记录
-            recent_history = history[-8:] if len(history) > 8 else history
-            with open(self.chat_history_file, 'w', encoding='utf-8') as f:
-                json.dump(recent_history, f, ensure_ascii=False, indent=2)
+            # 只保存最新的若干条记录
+            recent_history = history[-self.history_limit:] if len(history) > self.history_limit else history
+            self._write_json_atomic(self.chat_history_file, recent_history)
             logger.debug("聊天记录已保存")
         except Exception as e:
             logger.error(f"保存聊天记录失败: {e}")
     
-    def load_chat_history(self):
+    def append_chat_history(self, turn, history):
+        """追加一轮对话（JSON文件只能整体重写）"""
+        self.save_chat_history(history)
+    
+    def append_chat_turns(self, turns, history):
+        """追加多轮对话，只需按最新的聊天记录重写一次"""
+        self.save_chat_history(history)
+    
+    def clear_chat_history(self):
+        """清空聊天记录"""
+        self.save_chat_history([])
+    
+    def load_chat_history(self, limit=None):
         """加载聊天记录"""
         try:
             if os.path.exists(self.chat_history_file):
                 with open(self.chat_history_file, 'r', encoding='utf-8') as f:
+                    history = json.load(f)
+                return history[-limit:] if limit else history
+        except Exception as e:
+            logger.error(f"加载聊天记录失败: {e}")
+        return []
+    
+    def load_chat_history_range(self, start_time=None, end_time=None, session_id=None, before_id=None, limit=None):
+        """按时间范围读取聊天记录（JSON文件只保留最近的记录）"""
+        history = [
+            chat for chat in self.load_chat_history()
+            if (start_time is None or chat.get('timestamp', '') >= start_time)
+            and (end_time is None or chat.get('timestamp', '') < end_time)
+            and (session_id is None or chat.get('session_id') == session_id)
+        ]
+        return history[-limit:] if limit else history
+    
+    def save_summary(self, summary):
+        """保存滚动对话摘要"""
+        try:
+            self._write_json_atomic(self.summary_file, summary)
+        except Exception as e:
+            logger.error(f"保存对话摘要失败: {e}")
+    
+    def load_summary(self):
+        """加载滚动对话摘要"""
+        try:
+            if os.path.exists(self.summary_file):
+                with open(self.summary_file, 'r', encoding='utf-8') as f:
                     return json.load(f)
+        except Exception as e:
+            logger.error(f"加载对话摘要失败: {e}")
+        return None
+
+class SQLiteStorage:
+    """SQLite存储引擎：WAL模式，保存配置、记忆与完整聊天记录"""
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS memory (
+    id INTEGER PRIMARY KEY,
+    content TEXT NOT NULL,
+    created_time TEXT NOT NULL,
+    last_modified TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    user TEXT NOT NULL,
+    ai TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chat_history_timestamp ON chat_history(timestamp);
+CREATE INDEX IF NOT EXISTS idx_chat_history_session ON chat_history(session_id, id);
+"""
+    
+    def __init__(self, db_path, session_id, legacy=None):
+        self.db_path = db_path
+        self.session_id = session_id
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        if legacy is not None:
+            try:
+                self._migrate_from_json(legacy)
+            except Exception:
+                self.conn.close()
+                raise
+    
+    def set_fsync(self, policy):
+        """always/normal/off 分别对应 SQLite 的 synchronous=FULL/NORMAL/OFF"""
+        synchronous = {"always": "FULL", "normal": "NORMAL", "off": "OFF"}.get(policy, "NORMAL")
+        with self._lock:
+            self.conn.execute(f"PRAGMA synchronous={synchronous}")
+    
+    def _get_kv(self, key):
+        """读取键值表"""
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["value"]) if row else None
+    
+    def _set_kv(self, key, value):
+        """写入键值表"""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False))
+            )
+    
+    def _migrate_from_json(self, legacy):
+        """一次性从旧版JSON文件迁移数据；全部数据与迁移标记在同一个事务中写入，
+        失败时整体回滚并抛出异常，JSON文件保持不变，下次启动重新迁移"""
+        if self._get_kv("migrated_from_json"):
+            return
+        config = legacy.load_config()
+        memory = legacy.load_memory()
+        history = legacy.load_chat_history()
+        with self._lock, self.conn:
+            kv_sql = "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)"
+            if config:
+                self.conn.execute(kv_sql, ("config", json.dumps(config, ensure_ascii=False)))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO memory (id, content, created_time, last_modified) VALUES (?, ?, ?, ?)",
+                [(int(mem_id), data['content'], data['created_time'], data['last_modified'])
+                 for mem_id, data in memory.items()]
+            )
+            self.conn.executemany(
+                "INSERT INTO chat_history (session_id, user, ai, timestamp) VALUES (?, ?, ?, ?)",
+                [(chat.get('session_id', 'legacy'), chat['user'], chat['ai'], chat.get('timestamp', ''))
+                 for chat in history]
+            )
+            self.conn.execute(kv_sql, ("migrated_from_json", json.dumps(datetime.now().isoformat())))
+        if config or memory or history:
+            logger.info(f"已从JSON文件迁移数据: {len(memory)} 条记忆, {len(history)} 条聊天记录")
+    
+    def save_config(self, config):
+        """保存配置"""
+        try:
+            self._set_kv("config", config)
+            logger.debug("配置已保存到本地")
+        except Exception as e:
+            logger.error(f"保存配置失败: {e}")
+    
+    def load_config(self):
+        """加载配置"""
+        try:
+            return self._get_kv("config")
+        except Exception as e:
+            logger.error(f"加载配置失败: {e}")
+        return None
+    
+    def save_memory(self, memory):
+        """整体替换永久记忆"""
+        try:
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM memory")
+                self.conn.executemany(
+                    "INSERT INTO memory (id, content, created_time, last_modified) VALUES (?, ?, ?, ?)",
+                    [(int(mem_id), data['content'], data['created_time'], data['last_modified'])
+                     for mem_id, data in memory.items()]
+                )
+            logger.debug("记忆已保存")
+        except Exception as e:
+            logger.error(f"保存记忆失败: {e}")
+    
+    def append_memory_journal(self, record, memory):
+        """按操作记录增量更新单条记忆"""
+        self.append_memory_records([record], memory)
+    
+    def append_memory_records(self, records, memory):
+        """在一个事务中按顺序应用一批操作记录"""
+        try:
+            with self._lock, self.conn:
+                for record in records:
+                    if record["op"] == "put":
+                        data = record["data"]
+                        self.conn.execute(
+                            "INSERT OR REPLACE INTO memory (id, content, created_time, last_modified) VALUES (?, ?, ?, ?)",
+                            (int(record["id"]), data['content'], data['created_time'], data['last_modified'])
+                        )
+                    elif record["op"] == "del":
+                        self.conn.execute("DELETE FROM memory WHERE id = ?", (int(record["id"]),))
+        except Exception as e:
+            logger.error(f"写入记忆失败: {e}")
+    
+    def load_memory(self):
+        """加载永久记忆"""
+        try:
+            with self._lock:
+                rows = self.conn.execute("SELECT * FROM memory ORDER BY id").fetchall()
+            return {
+                str(row["id"]): {
+                    "content": row["content"],
+                    "created_time": row["created_time"],
+                    "last_modified": row["last_modified"]
+                }
+                for row in rows
+            }
+        except Exception as e:
+            logger.error(f"加载记忆失败: {e}")
+        return {}
+    
+    def save_chat_history(self, history):
+        """整体替换聊天记录"""
+        try:
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM chat_history")
+                self.conn.executemany(
+                    "INSERT INTO chat_history (session_id, user, ai, timestamp) VALUES (?, ?, ?, ?)",
+                    [(chat.get('session_id', self.session_id), chat['user'], chat['ai'], chat['timestamp'])
+                     for chat in history]
+                )
+            logger.debug("聊天记录已保存")
+        except Exception as e:
+            logger.error(f"保存聊天记录失败: {e}")
+    
+    def append_chat_history(self, turn, history):
+        """追加一轮对话，O(1)写入，返回新记录的ID"""
+        ids = self.append_chat_turns([turn], history)
+        return ids[0] if ids else None
+    
+    def append_chat_turns(self, turns, history):
+        """在一个事务中追加多轮对话，返回新记录的ID列表；
+        可能在后台写入线程中执行，不修改调用方仍持有的对话字典"""
+        try:
+            with self._lock, self.conn:
+                ids = [
+                    self.conn.execute(
+                        "INSERT INTO chat_history (session_id, user, ai, timestamp) VALUES (?, ?, ?, ?)",
+                        (turn.get('session_id', self.session_id), turn['user'], turn['ai'], turn['timestamp'])
+                    ).lastrowid
+                    for turn in turns
+                ]
+            logger.debug("聊天记录已保存")
+            return ids
+        except Exception as e:
+            logger.error(f"保存聊天记录失败: {e}")
+        return []
+    
+    def clear_chat_history(self):
+        """清空聊天记录"""
+        self.save_chat_history([])
+    
+    def load_chat_history(self, limit=None):
+        """加载最近的聊天记录（按时间正序）"""
+        return self.load_chat_history_range(limit=limit)
+    
+    def load_chat_history_range(self, start_time=None, end_time=None, session_id=None, before_id=None, limit=None):
+        """按时间范围、会话或ID游标读取聊天记录（按时间正序），走索引查询"""
+        conditions, params = [], []
+        if start_time is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start_time)
+        if end_time is not None:
+            conditions.append("timestamp < ?")
+            params.append(end_time)
+        if session_id is not None:
+            conditions.append("session_id = ?")
+            params.append(session_id)
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        sql = "SELECT * FROM chat_history"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY id DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        try:
+            with self._lock:
+                rows = self.conn.execute(sql, params).fetchall()
+            return [dict(row) for row in reversed(rows)]
         except Exception as e:
             logger.error(f"加载聊天记录失败: {e}")
         return []
+    
+    def save_summary(self, summary):
+        """保存滚动对话摘要"""
+        try:
+            self._set_kv("chat_summary", summary)
+        except Exception as e:
+            logger.error(f"保存对话摘要失败: {e}")
+    
+    def load_summary(self):
+        """加载滚动对话摘要"""
+        try:
+            return self._get_kv("chat_summary")
+        except Exception as e:
+            logger.error(f"加载对话摘要失败: {e}")
+        return None
+    
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self.conn.close()
+
+class WriteBehindWriter:
+    """后台持久化线程：调用方只登记改动并立即返回；等待delay秒收集同一批改动，
+    配置和摘要只写最新的一份，记忆操作和新增的聊天记录各合并为一次写入"""
+    def __init__(self, storage, delay=0.2):
+        self.storage = storage
+        self.delay = delay
+        self._cond = threading.Condition()
+        self._batch = {}
+        self._writing = False
+        self._urgent = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+    
+    @property
+    def pending(self):
+        return bool(self._batch) or self._writing
+    
+    def mark(self, key, value):
+        """登记最新状态，同一批次内后登记的覆盖先登记的"""
+        with self._cond:
+            self._batch[key] = value
+            self._cond.notify_all()
+    
+    def append(self, key, item, state=None):
+        """登记一条按顺序写入的改动；state为写入时需要的最新完整状态"""
+        with self._cond:
+            self._batch.setdefault(key, []).append(item)
+            if state is not None:
+                self._batch[f"{key}:state"] = state
+            self._cond.notify_all()
+    
+    def discard(self, key):
+        """丢弃尚未写入的改动（例如被整体保存或清空取代）"""
+        with self._cond:
+            self._batch.pop(key, None)
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._batch or self._stopped)
+                if not self._batch:
+                    return
+                # 合并窗口：期间的改动并入同一批，flush或关闭时立即写入
+                self._cond.wait_for(lambda: self._urgent or self._stopped, self.delay)
+                batch, self._batch = self._batch, {}
+                self._urgent = False
+                self._writing = True
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f"后台写入失败: {e}")
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+    
+    def _write(self, batch):
+        """按依赖顺序写入一批改动"""
+        if "config" in batch:
+            self.storage.save_config(batch["config"])
+        if "memory_records" in batch:
+            self.storage.append_memory_records(batch["memory_records"], batch["memory_records:state"])
+        if "clear_chat_history" in batch:
+            self.storage.clear_chat_history()
+        if "chat_turns" in batch:
+            self.storage.append_chat_turns(batch["chat_turns"], batch["chat_turns:state"])
+        if "summary" in batch:
+            self.storage.save_summary(batch["summary"])
+    
+    def flush(self, timeout=None):
+        """立即写入已登记的改动并等待完成，返回是否在超时前完成"""
+        with self._cond:
+            if self.pending:
+                self._urgent = True
+                self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self.pending, timeout)
+    
+    def stop(self, timeout=10):
+        """写完剩余的改动后结束线程"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("后台写入未能在关闭前完成")
+
+class ConfigManager:
+    """配置管理类，按配置选择存储后端（sqlite 或 json）；默认由后台线程合并写入，不阻塞调用线程"""
+    def __init__(self, backend=None, base_dir=".", history_limit=8, write_behind=True):
+        # 默认使用SQLite；JSON后端（含记忆日志与后台压缩）需通过 PVENUS_STORAGE=json 显式选择
+        backend = backend or os.environ.get("PVENUS_STORAGE", "sqlite")
+        self.session_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        json_storage = JsonStorage(base_dir, history_limit)
+        if backend == "json":
+            self.storage = json_storage
+        else:
+            try:
+                self.storage = SQLiteStorage(os.path.join(base_dir, "pvenus.db"), self.session_id, legacy=json_storage)
+            except Exception as e:
+                # 数据库无法打开或迁移失败时，本次运行继续以JSON文件为准
+                logger.error(f"初始化SQLite存储失败，本次使用JSON文件存储: {e}")
+                self.storage = json_storage
+                backend = "json"
+        self.writer = WriteBehindWriter(self.storage) if write_behind else None
+        self._config = None # 最近保存的配置，后台写入期间直接从内存返回
+        logger.debug(f"存储后端: {backend}, 后台写入: {'开启' if self.writer else '关闭'}")
+    
+    def configure_persistence(self, fsync=None, delay=None):
+        """设置落盘策略(always/normal/off)与后台写入的合并窗口(秒)"""
+        if fsync is not None:
+            self.storage.set_fsync(fsync)
+        if delay is not None and self.writer:
+            self.writer.delay = delay
+    
+    def flush(self, timeout=None):
+        """等待已登记的改动全部写入"""
+        return self.writer.flush(timeout) if self.writer else True
+    
+    def save_config(self, config):
+        """保存配置"""
+        self._config = config
+        if self.writer:
+            self.writer.mark("config", config)
+        else:
+            self.storage.save_config(config)
+    
+    def load_config(self):
+        """加载配置"""
+        if self._config is None:
+            self._config = self.storage.load_config()
+        return self._config
+    
+    def append_memory_journal(self, record, memory):
+        """记录一次记忆操作"""
+        if self.writer:
+            # 记录中的数据可能在写入前被再次修改，登记时复制一份
+            if "data" in record:
+                record = {**record, "data": dict(record["data"])}
+            self.writer.append("memory_records", record, memory)
+        else:
+            self.storage.append_memory_journal(record, memory)
+    
+    def load_memory(self):
+        """加载永久记忆"""
+        self.flush()
+        return self.storage.load_memory()
+    
+    def append_chat_history(self, turn, history):
+        """追加一轮对话；会话ID在调用线程中写入，入队之后不再修改对话字典。
+        后台写入时内存中的对话不带数据库ID，翻页所需的ID从存储中读取"""
+        turn['session_id'] = self.session_id
+        if self.writer:
+            self.writer.append("chat_turns", turn, history)
+        else:
+            turn_id = self.storage.append_chat_history(turn, history)
+            if turn_id is not None:
+                turn['id'] = turn_id
+    
+    def clear_chat_history(self):
+        """清空聊天记录"""
+        if self.writer:
+            self.writer.discard("chat_turns")
+            self.writer.mark("clear_chat_history", True)
+        else:
+            self.storage.clear_chat_history()
+    
+    def load_chat_history(self, limit=None):
+        """加载最近的聊天记录"""
+        self.flush()
+        return self.storage.load_chat_history(limit)
+    
+    def load_chat_history_range(self, start_time=None, end_time=None, session_id=None, before_id=None, limit=None):
+        """按时间范围、会话或ID游标读取聊天记录"""
+        self.flush()
+        return self.storage.load_chat_history_range(start_time, end_time, session_id, before_id, limit)
+    
+    def save_summary(self, summary):
+        """保存滚动对话摘要"""
+        if self.writer:
+            self.writer.mark("summary", summary)
+        else:
+            self.storage.save_summary(summary)
+    
+    def load_summary(self):
+        """加载滚动对话摘要"""
+        self.flush()
+        return self.storage.load_summary()
+    
+    def close(self):
+        """写完尚未落盘的改动后关闭存储后端"""
+        if self.writer:
+            self.writer.stop()
+        if hasattr(self.storage, "close"):
+            self.storage.close()
+
+class DiskLRUCache:
+    """内容寻址的磁盘缓存，按最近使用顺序(LRU)淘汰并限制总大小"""
+    def __init__(self, directory, max_bytes, suffix=""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.total_bytes = 0
+        self.reclaimed_bytes = 0 # 累计淘汰释放的字节数
+        self._entries = OrderedDict() # key -> 文件大小，按最近使用从旧到新排列
+        self._pinned = {} # 正在使用、不可淘汰的条目 -> 固定次数（同一文件可能同时排队多次）
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+    
+    def _load_index(self):
+        """扫描缓存目录，按修改时间恢复LRU顺序"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(self.suffix) and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                key = entry.name[:len(entry.name) - len(self.suffix)] if self.suffix else entry.name
+                entries.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.total_bytes += size
+    
+    def _path(self, key):
+        """缓存键对应的文件路径"""
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+    
+    def get_path(self, key):
+        """命中时返回缓存文件路径并刷新其使用时间，未命中返回None"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            path = self._path(key)
+            try:
+                os.utime(path)
+            except OSError:
+                # 文件已被外部删除
+                self.total_bytes -= self._entries.pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return path
+    
+    def get_bytes(self, key):
+        """读取缓存内容，未命中返回None"""
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+    
+    def put(self, key, data):
+        """写入缓存（临时文件+原子替换），超出容量时淘汰最久未使用的条目"""
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._evict()
+        return path
+    
+    def put_file(self, key, src_path):
+        """将已写好的文件移入缓存（原子替换），超出容量时淘汰最久未使用的条目"""
+        path = self._path(key)
+        os.replace(src_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self.total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+        return path
+    
+    def pin(self, key):
+        """固定条目，在取消相同次数的固定前不会被淘汰"""
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+    
+    def unpin(self, key=None):
+        """取消一次固定，不传key时取消全部"""
+        with self._lock:
+            if key is None:
+                self._pinned.clear()
+            elif self._pinned.get(key, 0) > 1:
+                self._pinned[key] -= 1
+            else:
+                self._pinned.pop(key, None)
+    
+    def _remove_entry(self, key):
+        """删除一个条目及其文件（调用方需持有锁）"""
+        size = self._entries.pop(key)
+        self.total_bytes -= size
+        self.reclaimed_bytes += size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+    
+    def _evict(self):
+        """淘汰最久未使用的条目直到总大小不超过上限（调用方需持有锁），跳过固定条目和最新条目"""
+        for key in list(self._entries)[:-1]:
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key not in self._pinned:
+                self._remove_entry(key)
+
+SILICONFLOW_BASE_URL = os.environ.get("PVENUS_SILICONFLOW_BASE_URL", "https://api.siliconflow.cn/v1") # 可指向本地模拟服务做压测
+
+class ClientRegistry:
+    """共享HTTP客户端注册表：按base URL复用keep-alive连接池，避免每次调用重复TLS握手"""
+    def __init__(self, max_connections=20, max_keepalive=10, timeout=60.0, connect_timeout=10.0, retire_grace=300.0):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retire_grace = retire_grace # 被替换的连接池在此秒数后关闭，留给进行中的请求（包括较长的流式回复）完成
+        self._lock = threading.Lock()
+        self._loop = None # 异步连接池所在的事件循环，关闭被替换的异步连接池时使用
+        self._retired = [] # 已被替换、等待关闭的连接池
+        self._http_clients = {} # base_url -> openai.DefaultHttpxClient
+        self._openai_clients = {} # (base_url, api_key) -> OpenAI
+        self._sessions = {} # base_url -> requests.Session
+        self._async_http_clients = {} # base_url -> openai.DefaultAsyncHttpxClient
+        self._async_openai_clients = {} # (base_url, api_key) -> AsyncOpenAI
+    
+    def configure(self, max_connections=None, max_keepalive=None, timeout=None, connect_timeout=None):
+        """调整连接池参数；参数变化时换上新的连接池，之后获取的客户端按新参数创建。
+        旧连接池可能仍被进行中的请求使用，等retire_grace秒后再关闭"""
+        settings = (max_connections or self.max_connections, max_keepalive or self.max_keepalive,
+                    timeout or self.timeout, connect_timeout or self.connect_timeout)
+        if settings == (self.max_connections, self.max_keepalive, self.timeout, self.connect_timeout):
+            return
+        with self._lock:
+            self.max_connections, self.max_keepalive, self.timeout, self.connect_timeout = settings
+            pools = self._detach()
+            if not any(pools.values()):
+                return
+            self._retired.append(pools)
+        timer = threading.Timer(self.retire_grace, self._close_retired, args=(pools,))
+        timer.daemon = True
+        timer.start()
+    
+    def _detach(self):
+        """取下当前所有连接池并返回，之后获取的客户端会重新创建（调用方需持有锁）"""
+        pools = {
+            "http": list(self._http_clients.values()),
+            "sessions": list(self._sessions.values()),
+            "async_http": list(self._async_http_clients.values())
+        }
+        self._http_clients.clear()
+        self._openai_clients.clear()
+        self._sessions.clear()
+        self._async_http_clients.clear()
+        self._async_openai_clients.clear()
+        return pools
+    
+    def _close_retired(self, pools):
+        """宽限期结束后关闭被替换的连接池；已在close/aclose中关闭的跳过"""
+        with self._lock:
+            if not any(retired is pools for retired in self._retired):
+                return
+            self._retired = [retired for retired in self._retired if retired is not pools]
+            loop = self._loop
+        self._close_sync(pools)
+        if pools["async_http"] and loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._aclose_all(pools["async_http"]), loop)
+    
+    @staticmethod
+    def _close_sync(pools):
+        for http_client in pools["http"]:
+            http_client.close()
+        for session in pools["sessions"]:
+            session.close()
+    
+    @staticmethod
+    async def _aclose_all(http_clients):
+        for http_client in http_clients:
+            await http_client.aclose()
+    
+    def _pool_options(self):
+        """连接池参数；Limits类型取自openai所依赖的HTTP库"""
+        return {
+            "limits": type(openai.DEFAULT_CONNECTION_LIMITS)(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive
+            ),
+            "timeout": openai.Timeout(self.timeout, connect=self.connect_timeout)
+        }
+    
+    def _get_async_http_client(self, base_url):
+        """获取指定base URL的异步HTTP连接池（调用方需持有锁）"""
+        http_client = self._async_http_clients.get(base_url)
+        if http_client is None:
+            http_client = openai.DefaultAsyncHttpxClient(**self._pool_options())
+            self._async_http_clients[base_url] = http_client
+        return http_client
+    
+    def _get_http_client(self, base_url):
+        """获取指定base URL的HTTP连接池（调用方需持有锁）"""
+        http_client = self._http_clients.get(base_url)
+        if http_client is None:
+            http_client = openai.DefaultHttpxClient(**self._pool_options())
+            self._http_clients[base_url] = http_client
+        return http_client
+    
+    def get_openai(self, api_key, base_url):
+        """获取共享连接池的OpenAI兼容客户端"""
+        with self._lock:
+            client = self._openai_clients.get((base_url, api_key))
+            if client is None:
+                client = openai.OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    http_client=self._get_http_client(base_url)
+                )
+                self._openai_clients[(base_url, api_key)] = client
+            return client
+    
+    def get_async_openai(self, api_key, base_url):
+        """获取共享连接池的异步OpenAI兼容客户端（只能在同一个事件循环中使用）"""
+        with self._lock:
+            client = self._async_openai_clients.get((base_url, api_key))
+            if client is None:
+                client = openai.AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    http_client=self._get_async_http_client(base_url)
+                )
+                self._async_openai_clients[(base_url, api_key)] = client
+            return client
+    
+    def get_session(self, base_url):
+        """获取指定base URL的requests会话，用于非OpenAI格式的接口"""
+        with self._lock:
+            session = self._sessions.get(base_url)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_keepalive)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[base_url] = session
+            return session
+    
+    def prewarm(self, base_urls, loop=None):
+        """后台预先建立连接，让第一轮对话不必承担DNS解析和TLS握手的耗时；传入事件循环时同时预热异步连接池"""
+        base_urls = [base_url for base_url in base_urls if base_url]
+        
+        def worker():
+            # 顺便在后台完成openai的导入，首轮对话不必再承担导入耗时
+            openai.load()
+            for base_url in base_urls:
+                start = time.perf_counter()
+                try:
+                    with self._lock:
+                        http_client = self._get_http_client(base_url)
+                    # 任意响应码都说明连接已建立并回到连接池
+                    http_client.head(base_url, timeout=self.connect_timeout)
+                    logger.debug(f"连接预热完成: {base_url} ({(time.perf_counter() - start) * 1000:.0f}ms)")
+                except Exception as e:
+                    logger.debug(f"连接预热失败: {base_url}: {e}")
+        
+        threading.Thread(target=worker, daemon=True).start()
+        if loop is not None:
+            self._loop = loop
+            asyncio.run_coroutine_threadsafe(self._prewarm_async(base_urls), loop)
+    
+    async def _prewarm_async(self, base_urls):
+        """并发预热异步连接池"""
+        async def warm(base_url):
+            start = time.perf_counter()
+            try:
+                with self._lock:
+                    http_client = self._get_async_http_client(base_url)
+                await http_client.head(base_url, timeout=self.connect_timeout)
+                logger.debug(f"异步连接预热完成: {base_url} ({(time.perf_counter() - start) * 1000:.0f}ms)")
+            except Exception as e:
+                logger.debug(f"异步连接预热失败: {base_url}: {e}")
+        
+        await asyncio.gather(*(warm(base_url) for base_url in base_urls))
+    
+    def close(self):
+        """关闭所有连接池，包括仍在宽限期内的旧连接池"""
+        with self._lock:
+            # 异步连接池只能在其事件循环中关闭（见aclose），这里仅丢弃引用
+            pools = [self._detach()] + self._retired
+            self._retired = []
+        for pool in pools:
+            self._close_sync(pool)
+    
+    async def aclose(self):
+        """在创建异步连接池的事件循环中关闭它们"""
+        with self._lock:
+            http_clients = list(self._async_http_clients.values())
+            self._async_http_clients.clear()
+            self._async_openai_clients.clear()
+            for pools in self._retired:
+                http_clients += pools["async_http"]
+                pools["async_http"] = []
+        await self._aclose_all(http_clients)
+
+client_registry = ClientRegistry()
+
+class AsyncLoopThread:
+    """在后台线程中运行asyncio事件循环，同步代码通过submit/run提交协程"""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="asyncio", daemon=True)
+        self._thread.start()
+    
+    def submit(self, coro):
+        """提交协程，立即返回concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+    
+    def run(self, coro):
+        """提交协程并阻塞等待结果"""
+        return self.submit(coro).result()
+    
+    async def _shutdown(self):
+        """取消仍在进行的阶段并关闭异步连接池"""
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client_registry.aclose()
+    
+    def stop(self, timeout=5):
+        """停止事件循环"""
+        if self.loop.is_closed():
+            return
+        try:
+            self.submit(self._shutdown()).result(timeout)
+        except Exception as e:
+            logger.warning(f"关闭事件循环时出错: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        if not self.loop.is_running():
+            self.loop.close()
+
+# --- 每轮对话的阶段耗时统计 ---
+
+METRIC_SPANS = {
+    "image_analysis": "图片分析",
+    "memory_search": "记忆检索",
+    "prompt_build": "构建提示词",
+    "llm_request": "模型请求",
+    "ttft": "首字延迟",
+    "memory_ops": "记忆操作",
+    "persistence": "保存记录",
+    "tts_synthesis": "语音合成",
+    "speed_adjust": "语音调速",
+    "playback_start": "开始播放",
+    "total": "整轮耗时",
+}
+
+def percentile(sorted_values, p):
+    """最近秩法计算分位数，sorted_values须已排序"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+class TurnMetrics:
+    """一轮对话各阶段的耗时（毫秒），可在多个线程中记录"""
+    def __init__(self):
+        self.timestamp = datetime.now().isoformat()
+        self.begin = time.perf_counter()
+        self.spans = {}
+        self.usage = None # 模型返回的token用量
+        self.lock = threading.Lock()
+    
+    def record(self, name, elapsed_ms):
+        """累加一个阶段的耗时，同一阶段执行多次（如分段合成）时求和"""
+        with self.lock:
+            self.spans[name] = self.spans.get(name, 0.0) + elapsed_ms
+    
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+    
+    def record_usage(self, prompt_tokens, cached_tokens, completion_tokens):
+        """记录本轮的token用量，cached_tokens为命中服务端提示词缓存的部分"""
+        self.usage = {"prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens, "completion_tokens": completion_tokens}
+    
+    async def timed(self, name, awaitable):
+        """等待awaitable并把耗时记为一个阶段，用于asyncio.gather中并发执行的阶段"""
+        with self.span(name):
+            return await awaitable
+    
+    def as_dict(self):
+        with self.lock:
+            spans = {name: round(elapsed, 1) for name, elapsed in self.spans.items()}
+        spans["total"] = round((time.perf_counter() - self.begin) * 1000, 1)
+        record = {"timestamp": self.timestamp, "spans": spans}
+        if self.usage:
+            record["usage"] = self.usage
+        return record
+
+class MetricsRecorder:
+    """把每轮对话的阶段耗时追加到按大小轮转的JSONL文件，并保留最近window轮用于计算p50/p95/p99"""
+    def __init__(self, path, max_bytes=5 * 1024 * 1024, backup_count=3, window=200):
+        self.path = path
+        self.window = window
+        self.samples = None # {阶段: 最近的耗时}，首次查询时从文件末尾恢复
+        self.usage = None # 最近各轮的 (提示词token数, 命中缓存的token数)
+        self.lock = threading.Lock()
+        self.handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True
+        )
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+    
+    def configure(self, max_bytes=None, window=None):
+        if max_bytes is not None:
+            self.handler.maxBytes = max_bytes
+        if window is not None and window != self.window:
+            with self.lock:
+                self.window = window
+                if self.samples is not None:
+                    self.samples = {name: deque(values, maxlen=window) for name, values in self.samples.items()}
+                    self.usage = deque(self.usage, maxlen=window)
+    
+    def _add_sample(self, record):
+        for name, elapsed in record.get("spans", {}).items():
+            self.samples.setdefault(name, deque(maxlen=self.window)).append(elapsed)
+        usage = record.get("usage")
+        if usage:
+            self.usage.append((usage.get("prompt_tokens", 0), usage.get("cached_tokens", 0)))
+    
+    def _load_recent(self):
+        """读取当前指标文件末尾的最近window条记录"""
+        self.samples = {}
+        self.usage = deque(maxlen=self.window)
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = deque(f, maxlen=self.window)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"读取性能指标失败: {e}")
+            return
+        for line in lines:
+            try:
+                self._add_sample(json.loads(line))
+            except ValueError:
+                continue
+    
+    def record_turn(self, metrics):
+        """写入一轮对话的指标"""
+        record = metrics.as_dict()
+        self.handler.handle(logging.makeLogRecord({"msg": json.dumps(record, ensure_ascii=False)}))
+        with self.lock:
+            if self.samples is not None:
+                self._add_sample(record)
+        logger.debug(f"本轮耗时: {record['spans']}")
+    
+    def summary(self):
+        """各阶段最近window轮的样本数与分位数（毫秒）"""
+        with self.lock:
+            if self.samples is None:
+                self._load_recent()
+            result = {}
+            for name, values in self.samples.items():
+                ordered = sorted(values)
+                result[name] = {"count": len(ordered), **{f"p{p}": percentile(ordered, p) for p in (50, 95, 99)}}
+            return result
+    
+    def cache_hit_rate(self):
+        """最近各轮提示词token中命中缓存的比例，返回 (命中率, 轮数)；没有用量数据时命中率为None"""
+        with self.lock:
+            if self.samples is None:
+                self._load_recent()
+            prompt_tokens = sum(prompt for prompt, _ in self.usage)
+            cached_tokens = sum(cached for _, cached in self.usage)
+            return (cached_tokens / prompt_tokens if prompt_tokens else None), len(self.usage)
+    
+    def format_summary(self):
+        """生成分位数表格文本"""
+        summary = self.summary()
+        if not summary:
+            return "暂无性能数据"
+        lines = [f"{'次数':>4}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}  阶段"]
+        for name in list(METRIC_SPANS) + sorted(set(summary) - set(METRIC_SPANS)):
+            if name in summary:
+                stats = summary[name]
+                lines.append(f"{stats['count']:>6}{stats['p50']:>10.0f}{stats['p95']:>10.0f}{stats['p99']:>10.0f}  {METRIC_SPANS.get(name, name)}")
+        hit_rate, turns = self.cache_hit_rate()
+        if hit_rate is not None:
+            lines.append(f"提示词缓存命中率: {hit_rate:.1%}（最近 {turns} 轮）")
+        return "\n".join(lines)
+    
+    def close(self):
+        self.handler.close()
 
 class FileProcessor:
     """文件处理类"""
-    def __init__(self, siliconflow_key):
+    MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif", "BMP": "image/bmp"}
+    VISION_MODEL = "Qwen/Qwen2.5-VL-72B-Instruct"
+    VISION_PROMPT = "请详细表述这幅图片的内容，包括场景、人物、物品、行为，以及场景可能想要表示的内容。"
+    
+    def __init__(self, siliconflow_key, max_side=1568, image_format="JPEG", quality=85,
+                 cache_dir="image_cache", cache_max_bytes=50 * 1024 * 1024, max_concurrency=3, base_dir="."):
         self.siliconflow_key = siliconflow_key
         self.image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+        self.max_side = max_side
+        self.image_format = image_format.upper().replace("JPG", "JPEG")
+        self.quality = quality
+        self.low_detail_max_side = 512 # 最终最长边不超过该值时使用 detail=low
+        self.analysis_cache = DiskLRUCache(os.path.join(base_dir, cache_dir), cache_max_bytes, suffix=".txt")
+        self._inflight = {} # 缓存键 -> 正在进行的分析请求(Future)
+        self._inflight_lock = threading.Lock()
+        # 有界线程池，限制同时进行的图片分析请求数以符合服务商限流
+        self.max_concurrency = max(1, max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="vision")
+    
+    def close(self):
+        """不再接受新的分析请求；已提交的分析仍会完成，线程随后退出"""
+        self._executor.shutdown(wait=False)
     
     def is_image_file(self, file_path):
         """判断是否为图片文件"""
@@ -117,50 +1334,311 @@ class FileProcessor:
             logger.error(f"图片编码失败: {e}")
             return None
     
-    def analyze_image(self, image_path):
-        """使用Qwen2.5-VL分析图片"""
+    def prepare_image(self, image_path):
+        """预处理图片：按EXIF方向旋转、限制最长边并重新编码，返回 (base64, MIME类型, detail)"""
         try:
-            client = OpenAI(
-                api_key=self.siliconflow_key,
-                base_url="https://api.siliconflow.cn/v1"
-            )
+            with Image.open(image_path) as original:
+                original_format = original.format
+                orientation = original.getexif().get(0x0112, 1)
+                img = ImageOps.exif_transpose(original)
             
-            base64_image = self.encode_image_to_base64(image_path)
-            if not base64_image:
-                return "图片编码失败"
-            
-            response = client.chat.completions.create(
-                model="Qwen/Qwen2.5-VL-72B-Instruct",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}",
-                                    "detail":"high"
-                                }
-                            },
-                            {"type": "text", "text": "请详细表述这幅图片的内容，包括场景、人物、物品、行为，以及场景可能想要表示的内容。"}
-                        ]
-                    }
-                ],
-                max_tokens=1000
-            )
-            
-            return response.choices[0].message.content
+            image_format = self.image_format
+            if orientation == 1 and original_format == image_format and max(img.size) <= self.max_side:
+                # 尺寸与格式都已符合要求，直接使用原图避免二次压缩
+                with open(image_path, "rb") as image_file:
+                    data = image_file.read()
+            else:
+                img.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+                if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+                    # JPEG不支持透明通道，合成到白色背景上
+                    rgba = img.convert("RGBA")
+                    img = Image.new("RGB", rgba.size, (255, 255, 255))
+                    img.paste(rgba, mask=rgba.getchannel("A"))
+                elif img.mode == "P":
+                    img = img.convert("RGBA")
+                
+                save_options = {"quality": self.quality} if image_format in ("JPEG", "WEBP") else {}
+                if image_format == "JPEG":
+                    save_options["optimize"] = True
+                buffer = io.BytesIO()
+                img.save(buffer, format=image_format, **save_options)
+                data = buffer.getvalue()
             
+            detail = "low" if max(img.size) <= self.low_detail_max_side else "high"
+            logger.debug(f"图片预处理完成: {img.size[0]}x{img.size[1]}, {len(data)} 字节, detail={detail}")
+            return base64.b64encode(data).decode('utf-8'), self.MIME_TYPES.get(image_format, "image/jpeg"), detail
         except Exception as e:
+            logger.warning(f"图片预处理失败，改为上传原图: {e}")
+            base64_image = self.encode_image_to_base64(image_path)
+            if not base64_image:
+                return None, None, None
+            mime_type = self.MIME_TYPES.get(Path(image_path).suffix.lower().lstrip('.').upper().replace("JPG", "JPEG"), "image/jpeg")
+            return base64_image, mime_type, "high"
+    
+    def _analysis_cache_key(self, image_path):
+        """由图片内容、模型、提示词和预处理参数计算缓存键"""
+        digest = hashlib.sha256()
+        with open(image_path, "rb") as image_file:
+            for block in iter(lambda: image_file.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(f"\0{self.VISION_MODEL}\0{self.VISION_PROMPT}\0{self.max_side}\0{self.image_format}\0{self.quality}".encode('utf-8'))
+        return digest.hexdigest()
+    
+    def _claim_inflight(self, cache_key):
+        """登记进行中的分析请求，返回 (Future, 是否由调用方负责请求)"""
+        with self._inflight_lock:
+            future = self._inflight.get(cache_key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._inflight[cache_key] = future
+            return future, True
+    
+    def _release_inflight(self, cache_key, future, result):
+        """结束进行中的分析请求，唤醒所有等待者"""
+        with self._inflight_lock:
+            del self._inflight[cache_key]
+        future.set_result(result)
+    
+    async def analyze_image_async(self, image_path, client):
+        """分析图片：优先读缓存，相同图片的并发请求合并为一次API调用"""
+        loop = asyncio.get_running_loop()
+        try:
+            cache_key = await loop.run_in_executor(self._executor, self._analysis_cache_key, image_path)
+        except OSError as e:
             logger.error(f"图片分析失败: {e}")
             return f"图片分析失败: {str(e)}"
+        
+        cached = self.analysis_cache.get_bytes(cache_key)
+        if cached is not None:
+            logger.info(f"命中图片分析缓存: {image_path}")
+            return cached.decode('utf-8')
+        
+        future, is_owner = self._claim_inflight(cache_key)
+        if not is_owner:
+            logger.info(f"相同图片正在分析，等待其结果: {image_path}")
+            return await asyncio.wrap_future(future)
+        
+        result = None
+        try:
+            # 解码与缩放属于CPU密集操作，放到线程池中执行以免阻塞事件循环
+            messages = await loop.run_in_executor(self._executor, self._build_vision_messages, image_path)
+            if messages is None:
+                result = "图片编码失败"
+            else:
+                response = await client.chat.completions.create(
+                    model=self.VISION_MODEL,
+                    messages=messages,
+                    max_tokens=1000,
+                    timeout=60
+                )
+                result = response.choices[0].message.content
+                self.analysis_cache.put(cache_key, result.encode('utf-8'))
+        except Exception as e:
+            logger.error(f"图片分析失败: {e}")
+            result = f"图片分析失败: {str(e)}"
+        finally:
+            self._release_inflight(cache_key, future, result)
+        return result
+    
+    async def analyze_images_async(self, image_paths, client):
+        """异步并发分析多张图片，同时进行的请求数不超过max_concurrency，结果按输入顺序返回"""
+        slots = asyncio.Semaphore(self.max_concurrency)
+        
+        async def analyze(image_path):
+            async with slots:
+                return await self.analyze_image_async(image_path, client)
+        
+        return list(await asyncio.gather(*(analyze(path) for path in image_paths)))
+    
+    def _build_vision_messages(self, image_path):
+        """构建图片分析请求的消息列表，编码失败时返回None"""
+        base64_image, mime_type, detail = self.prepare_image(image_path)
+        if not base64_image:
+            return None
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mime_type};base64,{base64_image}",
+                            "detail": detail
+                        }
+                    },
+                    {"type": "text", "text": self.VISION_PROMPT}
+                ]
+            }
+        ]
+
+class HashingEmbedder:
+    """本地哈希嵌入器：对字符 n-gram 做特征哈希，离线可用且无需模型文件"""
+    default_min_score = 0.08 # 只有字面重合才有相似度，相关记忆的得分通常只有0.1左右；单字偶然重合约0.06
+    
+    def __init__(self, dim=512):
+        self.dim = dim
+    
+    def _features(self, text):
+        """提取特征：英文/数字按词，中文等按单字和双字"""
+        features = []
+        for token in re.findall(r"\w+", text.lower()):
+            if token.isascii():
+                features.append(token)
+            else:
+                features.extend(token)
+                features.extend(token[i:i + 2] for i in range(len(token) - 1))
+        return features
+    
+    def embed(self, texts):
+        """将文本列表编码为L2归一化的向量矩阵"""
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode('utf-8'))
+                vectors[row, h % self.dim] += -1.0 if h & 0x80000000 else 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+class SentenceTransformerEmbedder:
+    """基于 sentence-transformers 的本地嵌入器（需预先下载模型）"""
+    default_min_score = 0.3
+    
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+    
+    def embed(self, texts):
+        """将文本列表编码为L2归一化的向量矩阵"""
+        return np.asarray(self.model.encode(list(texts), normalize_embeddings=True), dtype=np.float32)
+
+def create_embedder(spec="hashing"):
+    """根据配置创建嵌入器，如 "hashing"、"hashing:1024"、"sentence-transformers:<模型名>" """
+    name, _, arg = (spec or "hashing").partition(":")
+    if name == "sentence-transformers" and arg:
+        try:
+            return SentenceTransformerEmbedder(arg)
+        except Exception as e:
+            logger.error(f"加载嵌入模型失败，改用哈希嵌入: {e}")
+    elif name == "hashing" and arg.isdigit():
+        return HashingEmbedder(int(arg))
+    return HashingEmbedder()
+
+class MemoryIndex:
+    """记忆向量索引，维护 NumPy 嵌入矩阵并随记忆增删改增量更新"""
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self.ids = []
+        self.rows = {}
+        self.matrix = np.zeros((16, embedder.dim), dtype=np.float32)
+    
+    def rebuild(self, memory):
+        """根据全部记忆重建索引"""
+        self.ids = list(memory.keys())
+        self.rows = {mem_id: row for row, mem_id in enumerate(self.ids)}
+        self.matrix = np.zeros((max(16, len(self.ids)), self.embedder.dim), dtype=np.float32)
+        if self.ids:
+            self.matrix[:len(self.ids)] = self.embedder.embed([memory[i]['content'] for i in self.ids])
+    
+    def upsert(self, memory_id, content):
+        """新增或更新一条记忆的向量"""
+        row = self.rows.get(memory_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self.matrix):
+                # 容量翻倍扩展，均摊O(1)
+                grown = np.zeros((row * 2, self.matrix.shape[1]), dtype=np.float32)
+                grown[:row] = self.matrix
+                self.matrix = grown
+            self.ids.append(memory_id)
+            self.rows[memory_id] = row
+        self.matrix[row] = self.embedder.embed([content])[0]
+    
+    def remove(self, memory_id):
+        """删除一条记忆的向量（与末行交换后删除）"""
+        row = self.rows.pop(memory_id, None)
+        if row is None:
+            return
+        last = len(self.ids) - 1
+        if row != last:
+            moved_id = self.ids[last]
+            self.matrix[row] = self.matrix[last]
+            self.ids[row] = moved_id
+            self.rows[moved_id] = row
+        self.ids.pop()
+    
+    def search(self, query, top_k, min_score):
+        """返回与查询最相似的记忆 [(记忆ID, 相似度)]，按相似度降序"""
+        count = len(self.ids)
+        if count == 0:
+            return []
+        scores = self.matrix[:count] @ self.embedder.embed([query])[0]
+        k = min(top_k, count)
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(self.ids[i], float(scores[i])) for i in candidates if scores[i] >= min_score]
 
 class MemoryManager:
     """记忆管理类"""
-    def __init__(self, config_manager):
+    _versions = itertools.count(1) # 所有实例共用的版本号序列，记忆每次变化都取新值
+    
+    def __init__(self, config_manager, embedder=None):
         self.config_manager = config_manager
         self.memory = self.config_manager.load_memory()
+        self.version = next(self._versions) # 渲染好的记忆上下文按版本号缓存
         self.next_id = max([int(k) for k in self.memory.keys()] + [0]) + 1
+        self.top_k = 8
+        self.min_score = None # 为None时使用嵌入器自己的默认阈值
+        self.min_results = 3 # 检索结果不足时用最近修改的记忆补足
+        self.embedder = embedder
+        self.embedder_spec = None
+        self._index = None
+    
+    @property
+    def index(self):
+        """记忆向量索引，首次检索或修改记忆时才建立，未安装NumPy时为None"""
+        if self._index is None and HAS_NUMPY:
+            if self.embedder is None:
+                self.embedder = create_embedder(self.embedder_spec)
+            index = MemoryIndex(self.embedder)
+            index.rebuild(self.memory)
+            self._index = index
+        return self._index
+    
+    def configure_retrieval(self, top_k=None, min_score=None, embedder_spec=None, min_results=None):
+        """配置记忆检索参数，更换嵌入器时重建索引"""
+        if top_k is not None:
+            self.top_k = top_k
+        if min_score is not None:
+            self.min_score = min_score
+        if min_results is not None:
+            self.min_results = min_results
+        if embedder_spec and embedder_spec != self.embedder_spec and HAS_NUMPY:
+            # 嵌入器在下次使用索引时才创建，避免启动时加载模型
+            self.embedder_spec = embedder_spec
+            self.embedder = None
+            self._index = None
+    
+    def search_memory(self, query, top_k=None, min_score=None):
+        """检索与当前输入最相关的记忆，返回 [(记忆ID, 记忆数据)]"""
+        top_k = self.top_k if top_k is None else top_k
+        # 记忆总数不超过top_k或无法检索时，直接返回全部记忆
+        if not query or self.index is None or len(self.memory) <= top_k:
+            return list(self.memory.items())
+        if min_score is None:
+            min_score = self.embedder.default_min_score if self.min_score is None else self.min_score
+        items = [(mem_id, self.memory[mem_id]) for mem_id, _ in self.index.search(query, top_k, min_score)]
+        # 没有足够相关的记忆时（如寒暄），补充最近修改的记忆，避免模型完全看不到记忆
+        if len(items) < self.min_results:
+            items += self.recent_memories(self.min_results - len(items), exclude={mem_id for mem_id, _ in items})
+        return items
+    
+    def recent_memories(self, count, exclude=()):
+        """最近修改的count条记忆，按修改时间降序"""
+        candidates = ((mem_id, mem_data) for mem_id, mem_data in self.memory.items() if mem_id not in exclude)
+        return heapq.nlargest(count, candidates, key=lambda item: item[1]['last_modified'])
     
     def add_memory(self, content):
         """添加新记忆"""
@@ -172,14 +1650,20 @@ class MemoryManager:
             "last_modified": current_time
         }
         self.next_id += 1
-        self.config_manager.save_memory(self.memory)
+        self.version = next(self._versions)
+        if self.index is not None:
+            self.index.upsert(memory_id, content)
+        self.config_manager.append_memory_journal({"op": "put", "id": memory_id, "data": self.memory[memory_id]}, self.memory)
         return memory_id
     
     def delete_memory(self, memory_id):
         """删除记忆"""
         if memory_id in self.memory:
             del self.memory[memory_id]
-            self.config_manager.save_memory(self.memory)
+            self.version = next(self._versions)
+            if self.index is not None:
+                self.index.remove(memory_id)
+            self.config_manager.append_memory_journal({"op": "del", "id": memory_id}, self.memory)
             return True
         return False
     
@@ -188,28 +1672,20 @@ class MemoryManager:
         if memory_id in self.memory:
             self.memory[memory_id]["content"] = new_content
             self.memory[memory_id]["last_modified"] = datetime.now().isoformat()
-            self.config_manager.save_memory(self.memory)
+            self.version = next(self._versions)
+            if self.index is not None:
+                self.index.upsert(memory_id, new_content)
+            self.config_manager.append_memory_journal({"op": "put", "id": memory_id, "data": self.memory[memory_id]}, self.memory)
             return True
         return False
-    
-    def get_memory_prompt(self):
-        """获取记忆提示词"""
-        if not self.memory:
-            return ""
-        
-        memory_text = "永久记忆:\n"
-        for mem_id, mem_data in self.memory.items():
-            memory_text += f"[{mem_id}] {mem_data['content']} (创建: {mem_data['created_time'][:19]}, 修改: {mem_data['last_modified'][:19]})\n"
-        return memory_text
 
 class VoiceManager:
     """语音管理类"""
-    def __init__(self, siliconflow_key):
+    def __init__(self, siliconflow_key, cache_max_bytes=200 * 1024 * 1024,
+                 catalog_file="voice_catalog.json", catalog_ttl_seconds=3600, base_dir="."):
         self.siliconflow_key = siliconflow_key
-        self.client = OpenAI(
-            api_key=siliconflow_key,
-            base_url="https://api.siliconflow.cn/v1"
-        )
+        self.base_dir = base_dir # 语音缓存、音色目录和输出文件都放在该目录下
+        self.audio_cache = DiskLRUCache(os.path.join(base_dir, "tts_cache"), cache_max_bytes, suffix=".mp3")
         self.available_voices = {
             "1": "FunAudioLLM/CosyVoice2-0.5B:alex",
             "2": "FunAudioLLM/CosyVoice2-0.5B:anna",
@@ -220,28 +1696,79 @@ class VoiceManager:
             "7": "FunAudioLLM/CosyVoice2-0.5B:david",
             "8": "FunAudioLLM/CosyVoice2-0.5B:diana"
         }
-        self.custom_voices = self.get_custom_voices()
+        self.catalog_file = os.path.join(base_dir, catalog_file)
+        self.catalog_ttl_seconds = catalog_ttl_seconds
+        # 先用本地缓存的音色目录，过期后由refresh_voices在后台刷新
+        catalog = self._load_voice_catalog()
+        self.custom_voices = catalog["voices"] if catalog else []
         self.selected_voice = "FunAudioLLM/CosyVoice2-0.5B:alex"
     
+    @property
+    def client(self):
+        """语音服务客户端，首次使用时才创建（并导入openai）"""
+        return client_registry.get_openai(self.siliconflow_key, SILICONFLOW_BASE_URL)
+    
+    def _catalog_owner(self):
+        """音色目录缓存所属的API Key指纹，切换账号后旧缓存自动失效"""
+        return hashlib.sha256(self.siliconflow_key.encode('utf-8')).hexdigest()[:16]
+    
+    def _load_voice_catalog(self):
+        """读取本地音色目录缓存，不存在、已损坏或属于其他账号时返回None"""
+        try:
+            with open(self.catalog_file, 'r', encoding='utf-8') as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(catalog, dict) or catalog.get("owner") != self._catalog_owner():
+            return None
+        return catalog
+    
+    def _save_voice_catalog(self, catalog):
+        """原子写入音色目录缓存"""
+        tmp_path = f"{self.catalog_file}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(catalog, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.catalog_file)
+        except OSError as e:
+            logger.warning(f"保存音色目录缓存失败: {e}")
+    
+    def refresh_voices(self, force=False):
+        """刷新自定义音色列表；缓存未过期时直接使用缓存"""
+        catalog = self._load_voice_catalog()
+        if not force and catalog and time.time() - catalog.get("fetched_at", 0) < self.catalog_ttl_seconds:
+            self.custom_voices = catalog["voices"]
+        else:
+            self.custom_voices = self.get_custom_voices()
+        return self.custom_voices
+    
     def get_custom_voices(self):
-        """获取用户自定义音色列表"""
+        """获取用户自定义音色列表：带超时的条件请求，未变化时沿用缓存，失败时返回旧缓存"""
+        catalog = self._load_voice_catalog() or {"owner": self._catalog_owner(), "etag": None, "voices": [], "fetched_at": 0}
+        headers = {"Authorization": f"Bearer {self.siliconflow_key}"}
+        if catalog.get("etag"):
+            headers["If-None-Match"] = catalog["etag"]
         try:
-            import requests
-            response = requests.get(
-                "https://api.siliconflow.cn/v1/audio/voice/list",
-                headers={"Authorization": f"Bearer {self.siliconflow_key}"}
+            response = client_registry.get_session(SILICONFLOW_BASE_URL).get(
+                f"{SILICONFLOW_BASE_URL}/audio/voice/list",
+                headers=headers,
+                timeout=(client_registry.connect_timeout, 10)
             )
-            if response.status_code == 200:
+            if response.status_code == 304:
+                logger.debug("自定义音色列表未变化")
+            elif response.status_code == 200:
                 logger.debug(response.json())
                 # 提取uri列表
-                info = []
-                for i in response.json().get("result", []):
-                    if i.get("uri"):
-                        info.append(i)
-                return info
+                catalog["voices"] = [i for i in response.json().get("result", []) if i.get("uri")]
+                catalog["etag"] = response.headers.get("ETag")
+            else:
+                logger.error(f"获取自定义音色失败: HTTP {response.status_code}")
+                return catalog["voices"]
+            catalog["fetched_at"] = time.time()
+            self._save_voice_catalog(catalog)
         except Exception as e:
             logger.error(f"获取自定义音色失败: {e}")
-        return []
+        return catalog["voices"]
     
     def show_voice_options(self):
         """显示音色选择菜单"""
@@ -285,26 +1812,62 @@ class VoiceManager:
             logger.error(f"选择音色时出错: {e}")
             print("选择音色失败")
     
+    def speech_cache_key(self, text, speed=1.0, audio_format="mp3"):
+        """语音缓存键：(音色, 规范化文本, 语速, 格式) 的哈希"""
+        normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+        return hashlib.sha256(f"{self.selected_voice}\0{normalized}\0{speed:.2f}\0{audio_format}".encode('utf-8')).hexdigest()
+    
     def text_to_speech(self, text, output_file="output.mp3"):
-        """文本转语音"""
+        """文本转语音，相同音色和文本的结果直接从缓存复制"""
         try:
-            speech_file_path = Path(output_file)
+            speech_file_path = Path(self.base_dir, output_file)
+            cache_key = self.speech_cache_key(text)
+            cached_path = self.audio_cache.get_path(cache_key)
             
-            with self.client.audio.speech.with_streaming_response.create(
-                model="FunAudioLLM/CosyVoice2-0.5B",
-                voice=self.selected_voice,
-                input=text,
-                response_format="mp3"
-            ) as response:
-                response.stream_to_file(speech_file_path)
+            if cached_path:
+                logger.info("命中语音缓存，跳过合成")
+            else:
+                tmp_path = os.path.join(self.audio_cache.directory, f"{cache_key}.{uuid.uuid4().hex[:8]}.tmp")
+                with self.client.audio.speech.with_streaming_response.create(
+                    model="FunAudioLLM/CosyVoice2-0.5B",
+                    voice=self.selected_voice,
+                    input=text,
+                    response_format="mp3"
+                ) as response:
+                    response.stream_to_file(tmp_path)
+                cached_path = self.audio_cache.put_file(cache_key, tmp_path)
             
+            shutil.copyfile(cached_path, speech_file_path)
             return str(speech_file_path)
         except Exception as e:
             logger.error(f"语音合成失败: {e}")
             return None
 
+def estimate_tokens(text):
+    """在本地估算文本的token数：中日韩等宽字符约1个token，其余字符约4个字符1个token"""
+    if not text:
+        return 0
+    wide = sum(1 for ch in text if ch >= "\u2e80")
+    return wide + (len(text) - wide + 3) // 4
+
 class PromptBuilder:
     """提示词构建类"""
+    RENDER_CACHE_SIZE = 64
+    _render_cache = OrderedDict() # 渲染好的偏好/记忆文本，键中包含配置内容或记忆版本号，变化后自然失效
+    _render_lock = threading.Lock()
+    
+    @classmethod
+    def _memoize(cls, key, render):
+        with cls._render_lock:
+            if key in cls._render_cache:
+                cls._render_cache.move_to_end(key)
+                return cls._render_cache[key]
+        text = render()
+        with cls._render_lock:
+            cls._render_cache[key] = text
+            if len(cls._render_cache) > cls.RENDER_CACHE_SIZE:
+                cls._render_cache.popitem(last=False)
+        return text
     
     @staticmethod
     def build_system_prompt():
@@ -343,28 +1906,52 @@ class PromptBuilder:
         
         return "\n".join(context_parts) if context_parts else "用户信息: 暂无特殊偏好"
     
+    @classmethod
+    def build_cached_user_context(cls, preferences):
+        """偏好文本按偏好内容缓存，修改配置后自动重新渲染"""
+        key = ("preferences", json.dumps(preferences, ensure_ascii=False, sort_keys=True))
+        return cls._memoize(key, lambda: cls.build_user_context(preferences))
+    
     @staticmethod
-    def build_memory_context(memory_manager):
-        """构建记忆上下文"""
+    def build_memory_line(mem_id, mem_data, detail="full"):
+        """渲染一条记忆；detail为full时带创建和修改时间，date时只带修改日期，none时不带时间"""
+        if detail == "full":
+            created = mem_data['created_time'][:19].replace('T', ' ')
+            modified = mem_data['last_modified'][:19].replace('T', ' ')
+            return f"[{mem_id}] {mem_data['content']} (创建:{created}, 修改:{modified})"
+        if detail == "date":
+            return f"[{mem_id}] {mem_data['content']} ({mem_data['last_modified'][:10]})"
+        return f"[{mem_id}] {mem_data['content']}"
+    
+    @classmethod
+    def build_memory_context(cls, memory_manager, query=None, items=None, detail="full"):
+        """构建记忆上下文，提供query时只注入最相关的记忆，也可直接传入选好的记忆items；
+        相同记忆版本下选中相同记忆时直接复用渲染结果"""
         if not memory_manager.memory:
             return "永久记忆: 暂无"
         
-        memory_lines = ["永久记忆:"]
-        for mem_id, mem_data in memory_manager.memory.items():
-            created = mem_data['created_time'][:19].replace('T', ' ')
-            modified = mem_data['last_modified'][:19].replace('T', ' ')
-            memory_lines.append(f"[{mem_id}] {mem_data['content']} (创建:{created}, 修改:{modified})")
+        if items is None:
+            items = memory_manager.search_memory(query)
+        if not items:
+            # 与“暂无记忆”区分，让模型知道只是这一轮没有选中记忆
+            return "永久记忆: 无与当前输入相关的记忆"
+        
+        def render():
+            memory_lines = ["永久记忆:"]
+            for mem_id, mem_data in items:
+                memory_lines.append(cls.build_memory_line(mem_id, mem_data, detail))
+            return "\n".join(memory_lines)
         
-        return "\n".join(memory_lines)
+        return cls._memoize(("memory", memory_manager.version, tuple(mem_id for mem_id, _ in items), detail), render)
     
     @staticmethod
     def build_chat_history_context(chat_history, limit=4):
-        """构建聊天历史上下文"""
+        """构建聊天历史上下文，limit为None时包含传入的全部记录"""
         if not chat_history:
             return "聊天历史: 这是第一次对话"
         
         history_lines = ["最近的聊天记录:"]
-        recent_chats = chat_history[-limit:] if len(chat_history) > limit else chat_history
+        recent_chats = chat_history[-limit:] if limit and len(chat_history) > limit else chat_history
         
         for i, chat in enumerate(recent_chats, 1):
             history_lines.append(f"{i}. 用户: {chat['user']}")
@@ -373,6 +1960,11 @@ class PromptBuilder:
         
         return "\n".join(history_lines)
     
+    @staticmethod
+    def build_summary_context(summary):
+        """较早对话的滚动摘要，没有摘要时为空"""
+        return f"较早的对话摘要:\n{summary}" if summary else ""
+    
     @staticmethod
     def build_json_format_instruction():
         """构建JSON格式说明"""
@@ -397,8 +1989,10 @@ class PromptBuilder:
 - 添加记忆时只需要提供action和content"""
     
     @classmethod
-    def build_complete_prompt(cls, user_input, preferences, memory_manager, chat_history):
-        """构建完整的提示词"""
+    def build_complete_prompt(cls, user_input, preferences, memory_manager, chat_history, memory_context=None, history_limit=4, summary=""):
+        """构建完整的提示词；memory_context为已检索好的记忆上下文时不再重复检索"""
+        if memory_context is None:
+            memory_context = cls.build_memory_context(memory_manager, user_input)
         current_time = datetime.now().strftime("%Y年%m月%d日 %H:%M:%S")
         
         prompt_parts = [
@@ -408,9 +2002,10 @@ class PromptBuilder:
             "",
             cls.build_user_context(preferences),
             "",
-            cls.build_memory_context(memory_manager),
+            memory_context,
             "",
-            cls.build_chat_history_context(chat_history),
+            *([cls.build_summary_context(summary), ""] if summary else []),
+            cls.build_chat_history_context(chat_history, history_limit),
             "",
             f"用户当前输入: {user_input}",
             "",
@@ -418,17 +2013,504 @@ class PromptBuilder:
         ]
         
         return "\n".join(prompt_parts)
+    
+    @classmethod
+    def build_static_system_message(cls):
+        """系统规则与回复格式说明，与用户和对话无关"""
+        return cls._memoize("system", lambda: cls.build_system_prompt() + "\n" + cls.build_json_format_instruction())
+    
+    @classmethod
+    def build_messages(cls, user_input, preferences, memory_manager, chat_history, memory_context=None, history_limit=4, summary=""):
+        """构建结构化消息，按变化频率从低到高排列：固定的系统规则、偏好与记忆（以及较早对话的摘要）、聊天历史，
+        最后才是每轮都不同的当前时间和用户输入，使连续请求共享尽可能长的前缀以命中服务端提示词缓存"""
+        if memory_context is None:
+            memory_context = cls.build_memory_context(memory_manager, user_input)
+        messages = [
+            {"role": "system", "content": cls.build_static_system_message()},
+            {"role": "system", "content": "\n\n".join(filter(None, [
+                cls.build_cached_user_context(preferences),
+                memory_context,
+                cls.build_summary_context(summary)
+            ]))}
+        ]
+        for chat in chat_history[-history_limit:] if history_limit else chat_history:
+            messages.append({"role": "user", "content": chat['user']})
+            messages.append({"role": "assistant", "content": chat['ai']})
+        current_time = datetime.now().strftime("%Y年%m月%d日 %H:%M:%S")
+        messages.append({"role": "user", "content": f"当前时间: {current_time}\n\n用户当前输入: {user_input}"})
+        return messages
+
+class ContextPacker:
+    """按token预算组装上下文：先放最近几轮对话，再放相关记忆，剩余空间再放更早的对话；
+    空间紧张时记忆的时间戳依次压缩为日期、去掉，仍放不下时只保留最相关的若干条"""
+    TURN_OVERHEAD = 8 # 每轮对话的角色标记等额外开销
+    MEMORY_DETAILS = ("full", "date", "none")
+    
+    def __init__(self, token_budget=3000, recent_turns=4, max_turns=20, min_reply_tokens=1024, max_reply_tokens=2000):
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.max_turns = max_turns
+        self.min_reply_tokens = min_reply_tokens
+        self.max_reply_tokens = max_reply_tokens
+    
+    def turn_tokens(self, turn):
+        return estimate_tokens(turn['user']) + estimate_tokens(turn['ai']) + self.TURN_OVERHEAD
+    
+    def _take_turns(self, turns, budget):
+        """从最新的一轮开始往前取，直到放不下，返回 (选中的轮次(新到旧), 用掉的token, 是否全部放下)"""
+        chosen, used = [], 0
+        for turn in reversed(turns):
+            cost = self.turn_tokens(turn)
+            if used + cost > budget:
+                return chosen, used, False
+            chosen.append(turn)
+            used += cost
+        return chosen, used, True
+    
+    def _pack_memory(self, memory_manager, items, budget):
+        """在预算内渲染尽可能详细的记忆上下文，返回 (记忆上下文, 用掉的token)"""
+        if not memory_manager.memory or not items:
+            context = PromptBuilder.build_memory_context(memory_manager, items=[])
+            return context, estimate_tokens(context)
+        for detail in self.MEMORY_DETAILS:
+            context = PromptBuilder.build_memory_context(memory_manager, items=items, detail=detail)
+            tokens = estimate_tokens(context)
+            if tokens <= budget:
+                return context, tokens
+        # 最简格式也放不下时，按相关度从高到低保留
+        kept, used = [], estimate_tokens("永久记忆:")
+        for mem_id, mem_data in items:
+            cost = estimate_tokens(PromptBuilder.build_memory_line(mem_id, mem_data, "none")) + 1
+            if used + cost > budget:
+                break
+            kept.append((mem_id, mem_data))
+            used += cost
+        context = PromptBuilder.build_memory_context(memory_manager, items=kept, detail="none")
+        return context, estimate_tokens(context)
+    
+    def pack(self, memory_manager, memory_items, chat_history, fixed_texts):
+        """fixed_texts为必须完整发送的部分（系统规则、偏好、用户输入等），返回 (记忆上下文, 按时间顺序选中的聊天记录)"""
+        budget = self.token_budget - sum(estimate_tokens(text) for text in fixed_texts)
+        turns = chat_history[-self.max_turns:] if self.max_turns else chat_history
+        recent, older = turns[-self.recent_turns:], turns[:-self.recent_turns]
+        # 一条记忆都放不下时仍会发送一行占位说明，先为它留出空间
+        reserve = estimate_tokens(PromptBuilder.build_memory_context(memory_manager, items=[]))
+        
+        chosen, used, complete = self._take_turns(recent, budget - reserve)
+        budget -= used
+        memory_context, used = self._pack_memory(memory_manager, memory_items, max(0, budget))
+        budget -= used
+        # 最近的几轮全部放下后，才用剩余空间补充更早的对话，保证历史连续
+        if complete and older:
+            chosen += self._take_turns(older, budget)[0]
+        return memory_context, chosen[::-1]
+    
+    def reply_tokens(self, chat_history):
+        """按最近几次回复的长度确定max_tokens：取最长回复的两倍再加上JSON格式和记忆操作的余量"""
+        recent = chat_history[-self.recent_turns:]
+        if not recent:
+            return self.max_reply_tokens
+        longest = max(estimate_tokens(turn['ai']) for turn in recent)
+        return max(self.min_reply_tokens, min(self.max_reply_tokens, longest * 2 + 256))
+
+class HistorySummarizer:
+    """滚动对话摘要：移出最近keep_turns轮的对话每积累batch_turns轮，就在后台事件循环中合并进持久化的摘要；
+    前台对话只读取已有的摘要，从不等待摘要生成"""
+    def __init__(self, config_manager, async_loop, summarize, keep_turns=8, batch_turns=4, max_fold_turns=20):
+        self.config_manager = config_manager
+        self.async_loop = async_loop
+        self.summarize = summarize # 协程函数 (已有摘要, 若干轮对话) -> 新摘要
+        self.keep_turns = max(1, keep_turns)
+        self.batch_turns = max(1, batch_turns)
+        self.max_fold_turns = max_fold_turns # 单次合并的轮数上限，积压较多时分批合并
+        self.state = config_manager.load_summary() or self.empty_state()
+        self._lock = threading.Lock()
+        self._running = False
+        self._latest = None # 合并进行期间到达的最新聊天记录
+        self._generation = 0 # 清空聊天记录后丢弃仍在进行的合并结果
+    
+    @staticmethod
+    def empty_state():
+        return {"text": "", "covered_until": "", "turns": 0}
+    
+    @property
+    def text(self):
+        return self.state["text"]
+    
+    def unsummarized(self, chat_history):
+        """尚未并入摘要的对话（按时间戳判断）"""
+        covered_until = self.state["covered_until"]
+        if not covered_until:
+            return chat_history
+        return [turn for turn in chat_history if turn.get('timestamp', '') > covered_until]
+    
+    def schedule(self, chat_history):
+        """每轮对话保存后调用；待合并的对话够一批时提交后台合并，已有合并在进行时只记下最新的聊天记录"""
+        history = list(chat_history)
+        with self._lock:
+            if self._running:
+                self._latest = history
+                return
+            pending = self.unsummarized(history[:-self.keep_turns])
+            if len(pending) < self.batch_turns:
+                return
+            self._running = True
+            generation = self._generation
+        self.async_loop.submit(self._fold(pending[:self.max_fold_turns], history, generation))
+    
+    async def _fold(self, turns, history, generation):
+        """后台合并一批对话并保存；失败时保留原摘要，下一轮对话后重试"""
+        start_time = time.perf_counter()
+        succeeded = False
+        try:
+            text = await self.summarize(self.state["text"], turns)
+            state = {
+                "text": text,
+                "covered_until": turns[-1].get('timestamp', ''),
+                "turns": self.state["turns"] + len(turns),
+                "updated": datetime.now().isoformat()
+            }
+            with self._lock:
+                succeeded = generation == self._generation
+                if succeeded:
+                    self.state = state
+            if succeeded:
+                self.config_manager.save_summary(state)
+                logger.info(f"已将 {len(turns)} 轮较早的对话并入摘要（累计 {state['turns']} 轮, {len(text)} 字, 用时 {time.perf_counter() - start_time:.1f}s）")
+        except Exception as e:
+            logger.warning(f"更新对话摘要失败，将在下一轮对话后重试: {e}")
+        with self._lock:
+            self._running = False
+            latest, self._latest = self._latest, None
+        # 期间有新对话或仍有积压时继续合并
+        if succeeded:
+            self.schedule(latest or history)
+    
+    def reset(self):
+        """清空聊天记录时同时清空摘要"""
+        with self._lock:
+            self._generation += 1
+            self._latest = None
+            self.state = self.empty_state()
+        self.config_manager.save_summary(self.state)
+    
+    def close(self):
+        """停止后续合并并丢弃仍在进行的合并结果，避免与新的摘要器同时写入摘要"""
+        with self._lock:
+            self._generation += 1
+            self._latest = None
+
+class StreamingResponseParser:
+    """流式JSON解析类，从逐块到达的JSON中增量提取顶层 response 字段"""
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, field="response"):
+        self.field = field
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escape = None
+        self.expect_key = False
+        self.after_colon = False
+        self.string_chars = []
+        self.last_key = None
+        self.capturing = False
+        self.done = False
+        self.pending_high = None
+
+    def feed(self, chunk):
+        """输入新的文本块，返回本次新解析出的 response 文本"""
+        self.buffer.append(chunk)
+        output = []
+        for ch in chunk:
+            if self.in_string:
+                self._feed_string_char(ch, output)
+                continue
+            if ch == '"':
+                self.in_string = True
+                self.string_chars = []
+                # 顶层 response 字段的字符串值开始
+                self.capturing = self.depth == 1 and self.after_colon and self.last_key == self.field and not self.done
+                self.after_colon = False
+            elif ch in '{[':
+                self.depth += 1
+                self.expect_key = ch == '{' and self.depth == 1
+                self.after_colon = False
+            elif ch in '}]':
+                self.depth -= 1
+                self.after_colon = False
+            elif ch == ',' and self.depth == 1:
+                self.expect_key = True
+                self.after_colon = False
+            elif ch == ':' and self.depth == 1:
+                self.after_colon = True
+            elif not ch.isspace():
+                self.after_colon = False
+        return "".join(output)
+
+    def _feed_string_char(self, ch, output):
+        """处理字符串内部的字符（含转义序列）"""
+        target = output if self.capturing else self.string_chars
+        if self.escape is not None:
+            if self.escape == "":
+                if ch == 'u':
+                    self.escape = "u"
+                    return
+                self.escape = None
+                self._emit(self.ESCAPES.get(ch, ch), target)
+                return
+            self.escape += ch
+            if len(self.escape) == 5:
+                hex_digits, self.escape = self.escape[1:], None
+                try:
+                    code = int(hex_digits, 16)
+                except ValueError:
+                    return
+                if 0xD800 <= code <= 0xDBFF:
+                    self.pending_high = code
+                    return
+                if 0xDC00 <= code <= 0xDFFF and self.pending_high is not None:
+                    code = 0x10000 + ((self.pending_high - 0xD800) << 10) + (code - 0xDC00)
+                    self.pending_high = None
+                self._emit(chr(code), target)
+            return
+        if ch == '\\':
+            self.escape = ""
+        elif ch == '"':
+            self.in_string = False
+            if self.capturing:
+                self.capturing = False
+                self.done = True
+            elif self.depth == 1 and self.expect_key:
+                self.last_key = "".join(self.string_chars)
+                self.expect_key = False
+        else:
+            self._emit(ch, target)
+
+    def _emit(self, text, target):
+        """输出解码后的字符，丢弃未配对的代理项"""
+        self.pending_high = None
+        target.append(text)
+
+    @property
+    def text(self):
+        """目前为止收到的完整原始文本"""
+        return "".join(self.buffer)
+
+class ConversationEngine:
+    """异步对话引擎：把一轮对话拆成可等待的阶段，互不依赖的阶段（图片分析、记忆检索、音色刷新）并发执行"""
+    def __init__(self, openai_key, api_gateway, siliconflow_key, file_processor, memory_manager, voice_manager=None,
+                 prompt_layout="messages", report_usage=True, packer=None, summary_model="gpt-4o", summary_max_chars=600):
+        self.openai_key = openai_key
+        self.api_gateway = api_gateway
+        self.siliconflow_key = siliconflow_key
+        self.file_processor = file_processor
+        self.memory_manager = memory_manager
+        self.voice_manager = voice_manager
+        self.prompt_layout = prompt_layout # messages: 分层的结构化消息；single: 旧版单条用户消息
+        self.report_usage = report_usage # 流式请求时让服务端在最后返回token用量
+        self.packer = packer or ContextPacker()
+        self.summarizer = None # HistorySummarizer，未启用滚动摘要时为None
+        self.summary_model = summary_model
+        self.summary_max_chars = summary_max_chars
+        self.voice_refresh = None # 最近一次启动的音色列表刷新任务，直到需要语音时才等待
+        self.voice_ready = None # 最近一次成功完成的刷新任务
+        self.voice_refreshed_at = 0.0
+    
+    @property
+    def chat_client(self):
+        """对话模型的异步客户端，在事件循环线程中首次使用时才创建"""
+        return client_registry.get_async_openai(self.openai_key, self.api_gateway)
+    
+    @property
+    def vision_client(self):
+        """图片分析的异步客户端"""
+        return client_registry.get_async_openai(self.siliconflow_key, SILICONFLOW_BASE_URL)
+    
+    def _voice_stage(self):
+        """返回音色列表刷新任务：首次调用时在后台启动刷新；上次刷新超过目录有效期后重新刷新，
+        期间继续返回上一次的结果，不让对话等待新的刷新"""
+        pending = self.voice_refresh is not None and not self.voice_refresh.done()
+        expired = time.monotonic() - self.voice_refreshed_at >= self.voice_manager.catalog_ttl_seconds
+        if not pending and (self.voice_ready is None or expired):
+            self.voice_refresh = asyncio.ensure_future(asyncio.to_thread(self.voice_manager.refresh_voices))
+            self.voice_refresh.add_done_callback(self._voices_refreshed)
+        return self.voice_ready or self.voice_refresh
+    
+    def _voices_refreshed(self, task):
+        """刷新成功后记录结果与完成时间；失败时保留上一次的结果，下次调用会重试"""
+        if not task.cancelled() and task.exception() is None:
+            self.voice_ready = task
+            self.voice_refreshed_at = time.monotonic()
+    
+    def close(self):
+        """重新初始化客户端时由旧引擎调用，停止其后台摘要"""
+        if self.summarizer:
+            self.summarizer.close()
+    
+    async def load_voices(self):
+        """等待音色列表刷新完成"""
+        if self.voice_manager:
+            return await self._voice_stage()
+        return []
+    
+    @staticmethod
+    def compose_input(user_input, image_paths, analyses):
+        """把图片分析结果按出现顺序拼接到用户输入之后"""
+        files_info = [f"图片分析结果({path}): {analysis}" for path, analysis in zip(image_paths, analyses)]
+        if files_info:
+            return user_input + "\n\n" + "\n".join(files_info)
+        return user_input
+    
+    async def run_turn(self, user_input, image_paths, preferences, chat_history, on_delta=None, streaming=True, metrics=None):
+        """执行一轮对话直到拿到模型回复，返回原始回复文本；各阶段耗时记录到metrics"""
+        metrics = metrics or TurnMetrics()
+        if self.voice_manager:
+            self._voice_stage()
+        
+        # 图片分析与记忆检索互不依赖，并发执行；记忆按用户原话检索
+        # 没有图片时不创建视觉模型的客户端
+        if image_paths:
+            image_stage = metrics.timed("image_analysis", self.file_processor.analyze_images_async(image_paths, self.vision_client))
+        else:
+            image_stage = asyncio.sleep(0, result=[])
+        analyses, memory_items = await asyncio.gather(
+            image_stage,
+            metrics.timed("memory_search", asyncio.to_thread(self.memory_manager.search_memory, user_input))
+        )
+        
+        with metrics.span("prompt_build"):
+            composed_input = self.compose_input(user_input, image_paths, analyses)
+            # 已并入摘要的对话由摘要代替，其余的在token预算内挑选
+            summary = self.summarizer.text if self.summarizer else ""
+            candidates = self.summarizer.unsummarized(chat_history) if self.summarizer else chat_history
+            memory_context, history = self.packer.pack(
+                self.memory_manager,
+                memory_items,
+                candidates,
+                [
+                    PromptBuilder.build_static_system_message(),
+                    PromptBuilder.build_cached_user_context(preferences),
+                    PromptBuilder.build_summary_context(summary),
+                    composed_input
+                ]
+            )
+            build = PromptBuilder.build_complete_prompt if self.prompt_layout == "single" else PromptBuilder.build_messages
+            prompt = build(
+                composed_input,
+                preferences,
+                self.memory_manager,
+                history,
+                memory_context=memory_context,
+                history_limit=None,
+                summary=summary
+            )
+            messages = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+        
+        logger.debug(f"正在调用OpenAI API... (记忆 {len(memory_items)} 条候选, 历史 {len(history)}/{len(chat_history)} 轮)")
+        with metrics.span("llm_request"):
+            return await self.complete(messages, on_delta, streaming, metrics, self.packer.reply_tokens(history))
+    
+    def record_usage(self, usage, metrics=None):
+        """记录token用量与提示词缓存命中情况"""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        prompt_tokens = usage.prompt_tokens or 0
+        if metrics:
+            metrics.record_usage(prompt_tokens, cached_tokens, usage.completion_tokens or 0)
+        if prompt_tokens:
+            logger.info(f"提示词缓存命中: {cached_tokens}/{prompt_tokens} tokens ({cached_tokens / prompt_tokens:.0%})")
+    
+    async def complete(self, messages, on_delta=None, streaming=True, metrics=None, max_tokens=2000):
+        """调用对话模型；流式模式下每解析出新的response文本就回调on_delta"""
+        request = {
+            "model": "gpt-4o",
+            "messages": messages,
+            "response_format": {"type": "json_object"},
+            "max_tokens": max_tokens
+        }
+        if not streaming:
+            response = await self.chat_client.chat.completions.create(**request)
+            self.record_usage(response.usage, metrics)
+            return response.choices[0].message.content
+        
+        parser = StreamingResponseParser()
+        start_time = time.perf_counter()
+        first_token_time = None
+        
+        if self.report_usage:
+            request["stream_options"] = {"include_usage": True}
+        try:
+            stream = await self.chat_client.chat.completions.create(**request, stream=True)
+        except openai.BadRequestError as e:
+            if "stream_options" not in request:
+                raise
+            # 部分网关不接受stream_options，本次会话内不再请求用量并重试
+            logger.warning(f"网关拒绝stream_options，已关闭用量统计: {e}")
+            self.report_usage = False
+            del request["stream_options"]
+            stream = await self.chat_client.chat.completions.create(**request, stream=True)
+        async for chunk in stream:
+            if chunk.usage:
+                self.record_usage(chunk.usage, metrics)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+                logger.info(f"首字延迟(TTFT): {first_token_time - start_time:.2f}s")
+                if metrics:
+                    metrics.record("ttft", (first_token_time - start_time) * 1000)
+            
+            new_text = parser.feed(delta)
+            if new_text and on_delta:
+                on_delta(new_text)
+        
+        logger.debug(f"流式回复完成，总耗时: {time.perf_counter() - start_time:.2f}s")
+        return parser.text
+    
+    async def summarize(self, summary, turns):
+        """把若干轮对话合并进已有摘要，返回新摘要"""
+        dialogue = "\n\n".join(f"用户: {turn['user']}\nAI: {turn['ai']}" for turn in turns)
+        messages = [
+            {"role": "system", "content": f"你负责维护一段对话摘要。把新的对话合并进已有摘要，保留用户的目标、已做的决定、提到的事实和未完成的事项，"
+                                          f"删去寒暄和重复内容，不超过{self.summary_max_chars}字，只输出摘要本身。"},
+            {"role": "user", "content": f"已有摘要:\n{summary or '暂无'}\n\n新的对话:\n{dialogue}"}
+        ]
+        response = await self.chat_client.chat.completions.create(
+            model=self.summary_model,
+            messages=messages,
+            max_tokens=self.summary_max_chars * 2
+        )
+        return response.choices[0].message.content.strip()
+    
+    async def speak(self, text, metrics=None):
+        """语音阶段：等待音色列表就绪后合成语音，返回语音文件路径"""
+        metrics = metrics or TurnMetrics()
+        await self.load_voices()
+        with metrics.span("tts_synthesis"):
+            return await asyncio.to_thread(self.voice_manager.text_to_speech, text)
 
 class AIChat:
     """AI聊天主类"""
-    def __init__(self):
-        self.config_manager = ConfigManager()
+    def __init__(self, base_dir=".", async_loop=None):
+        self.base_dir = base_dir # 存储、缓存与指标文件所在目录，同一进程中的多个会话各用一个目录
+        self.config_manager = ConfigManager(base_dir=base_dir)
         self.memory_manager = MemoryManager(self.config_manager)
         self.file_processor = None
         self.voice_manager = None
-        self.openai_client = None
-        self.chat_history = self.config_manager.load_chat_history()
+        self.engine = None
+        # 多个会话在同一进程中运行时共享一个事件循环（异步连接池只能在创建它的循环中使用）
+        self.async_loop = async_loop or AsyncLoopThread()
+        self.metrics = MetricsRecorder(os.path.join(base_dir, "metrics.jsonl"))
+        self.chat_history = self.config_manager.load_chat_history(limit=20) # 与上下文打包的 context_max_turns 默认值一致
         self.voice_enabled = False
+        self.streaming_enabled = True
+        startup_timer.mark("加载存储与记忆")
     
     def initialize_config(self):
         """初始化配置"""
@@ -475,33 +2557,92 @@ class AIChat:
     
     def setup_clients(self, config):
         """设置API客户端"""
-        self.file_processor = FileProcessor(config['siliconflow_key'])
-        self.voice_manager = VoiceManager(config['siliconflow_key'])
-        self.openai_client = OpenAI(
-            api_key=config['openai_key'],
-            base_url=config['openai_api_gateway']
+        self.streaming_enabled = config.get('streaming', True)
+        self.metrics.configure(
+            max_bytes=config.get('metrics_max_mb', 5) * 1024 * 1024,
+            window=config.get('metrics_window', 200)
+        )
+        client_registry.configure(
+            max_connections=config.get('http_max_connections', 20),
+            max_keepalive=config.get('http_max_keepalive', 10),
+            timeout=config.get('http_timeout', 60.0),
+            connect_timeout=config.get('http_connect_timeout', 10.0)
+        )
+        client_registry.prewarm([config['openai_api_gateway'], SILICONFLOW_BASE_URL], loop=self.async_loop.loop)
+        self.config_manager.configure_persistence(
+            fsync=config.get('persistence_fsync', "normal"),
+            delay=config.get('persistence_delay_ms', 200) / 1000
+        )
+        self.memory_manager.configure_retrieval(
+            top_k=config.get('memory_top_k', 8),
+            min_score=config.get('memory_min_score'),
+            embedder_spec=config.get('memory_embedder'),
+            min_results=config.get('memory_min_results', 3)
         )
+        # 重新初始化时关闭上一次创建的线程池和引擎，进行中的任务仍会完成
+        if self.file_processor:
+            self.file_processor.close()
+        if self.engine:
+            self.engine.close()
+        self.file_processor = FileProcessor(
+            config['siliconflow_key'],
+            max_side=config.get('image_max_side', 1568),
+            image_format=config.get('image_format', "JPEG"),
+            quality=config.get('image_quality', 85),
+            cache_max_bytes=config.get('vision_cache_max_mb', 50) * 1024 * 1024,
+            max_concurrency=config.get('vision_concurrency', 3),
+            base_dir=self.base_dir
+        )
+        self.voice_manager = VoiceManager(
+            config['siliconflow_key'],
+            cache_max_bytes=config.get('tts_cache_max_mb', 200) * 1024 * 1024,
+            catalog_ttl_seconds=config.get('voice_catalog_ttl_minutes', 60) * 60,
+            base_dir=self.base_dir
+        )
+        self.engine = ConversationEngine(
+            config['openai_key'],
+            config['openai_api_gateway'],
+            config['siliconflow_key'],
+            self.file_processor,
+            self.memory_manager,
+            self.voice_manager,
+            prompt_layout=config.get('prompt_layout', "messages"),
+            report_usage=config.get('report_usage', True),
+            packer=ContextPacker(
+                token_budget=config.get('context_token_budget', 3000),
+                recent_turns=config.get('context_recent_turns', 4),
+                max_turns=config.get('context_max_turns', 20),
+                min_reply_tokens=config.get('reply_min_tokens', 1024),
+                max_reply_tokens=config.get('reply_max_tokens', 2000)
+            ),
+            summary_model=config.get('summary_model', "gpt-4o"),
+            summary_max_chars=config.get('summary_max_chars', 600)
+        )
+        if config.get('summary_enabled', True):
+            # 较早的对话在后台合并为滚动摘要，不占用前台对话的时间
+            self.engine.summarizer = HistorySummarizer(
+                self.config_manager,
+                self.async_loop,
+                self.engine.summarize,
+                keep_turns=config.get('summary_keep_turns', 8),
+                batch_turns=config.get('summary_batch_turns', 4)
+            )
     
     def parse_user_input(self, user_input):
-        """解析用户输入，检查是否包含文件路径"""
+        """解析用户输入，返回其中包含的图片路径"""
         words = user_input.split()
-        files_info = []
-        text_input = user_input
+        image_paths = []
         
         for word in words:
             # 检查绝对路径和相对路径
             if os.path.exists(word):
                 if self.file_processor.is_image_file(word):
                     logger.info(f"检测到图片文件: {word}")
-                    image_analysis = self.file_processor.analyze_image(word)
-                    files_info.append(f"图片分析结果({word}): {image_analysis}")
+                    image_paths.append(word)
                 else:
                     logger.info(f"检测到非图片文件: {word}")
         
-        if files_info:
-            text_input = user_input + "\n\n" + "\n".join(files_info)
-        
-        return text_input
+        return image_paths
     
     def process_ai_response(self, ai_response_text):
         """处理AI的JSON回复"""
@@ -531,6 +2672,46 @@ class AIChat:
             logger.error(f"处理AI回复时出错: {e}")
             return ai_response_text
     
+    def chat_turn(self, user_input, preferences, on_delta=None, metrics=None):
+        """执行一轮对话：调用引擎拿到回复、执行记忆操作并保存聊天记录，返回要显示的回复"""
+        metrics = metrics or TurnMetrics()
+        # 图片分析、记忆检索、调用模型由异步引擎按阶段执行
+        ai_response_text = self.async_loop.run(self.engine.run_turn(
+            user_input,
+            self.parse_user_input(user_input),
+            preferences,
+            self.chat_history,
+            on_delta=on_delta,
+            streaming=self.streaming_enabled,
+            metrics=metrics
+        ))
+        
+        # 处理AI回复（记忆操作在完整JSON到达后才执行）
+        with metrics.span("memory_ops"):
+            display_response = self.process_ai_response(ai_response_text)
+        
+        # 保存聊天记录
+        turn = {
+            "user": user_input,
+            "ai": display_response,
+            "timestamp": datetime.now().isoformat()
+        }
+        self.chat_history.append(turn)
+        with metrics.span("persistence"):
+            self.config_manager.append_chat_history(turn, self.chat_history)
+        if self.engine.summarizer:
+            self.engine.summarizer.schedule(self.chat_history)
+        return display_response
+    
+    def print_stream_delta(self, state):
+        """生成流式输出回调：首段文本到达时打印前缀，之后逐段打印"""
+        def on_delta(new_text):
+            if not state["printed"]:
+                print("\nAI: ", end="", flush=True)
+                state["printed"] = True
+            print(new_text, end="", flush=True)
+        return on_delta
+    
     def show_menu(self):
         """显示菜单"""
         print("\n=== 菜单选项 ===")
@@ -558,7 +2739,9 @@ class AIChat:
     def clear_chat_history(self):
         """清空聊天记录"""
         self.chat_history = []
-        self.config_manager.save_chat_history(self.chat_history)
+        self.config_manager.clear_chat_history()
+        if self.engine and self.engine.summarizer:
+            self.engine.summarizer.reset()
         print("聊天记录已清空")
     
     def toggle_voice(self):
@@ -572,11 +2755,14 @@ class AIChat:
         try:
             # 初始化配置
             config = self.initialize_config()
+            startup_timer.skip() # 等待用户确认配置的时间不计入
             self.setup_clients(config)
+            startup_timer.mark("初始化客户端")
+            startup_timer.report()
             
             logger.info("程序初始化完成")
             print("\n欢迎使用AI聊天助手！")
-            print("您可以直接输入消息开始对话，或输入 '/menu' 查看菜单选项")
+            print("您可以直接输入消息开始对话，或输入 '/menu' 查看菜单选项，输入 '/stats' 查看各阶段耗时统计")
             print("支持在消息中包含图片路径，AI会自动分析图片内容")
             
             while True:
@@ -610,49 +2796,35 @@ class AIChat:
                             print("无效选项")
                         continue
                     
-                    # 解析用户输入（检查文件）
-                    processed_input = self.parse_user_input(user_input)
-                    
-                    # 构建提示词
-                    prompt = PromptBuilder.build_complete_prompt(
-                        processed_input, 
-                        config['preferences'], 
-                        self.memory_manager, 
-                        self.chat_history
-                    )
+                    if user_input == "/stats":
+                        print("\n=== 各阶段耗时（最近对话） ===")
+                        print(self.metrics.format_summary())
+                        continue
                     
-                    # 调用OpenAI API
-                    logger.debug("正在调用OpenAI API...")
-                    response = self.openai_client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[{"role": "user", "content": prompt}],
-                        response_format={"type": "json_object"},
-                        max_tokens=2000
+                    stream_state = {"printed": False}
+                    metrics = TurnMetrics()
+                    display_response = self.chat_turn(
+                        user_input,
+                        config['preferences'],
+                        on_delta=self.print_stream_delta(stream_state),
+                        metrics=metrics
                     )
                     
-                    ai_response_text = response.choices[0].message.content
-                    
-                    # 处理AI回复
-                    display_response = self.process_ai_response(ai_response_text)
-                    
-                    print(f"\nAI: {display_response}")
-                    
-                    # 保存聊天记录
-                    self.chat_history.append({
-                        "user": user_input,
-                        "ai": display_response,
-                        "timestamp": datetime.now().isoformat()
-                    })
-                    self.config_manager.save_chat_history(self.chat_history)
+                    if stream_state["printed"]:
+                        print()
+                    else:
+                        print(f"\nAI: {display_response}")
                     
                     # 语音输出
                     if self.voice_enabled and self.voice_manager:
                         logger.info("正在生成语音...")
-                        voice_file = self.voice_manager.text_to_speech(display_response)
+                        voice_file = self.async_loop.run(self.engine.speak(display_response, metrics))
                         if voice_file:
                             print(f"语音文件已生成: {voice_file}")
                             print(f"当前音色: {self.voice_manager.selected_voice}")
                     
+                    self.metrics.record_turn(metrics)
+                    
                 except KeyboardInterrupt:
                     print("\n\n程序被用户中断")
                     break
@@ -663,6 +2835,11 @@ class AIChat:
         except Exception as e:
             logger.error(f"程序运行出错: {e}")
             print(f"程序出现严重错误: {e}")
+        finally:
+            self.async_loop.stop()
+            client_registry.close()
+            self.metrics.close()
+            self.config_manager.close()
 
 def main():
     chat = AIChat()
@@ -1,21 +1,110 @@
+import asyncio
+import importlib
+import importlib.util
+import contextlib
 import logging
+import logging.handlers
 import json
+import math
 import os
 import base64
+import bisect
 import hashlib
+import heapq
+import itertools
+import re
+import sqlite3
+import sys
+import time
+import unicodedata
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-import requests
-from openai import OpenAI
-from PIL import Image
 import io
 import threading
 import tkinter
 from tkinter import filedialog
 
+# --- 冷启动计时与延迟导入 ---
+class StartupTimer:
+    """冷启动计时：按导入与初始化阶段记录耗时，设置环境变量PVENUS_STARTUP_TIMING=1或传入--startup-timing时输出报告"""
+    def __init__(self):
+        self.enabled = os.environ.get("PVENUS_STARTUP_TIMING") == "1" or "--startup-timing" in sys.argv
+        self.begin = time.perf_counter()
+        self.last = self.begin
+        self.phases = [] # [(阶段, 耗时ms)]
+        self.lazy_imports = [] # [(模块, 导入耗时ms, 距启动ms)]
+        self.reported = False
+
+    def mark(self, phase):
+        """记录从上一个标记到现在的阶段耗时"""
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self.last) * 1000))
+        self.last = now
+
+    def skip(self):
+        """跳过从上一个标记到现在的时间（如等待用户输入），不计入任何阶段"""
+        self.last = time.perf_counter()
+
+    def record_import(self, name, elapsed_ms):
+        """记录一次延迟导入"""
+        self.lazy_imports.append((name, elapsed_ms, (time.perf_counter() - self.begin) * 1000))
+
+    def as_dict(self):
+        """以字典形式返回计时结果，供基准测试使用"""
+        return {
+            "total_ms": sum(ms for _, ms in self.phases),
+            "phases": [{"phase": phase, "ms": ms} for phase, ms in self.phases],
+            "lazy_imports": [{"module": name, "ms": ms, "at_ms": at} for name, ms, at in self.lazy_imports]
+        }
+
+    def report(self):
+        """输出冷启动报告，只输出一次"""
+        if not self.enabled or self.reported:
+            return
+        self.reported = True
+        lines = ["冷启动耗时报告:"]
+        for phase, ms in self.phases:
+            lines.append(f"  {phase}: {ms:.1f} ms")
+        lines.append(f"  合计: {sum(ms for _, ms in self.phases):.1f} ms")
+        for name, ms, at in self.lazy_imports:
+            lines.append(f"  延迟导入 {name}: {ms:.1f} ms (启动后 {at:.0f} ms)")
+        print("\n".join(lines), file=sys.stderr)
+
+startup_timer = StartupTimer()
+
+class LazyModule:
+    """延迟导入的模块代理：首次访问属性时才真正导入"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        """导入并返回真实模块"""
+        if self._module is None:
+            start = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            startup_timer.record_import(self._name, (time.perf_counter() - start) * 1000)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+# 重量级依赖推迟到功能首次使用时再导入
+requests = LazyModule("requests")
+openai = LazyModule("openai")
+Image = LazyModule("PIL.Image")
+ImageOps = LazyModule("PIL.ImageOps")
+pygame = LazyModule("pygame")
+pydub = LazyModule("pydub")
+np = LazyModule("numpy")
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None # 未安装NumPy时记忆检索退化为全量注入
+
 import customtkinter as ctk
-import pygame
-from pydub import AudioSegment
+startup_timer.mark("导入customtkinter")
 
 # --- 外观设置 ---
 ctk.set_appearance_mode("Dark")
@@ -23,20 +112,62 @@ ctk.set_default_color_theme("blue")
 
 # --- 日志设置 ---
 class GuiLogger(logging.Handler):
-    """自定义日志处理器，将日志消息重定向到GUI文本框"""
-    def __init__(self, textbox):
+    """自定义日志处理器，将日志消息批量输出到GUI文本框
+
+    日志先写入环形缓冲区，由Tk主线程每帧最多取出一次并一次性插入；
+    文本框只保留最近max_lines行，缓冲区溢出时丢弃最早的日志并提示丢弃条数。
+    """
+    FLUSH_MS = 50 # 主线程取出日志的间隔(毫秒)
+
+    def __init__(self, textbox, max_lines=1000, buffer_size=500):
         super().__init__()
         self.textbox = textbox
+        self.max_lines = max_lines
+        self.buffer = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.buffer_lock = threading.Lock()
         self.textbox.configure(state='disabled')
+        self.textbox.after(self.FLUSH_MS, self.flush_to_textbox)
 
     def emit(self, record):
-        msg = self.format(record)
-        def append_msg():
+        try:
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self.buffer_lock:
+            if len(self.buffer) == self.buffer.maxlen: self.dropped += 1
+            self.buffer.append(msg)
+
+    def flush_to_textbox(self):
+        """在Tk主线程中取出缓冲区内的全部日志，一次性插入并裁剪多余的行"""
+        with self.buffer_lock:
+            lines, dropped = list(self.buffer), self.dropped
+            self.buffer.clear()
+            self.dropped = 0
+        if lines:
+            if dropped: lines.insert(0, f"... 日志过多，已省略 {dropped} 条 ...")
             self.textbox.configure(state='normal')
-            self.textbox.insert(tkinter.END, msg + "\n")
+            self.textbox.insert(tkinter.END, "\n".join(lines) + "\n")
+            excess = int(self.textbox.index("end-1c").split(".")[0]) - 1 - self.max_lines
+            if excess > 0: self.textbox.delete("1.0", f"{excess + 1}.0")
             self.textbox.see(tkinter.END)
             self.textbox.configure(state='disabled')
-        self.textbox.after(0, append_msg)
+        self.textbox.after(self.FLUSH_MS, self.flush_to_textbox)
+
+class LazyJson:
+    """延迟序列化的日志参数：只有日志真正被某个处理器输出时才执行json.dumps"""
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, ensure_ascii=False, indent=2)
+
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+def sync_logger_level():
+    """让logger的级别等于各处理器中最低的级别，没有处理器需要的日志在调用处就被跳过"""
+    logger.setLevel(min((handler.level for handler in logger.handlers), default=logging.WARNING))
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -45,27 +176,56 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 # 文件日志处理器
 if not os.path.exists('logs'): os.makedirs('logs')
 file_handler = logging.FileHandler("logs/app.log", encoding="utf-8")
-file_handler.setLevel(logging.DEBUG)
+file_handler.setLevel(logging.INFO) # 请求/响应的完整内容只在DEBUG级别记录，需要时通过 file_log_level 开启
 file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
+startup_timer.mark("日志初始化")
 
 
 # --- 核心逻辑类 (从CLI版本迁移并适配) ---
 
-class ConfigManager:
-    """配置管理类"""
-    def __init__(self):
-        self.config_dir = "data"
-        self.config_file = os.path.join(self.config_dir, "config.json")
-        self.memory_file = os.path.join(self.config_dir, "memory.json")
-        self.chat_history_file = os.path.join(self.config_dir, "chat_history.json")
-        os.makedirs(self.config_dir, exist_ok=True)
+class JsonStorage:
+    """JSON文件存储（旧版格式）"""
+    def __init__(self, base_dir="data", history_limit=20):
+        self.history_limit = history_limit
+        self.config_file = os.path.join(base_dir, "config.json")
+        self.memory_file = os.path.join(base_dir, "memory.json")
+        self.chat_history_file = os.path.join(base_dir, "chat_history.json")
+        self.memory_journal_file = os.path.join(base_dir, "memory.journal")
+        self.summary_file = os.path.join(base_dir, "chat_summary.json")
+        self.journal_compact_threshold = 200
+        self._journal_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._journal_count = 0
+        self._snapshot_generation = 0
+        self._compacting = False
+        self.fsync = "normal"
+
+    def set_fsync(self, policy):
+        """always: 每次写入都落盘（含目录项）；normal: 快照文件落盘，日志追加交给系统；off: 全部交给系统"""
+        self.fsync = policy
+
+    def _write_json_atomic(self, path, data):
+        """先写临时文件再原子替换，避免写入中途崩溃损坏原文件"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            if self.fsync != "off":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if self.fsync == "always" and hasattr(os, "O_DIRECTORY"):
+            # 同步目录项，保证替换本身在断电后可见
+            dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
 
     def save_config(self, config):
         """保存配置到本地文件"""
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(config, f, ensure_ascii=False, indent=2)
+            self._write_json_atomic(self.config_file, config)
             logger.debug("配置已保存到本地")
         except Exception as e:
             logger.error(f"保存配置失败: {e}")
@@ -81,49 +241,1204 @@ class ConfigManager:
         return None
 
     def save_memory(self, memory):
-        """保存永久记忆"""
+        """保存永久记忆（完整快照，并清空日志）"""
         try:
-            with open(self.memory_file, 'w', encoding='utf-8') as f:
-                json.dump(memory, f, ensure_ascii=False, indent=2)
+            with self._snapshot_lock, self._journal_lock:
+                self._snapshot_generation += 1
+                self._write_json_atomic(self.memory_file, memory)
+                for path in (self.memory_journal_file, f"{self.memory_journal_file}.compacting"):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._journal_count = 0
             logger.debug("记忆已保存")
         except Exception as e:
             logger.error(f"保存记忆失败: {e}")
 
+    def append_memory_journal(self, record, memory):
+        """向记忆日志追加一条操作记录"""
+        self.append_memory_records([record], memory)
+
+    def append_memory_records(self, records, memory):
+        """向记忆日志追加一批操作记录（一次写入），达到阈值时在后台压缩为快照"""
+        try:
+            lines = "".join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n" for record in records)
+            with self._journal_lock:
+                with open(self.memory_journal_file, 'a', encoding='utf-8') as f:
+                    f.write(lines)
+                    if self.fsync == "always":
+                        f.flush()
+                        os.fsync(f.fileno())
+                self._journal_count += len(records)
+                if self._journal_count >= self.journal_compact_threshold and not self._compacting:
+                    self._start_compaction(memory)
+        except Exception as e:
+            logger.error(f"写入记忆日志失败: {e}")
+
+    def _start_compaction(self, memory):
+        """轮换日志文件并启动后台压缩（调用方需持有日志锁）"""
+        compacting_file = f"{self.memory_journal_file}.compacting"
+        if os.path.exists(compacting_file):
+            # 上次压缩未完成，先把残留记录并回当前日志之前
+            with open(compacting_file, 'r', encoding='utf-8') as f:
+                pending = f.read()
+            with open(self.memory_journal_file, 'r', encoding='utf-8') as f:
+                current = f.read()
+            with open(compacting_file, 'w', encoding='utf-8') as f:
+                f.write(pending + current)
+            os.remove(self.memory_journal_file)
+        else:
+            os.replace(self.memory_journal_file, compacting_file)
+        # 快照在持锁时复制，之后的操作写入新日志；记忆字典可能正被其他线程修改，先整体复制再逐条复制
+        snapshot = {mem_id: dict(mem_data) for mem_id, mem_data in dict(memory).items()}
+        generation = self._snapshot_generation
+        self._journal_count = 0
+        self._compacting = True
+        thread = threading.Thread(target=self._compact_memory, args=(snapshot, generation, compacting_file))
+        thread.daemon = True
+        thread.start()
+
+    def _compact_memory(self, snapshot, generation, compacting_file):
+        """后台线程：写入新快照并删除已合并的日志"""
+        try:
+            with self._snapshot_lock:
+                # 期间若已有完整保存，则这份快照已过时
+                if generation == self._snapshot_generation:
+                    self._write_json_atomic(self.memory_file, snapshot)
+                    if os.path.exists(compacting_file):
+                        os.remove(compacting_file)
+            logger.debug(f"记忆日志已压缩，共 {len(snapshot)} 条记忆")
+        except Exception as e:
+            logger.error(f"压缩记忆日志失败: {e}")
+        finally:
+            self._compacting = False
+
+    def _replay_memory_journal(self, memory, path):
+        """将日志中的操作记录重放到记忆字典上，返回记录条数"""
+        count = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        if lines and not lines[-1].endswith("\n"):
+            # 崩溃时可能残留半行记录，补上换行避免与后续记录粘连
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write("\n")
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("op") == "put":
+                memory[record["id"]] = record["data"]
+            elif record.get("op") == "del":
+                memory.pop(record["id"], None)
+            count += 1
+        return count
+
     def load_memory(self):
-        """加载永久记忆"""
+        """加载永久记忆（快照 + 日志重放）"""
+        memory = {}
         try:
             if os.path.exists(self.memory_file):
                 with open(self.memory_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                    memory = json.load(f)
+            count = 0
+            for path in (f"{self.memory_journal_file}.compacting", self.memory_journal_file):
+                if os.path.exists(path):
+                    count += self._replay_memory_journal(memory, path)
+            with self._journal_lock:
+                self._journal_count = count
         except Exception as e:
             logger.error(f"加载记忆失败: {e}")
-        return {}
+        return memory
 
     def save_chat_history(self, history):
         """保存聊天记录"""
         try:
-            recent_history = history[-20:] if len(history) > 20 else history
-            with open(self.chat_history_file, 'w', encoding='utf-8') as f:
-                json.dump(recent_history, f, ensure_ascii=False, indent=2)
+            # 只保存最新的若干条记录
+            recent_history = history[-self.history_limit:] if len(history) > self.history_limit else history
+            self._write_json_atomic(self.chat_history_file, recent_history)
             logger.debug("聊天记录已保存")
         except Exception as e:
             logger.error(f"保存聊天记录失败: {e}")
 
-    def load_chat_history(self):
+    def append_chat_history(self, turn, history):
+        """追加一轮对话（JSON文件只能整体重写）"""
+        self.save_chat_history(history)
+
+    def append_chat_turns(self, turns, history):
+        """追加多轮对话，只需按最新的聊天记录重写一次"""
+        self.save_chat_history(history)
+
+    def clear_chat_history(self):
+        """清空聊天记录"""
+        self.save_chat_history([])
+
+    def load_chat_history(self, limit=None):
         """加载聊天记录"""
         try:
             if os.path.exists(self.chat_history_file):
                 with open(self.chat_history_file, 'r', encoding='utf-8') as f:
+                    history = json.load(f)
+                return history[-limit:] if limit else history
+        except Exception as e:
+            logger.error(f"加载聊天记录失败: {e}")
+        return []
+
+    def load_chat_history_range(self, start_time=None, end_time=None, session_id=None, before_id=None, limit=None):
+        """按时间范围读取聊天记录（JSON文件只保留最近的记录）"""
+        history = [
+            chat for chat in self.load_chat_history()
+            if (start_time is None or chat.get('timestamp', '') >= start_time)
+            and (end_time is None or chat.get('timestamp', '') < end_time)
+            and (session_id is None or chat.get('session_id') == session_id)
+        ]
+        return history[-limit:] if limit else history
+
+    def save_summary(self, summary):
+        """保存滚动对话摘要"""
+        try:
+            self._write_json_atomic(self.summary_file, summary)
+        except Exception as e:
+            logger.error(f"保存对话摘要失败: {e}")
+
+    def load_summary(self):
+        """加载滚动对话摘要"""
+        try:
+            if os.path.exists(self.summary_file):
+                with open(self.summary_file, 'r', encoding='utf-8') as f:
                     return json.load(f)
+        except Exception as e:
+            logger.error(f"加载对话摘要失败: {e}")
+        return None
+
+class SQLiteStorage:
+    """SQLite存储引擎：WAL模式，保存配置、记忆与完整聊天记录"""
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS memory (
+    id INTEGER PRIMARY KEY,
+    content TEXT NOT NULL,
+    created_time TEXT NOT NULL,
+    last_modified TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    user TEXT NOT NULL,
+    ai TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chat_history_timestamp ON chat_history(timestamp);
+CREATE INDEX IF NOT EXISTS idx_chat_history_session ON chat_history(session_id, id);
+"""
+
+    def __init__(self, db_path, session_id, legacy=None):
+        self.db_path = db_path
+        self.session_id = session_id
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        if legacy is not None:
+            try:
+                self._migrate_from_json(legacy)
+            except Exception:
+                self.conn.close()
+                raise
+
+    def set_fsync(self, policy):
+        """always/normal/off 分别对应 SQLite 的 synchronous=FULL/NORMAL/OFF"""
+        synchronous = {"always": "FULL", "normal": "NORMAL", "off": "OFF"}.get(policy, "NORMAL")
+        with self._lock:
+            self.conn.execute(f"PRAGMA synchronous={synchronous}")
+
+    def _get_kv(self, key):
+        """读取键值表"""
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["value"]) if row else None
+
+    def _set_kv(self, key, value):
+        """写入键值表"""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False))
+            )
+
+    def _migrate_from_json(self, legacy):
+        """一次性从旧版JSON文件迁移数据；全部数据与迁移标记在同一个事务中写入，
+        失败时整体回滚并抛出异常，JSON文件保持不变，下次启动重新迁移"""
+        if self._get_kv("migrated_from_json"):
+            return
+        config = legacy.load_config()
+        memory = legacy.load_memory()
+        history = legacy.load_chat_history()
+        with self._lock, self.conn:
+            kv_sql = "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)"
+            if config:
+                self.conn.execute(kv_sql, ("config", json.dumps(config, ensure_ascii=False)))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO memory (id, content, created_time, last_modified) VALUES (?, ?, ?, ?)",
+                [(int(mem_id), data['content'], data['created_time'], data['last_modified'])
+                 for mem_id, data in memory.items()]
+            )
+            self.conn.executemany(
+                "INSERT INTO chat_history (session_id, user, ai, timestamp) VALUES (?, ?, ?, ?)",
+                [(chat.get('session_id', 'legacy'), chat['user'], chat['ai'], chat.get('timestamp', ''))
+                 for chat in history]
+            )
+            self.conn.execute(kv_sql, ("migrated_from_json", json.dumps(datetime.now().isoformat())))
+        if config or memory or history:
+            logger.info(f"已从JSON文件迁移数据: {len(memory)} 条记忆, {len(history)} 条聊天记录")
+
+    def save_config(self, config):
+        """保存配置"""
+        try:
+            self._set_kv("config", config)
+            logger.debug("配置已保存到本地")
+        except Exception as e:
+            logger.error(f"保存配置失败: {e}")
+
+    def load_config(self):
+        """加载配置"""
+        try:
+            return self._get_kv("config")
+        except Exception as e:
+            logger.error(f"加载配置失败: {e}")
+        return None
+
+    def save_memory(self, memory):
+        """整体替换永久记忆"""
+        try:
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM memory")
+                self.conn.executemany(
+                    "INSERT INTO memory (id, content, created_time, last_modified) VALUES (?, ?, ?, ?)",
+                    [(int(mem_id), data['content'], data['created_time'], data['last_modified'])
+                     for mem_id, data in memory.items()]
+                )
+            logger.debug("记忆已保存")
+        except Exception as e:
+            logger.error(f"保存记忆失败: {e}")
+
+    def append_memory_journal(self, record, memory):
+        """按操作记录增量更新单条记忆"""
+        self.append_memory_records([record], memory)
+
+    def append_memory_records(self, records, memory):
+        """在一个事务中按顺序应用一批操作记录"""
+        try:
+            with self._lock, self.conn:
+                for record in records:
+                    if record["op"] == "put":
+                        data = record["data"]
+                        self.conn.execute(
+                            "INSERT OR REPLACE INTO memory (id, content, created_time, last_modified) VALUES (?, ?, ?, ?)",
+                            (int(record["id"]), data['content'], data['created_time'], data['last_modified'])
+                        )
+                    elif record["op"] == "del":
+                        self.conn.execute("DELETE FROM memory WHERE id = ?", (int(record["id"]),))
+        except Exception as e:
+            logger.error(f"写入记忆失败: {e}")
+
+    def load_memory(self):
+        """加载永久记忆"""
+        try:
+            with self._lock:
+                rows = self.conn.execute("SELECT * FROM memory ORDER BY id").fetchall()
+            return {
+                str(row["id"]): {
+                    "content": row["content"],
+                    "created_time": row["created_time"],
+                    "last_modified": row["last_modified"]
+                }
+                for row in rows
+            }
+        except Exception as e:
+            logger.error(f"加载记忆失败: {e}")
+        return {}
+
+    def save_chat_history(self, history):
+        """整体替换聊天记录"""
+        try:
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM chat_history")
+                self.conn.executemany(
+                    "INSERT INTO chat_history (session_id, user, ai, timestamp) VALUES (?, ?, ?, ?)",
+                    [(chat.get('session_id', self.session_id), chat['user'], chat['ai'], chat['timestamp'])
+                     for chat in history]
+                )
+            logger.debug("聊天记录已保存")
+        except Exception as e:
+            logger.error(f"保存聊天记录失败: {e}")
+
+    def append_chat_history(self, turn, history):
+        """追加一轮对话，O(1)写入，返回新记录的ID"""
+        ids = self.append_chat_turns([turn], history)
+        return ids[0] if ids else None
+
+    def append_chat_turns(self, turns, history):
+        """在一个事务中追加多轮对话，返回新记录的ID列表；
+        可能在后台写入线程中执行，不修改调用方仍持有的对话字典"""
+        try:
+            with self._lock, self.conn:
+                ids = [
+                    self.conn.execute(
+                        "INSERT INTO chat_history (session_id, user, ai, timestamp) VALUES (?, ?, ?, ?)",
+                        (turn.get('session_id', self.session_id), turn['user'], turn['ai'], turn['timestamp'])
+                    ).lastrowid
+                    for turn in turns
+                ]
+            logger.debug("聊天记录已保存")
+            return ids
+        except Exception as e:
+            logger.error(f"保存聊天记录失败: {e}")
+        return []
+
+    def clear_chat_history(self):
+        """清空聊天记录"""
+        self.save_chat_history([])
+
+    def load_chat_history(self, limit=None):
+        """加载最近的聊天记录（按时间正序）"""
+        return self.load_chat_history_range(limit=limit)
+
+    def load_chat_history_range(self, start_time=None, end_time=None, session_id=None, before_id=None, limit=None):
+        """按时间范围、会话或ID游标读取聊天记录（按时间正序），走索引查询"""
+        conditions, params = [], []
+        if start_time is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start_time)
+        if end_time is not None:
+            conditions.append("timestamp < ?")
+            params.append(end_time)
+        if session_id is not None:
+            conditions.append("session_id = ?")
+            params.append(session_id)
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        sql = "SELECT * FROM chat_history"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY id DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        try:
+            with self._lock:
+                rows = self.conn.execute(sql, params).fetchall()
+            return [dict(row) for row in reversed(rows)]
         except Exception as e:
             logger.error(f"加载聊天记录失败: {e}")
         return []
 
+    def save_summary(self, summary):
+        """保存滚动对话摘要"""
+        try:
+            self._set_kv("chat_summary", summary)
+        except Exception as e:
+            logger.error(f"保存对话摘要失败: {e}")
+
+    def load_summary(self):
+        """加载滚动对话摘要"""
+        try:
+            return self._get_kv("chat_summary")
+        except Exception as e:
+            logger.error(f"加载对话摘要失败: {e}")
+        return None
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self.conn.close()
+
+class WriteBehindWriter:
+    """后台持久化线程：调用方只登记改动并立即返回；等待delay秒收集同一批改动，
+    配置和摘要只写最新的一份，记忆操作和新增的聊天记录各合并为一次写入"""
+    def __init__(self, storage, delay=0.2):
+        self.storage = storage
+        self.delay = delay
+        self._cond = threading.Condition()
+        self._batch = {}
+        self._writing = False
+        self._urgent = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self):
+        return bool(self._batch) or self._writing
+
+    def mark(self, key, value):
+        """登记最新状态，同一批次内后登记的覆盖先登记的"""
+        with self._cond:
+            self._batch[key] = value
+            self._cond.notify_all()
+
+    def append(self, key, item, state=None):
+        """登记一条按顺序写入的改动；state为写入时需要的最新完整状态"""
+        with self._cond:
+            self._batch.setdefault(key, []).append(item)
+            if state is not None:
+                self._batch[f"{key}:state"] = state
+            self._cond.notify_all()
+
+    def discard(self, key):
+        """丢弃尚未写入的改动（例如被整体保存或清空取代）"""
+        with self._cond:
+            self._batch.pop(key, None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._batch or self._stopped)
+                if not self._batch:
+                    return
+                # 合并窗口：期间的改动并入同一批，flush或关闭时立即写入
+                self._cond.wait_for(lambda: self._urgent or self._stopped, self.delay)
+                batch, self._batch = self._batch, {}
+                self._urgent = False
+                self._writing = True
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f"后台写入失败: {e}")
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def _write(self, batch):
+        """按依赖顺序写入一批改动"""
+        if "config" in batch:
+            self.storage.save_config(batch["config"])
+        if "memory_records" in batch:
+            self.storage.append_memory_records(batch["memory_records"], batch["memory_records:state"])
+        if "clear_chat_history" in batch:
+            self.storage.clear_chat_history()
+        if "chat_turns" in batch:
+            self.storage.append_chat_turns(batch["chat_turns"], batch["chat_turns:state"])
+        if "summary" in batch:
+            self.storage.save_summary(batch["summary"])
+
+    def flush(self, timeout=None):
+        """立即写入已登记的改动并等待完成，返回是否在超时前完成"""
+        with self._cond:
+            if self.pending:
+                self._urgent = True
+                self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self.pending, timeout)
+
+    def stop(self, timeout=10):
+        """写完剩余的改动后结束线程"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("后台写入未能在关闭前完成")
+
+class ConfigManager:
+    """配置管理类，按配置选择存储后端（sqlite 或 json）；默认由后台线程合并写入，不阻塞调用线程"""
+    def __init__(self, backend=None, base_dir="data", history_limit=20, write_behind=True):
+        # 默认使用SQLite；JSON后端（含记忆日志与后台压缩）需通过 PVENUS_STORAGE=json 显式选择
+        backend = backend or os.environ.get("PVENUS_STORAGE", "sqlite")
+        os.makedirs(base_dir, exist_ok=True)
+        self.session_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        json_storage = JsonStorage(base_dir, history_limit)
+        if backend == "json":
+            self.storage = json_storage
+        else:
+            try:
+                self.storage = SQLiteStorage(os.path.join(base_dir, "pvenus.db"), self.session_id, legacy=json_storage)
+            except Exception as e:
+                # 数据库无法打开或迁移失败时，本次运行继续以JSON文件为准
+                logger.error(f"初始化SQLite存储失败，本次使用JSON文件存储: {e}")
+                self.storage = json_storage
+                backend = "json"
+        self.writer = WriteBehindWriter(self.storage) if write_behind else None
+        self._config = None # 最近保存的配置，后台写入期间直接从内存返回
+        logger.debug(f"存储后端: {backend}, 后台写入: {'开启' if self.writer else '关闭'}")
+
+    def configure_persistence(self, fsync=None, delay=None):
+        """设置落盘策略(always/normal/off)与后台写入的合并窗口(秒)"""
+        if fsync is not None:
+            self.storage.set_fsync(fsync)
+        if delay is not None and self.writer:
+            self.writer.delay = delay
+
+    def flush(self, timeout=None):
+        """等待已登记的改动全部写入"""
+        return self.writer.flush(timeout) if self.writer else True
+
+    def save_config(self, config):
+        """保存配置"""
+        self._config = config
+        if self.writer:
+            self.writer.mark("config", config)
+        else:
+            self.storage.save_config(config)
+
+    def load_config(self):
+        """加载配置"""
+        if self._config is None:
+            self._config = self.storage.load_config()
+        return self._config
+
+    def append_memory_journal(self, record, memory):
+        """记录一次记忆操作"""
+        if self.writer:
+            # 记录中的数据可能在写入前被再次修改，登记时复制一份
+            if "data" in record:
+                record = {**record, "data": dict(record["data"])}
+            self.writer.append("memory_records", record, memory)
+        else:
+            self.storage.append_memory_journal(record, memory)
+
+    def load_memory(self):
+        """加载永久记忆"""
+        self.flush()
+        return self.storage.load_memory()
+
+    def append_chat_history(self, turn, history):
+        """追加一轮对话；会话ID在调用线程中写入，入队之后不再修改对话字典。
+        后台写入时内存中的对话不带数据库ID，翻页所需的ID从存储中读取"""
+        turn['session_id'] = self.session_id
+        if self.writer:
+            self.writer.append("chat_turns", turn, history)
+        else:
+            turn_id = self.storage.append_chat_history(turn, history)
+            if turn_id is not None:
+                turn['id'] = turn_id
+
+    def clear_chat_history(self):
+        """清空聊天记录"""
+        if self.writer:
+            self.writer.discard("chat_turns")
+            self.writer.mark("clear_chat_history", True)
+        else:
+            self.storage.clear_chat_history()
+
+    def load_chat_history(self, limit=None):
+        """加载最近的聊天记录"""
+        self.flush()
+        return self.storage.load_chat_history(limit)
+
+    def load_chat_history_range(self, start_time=None, end_time=None, session_id=None, before_id=None, limit=None):
+        """按时间范围、会话或ID游标读取聊天记录"""
+        self.flush()
+        return self.storage.load_chat_history_range(start_time, end_time, session_id, before_id, limit)
+
+    def save_summary(self, summary):
+        """保存滚动对话摘要"""
+        if self.writer:
+            self.writer.mark("summary", summary)
+        else:
+            self.storage.save_summary(summary)
+
+    def load_summary(self):
+        """加载滚动对话摘要"""
+        self.flush()
+        return self.storage.load_summary()
+
+    def close(self):
+        """写完尚未落盘的改动后关闭存储后端"""
+        if self.writer:
+            self.writer.stop()
+        if hasattr(self.storage, "close"):
+            self.storage.close()
+
+class DiskLRUCache:
+    """内容寻址的磁盘缓存，按最近使用顺序(LRU)淘汰并限制总大小"""
+    def __init__(self, directory, max_bytes, suffix=""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.total_bytes = 0
+        self.reclaimed_bytes = 0 # 累计淘汰释放的字节数
+        self._entries = OrderedDict() # key -> 文件大小，按最近使用从旧到新排列
+        self._pinned = {} # 正在使用、不可淘汰的条目 -> 固定次数（同一文件可能同时排队多次）
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """扫描缓存目录，按修改时间恢复LRU顺序"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(self.suffix) and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                key = entry.name[:len(entry.name) - len(self.suffix)] if self.suffix else entry.name
+                entries.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.total_bytes += size
+
+    def _path(self, key):
+        """缓存键对应的文件路径"""
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def get_path(self, key):
+        """命中时返回缓存文件路径并刷新其使用时间，未命中返回None"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            path = self._path(key)
+            try:
+                os.utime(path)
+            except OSError:
+                # 文件已被外部删除
+                self.total_bytes -= self._entries.pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return path
+
+    def get_bytes(self, key):
+        """读取缓存内容，未命中返回None"""
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        """写入缓存（临时文件+原子替换），超出容量时淘汰最久未使用的条目"""
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._evict()
+        return path
+
+    def put_file(self, key, src_path):
+        """将已写好的文件移入缓存（原子替换），超出容量时淘汰最久未使用的条目"""
+        path = self._path(key)
+        os.replace(src_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self.total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+        return path
+
+    def pin(self, key):
+        """固定条目，在取消相同次数的固定前不会被淘汰"""
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def unpin(self, key=None):
+        """取消一次固定，不传key时取消全部"""
+        with self._lock:
+            if key is None:
+                self._pinned.clear()
+            elif self._pinned.get(key, 0) > 1:
+                self._pinned[key] -= 1
+            else:
+                self._pinned.pop(key, None)
+
+    def _remove_entry(self, key):
+        """删除一个条目及其文件（调用方需持有锁）"""
+        size = self._entries.pop(key)
+        self.total_bytes -= size
+        self.reclaimed_bytes += size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        """淘汰最久未使用的条目直到总大小不超过上限（调用方需持有锁），跳过固定条目和最新条目"""
+        for key in list(self._entries)[:-1]:
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key not in self._pinned:
+                self._remove_entry(key)
+
+class AudioStore(DiskLRUCache):
+    """语音文件存储：在LRU容量上限之外增加存活时间(TTL)，并在后台定期清理"""
+    def __init__(self, directory, max_bytes, ttl_seconds=7 * 24 * 3600, cleanup_interval=600):
+        super().__init__(directory, max_bytes)
+        self.ttl_seconds = ttl_seconds
+        self.cleanup_interval = cleanup_interval
+        self._stop_event = threading.Event()
+        self._cleanup_thread = None
+
+    def start_cleanup(self):
+        """启动后台清理线程（启动时先清理一次）"""
+        if self._cleanup_thread is not None: return
+        self._cleanup_thread = threading.Thread(target=self._cleanup_loop, name="audio-cleanup", daemon=True)
+        self._cleanup_thread.start()
+
+    def stop_cleanup(self):
+        """停止后台清理线程"""
+        self._stop_event.set()
+
+    def _cleanup_loop(self):
+        while True:
+            try:
+                self.cleanup()
+            except Exception as e:
+                logger.error(f"清理语音文件失败: {e}")
+            if self._stop_event.wait(self.cleanup_interval): return
+
+    def cleanup(self):
+        """删除过期、超出容量的语音文件以及残留的临时文件，返回本次释放的字节数"""
+        now = time.time()
+        with self._lock:
+            reclaimed_before = self.reclaimed_bytes
+            removed_count = len(self._entries)
+            for key in list(self._entries):
+                if key in self._pinned: continue
+                try:
+                    expired = now - os.path.getmtime(self._path(key)) > self.ttl_seconds
+                except OSError:
+                    expired = True
+                if expired: self._remove_entry(key)
+            self._evict()
+            removed_count -= len(self._entries)
+            reclaimed = self.reclaimed_bytes - reclaimed_before
+        # 崩溃或中断遗留的临时文件
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp") and now - entry.stat().st_mtime > 3600:
+                try:
+                    reclaimed += entry.stat().st_size
+                    os.remove(entry.path)
+                    removed_count += 1
+                except OSError:
+                    pass
+        if removed_count:
+            logger.info(f"语音文件清理完成: 删除 {removed_count} 个文件，释放 {reclaimed / 1024 / 1024:.1f} MB，"
+                        f"当前占用 {self.total_bytes / 1024 / 1024:.1f} MB")
+        return reclaimed
+
+SILICONFLOW_BASE_URL = os.environ.get("PVENUS_SILICONFLOW_BASE_URL", "https://api.siliconflow.cn/v1") # 可指向本地模拟服务做压测
+
+class ClientRegistry:
+    """共享HTTP客户端注册表：按base URL复用keep-alive连接池，避免每次调用重复TLS握手"""
+    def __init__(self, max_connections=20, max_keepalive=10, timeout=60.0, connect_timeout=10.0, retire_grace=300.0):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retire_grace = retire_grace # 被替换的连接池在此秒数后关闭，留给进行中的请求（包括较长的流式回复）完成
+        self._lock = threading.Lock()
+        self._loop = None # 异步连接池所在的事件循环，关闭被替换的异步连接池时使用
+        self._retired = [] # 已被替换、等待关闭的连接池
+        self._http_clients = {} # base_url -> openai.DefaultHttpxClient
+        self._openai_clients = {} # (base_url, api_key) -> OpenAI
+        self._sessions = {} # base_url -> requests.Session
+        self._async_http_clients = {} # base_url -> openai.DefaultAsyncHttpxClient
+        self._async_openai_clients = {} # (base_url, api_key) -> AsyncOpenAI
+
+    def configure(self, max_connections=None, max_keepalive=None, timeout=None, connect_timeout=None):
+        """调整连接池参数；参数变化时换上新的连接池，之后获取的客户端按新参数创建。
+        旧连接池可能仍被进行中的请求使用，等retire_grace秒后再关闭"""
+        settings = (max_connections or self.max_connections, max_keepalive or self.max_keepalive,
+                    timeout or self.timeout, connect_timeout or self.connect_timeout)
+        if settings == (self.max_connections, self.max_keepalive, self.timeout, self.connect_timeout):
+            return
+        with self._lock:
+            self.max_connections, self.max_keepalive, self.timeout, self.connect_timeout = settings
+            pools = self._detach()
+            if not any(pools.values()):
+                return
+            self._retired.append(pools)
+        timer = threading.Timer(self.retire_grace, self._close_retired, args=(pools,))
+        timer.daemon = True
+        timer.start()
+
+    def _detach(self):
+        """取下当前所有连接池并返回，之后获取的客户端会重新创建（调用方需持有锁）"""
+        pools = {
+            "http": list(self._http_clients.values()),
+            "sessions": list(self._sessions.values()),
+            "async_http": list(self._async_http_clients.values())
+        }
+        self._http_clients.clear()
+        self._openai_clients.clear()
+        self._sessions.clear()
+        self._async_http_clients.clear()
+        self._async_openai_clients.clear()
+        return pools
+
+    def _close_retired(self, pools):
+        """宽限期结束后关闭被替换的连接池；已在close/aclose中关闭的跳过"""
+        with self._lock:
+            if not any(retired is pools for retired in self._retired):
+                return
+            self._retired = [retired for retired in self._retired if retired is not pools]
+            loop = self._loop
+        self._close_sync(pools)
+        if pools["async_http"] and loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._aclose_all(pools["async_http"]), loop)
+
+    @staticmethod
+    def _close_sync(pools):
+        for http_client in pools["http"]:
+            http_client.close()
+        for session in pools["sessions"]:
+            session.close()
+
+    @staticmethod
+    async def _aclose_all(http_clients):
+        for http_client in http_clients:
+            await http_client.aclose()
+
+    def _pool_options(self):
+        """连接池参数；Limits类型取自openai所依赖的HTTP库"""
+        return {
+            "limits": type(openai.DEFAULT_CONNECTION_LIMITS)(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive
+            ),
+            "timeout": openai.Timeout(self.timeout, connect=self.connect_timeout)
+        }
+
+    def _get_async_http_client(self, base_url):
+        """获取指定base URL的异步HTTP连接池（调用方需持有锁）"""
+        http_client = self._async_http_clients.get(base_url)
+        if http_client is None:
+            http_client = openai.DefaultAsyncHttpxClient(**self._pool_options())
+            self._async_http_clients[base_url] = http_client
+        return http_client
+
+    def _get_http_client(self, base_url):
+        """获取指定base URL的HTTP连接池（调用方需持有锁）"""
+        http_client = self._http_clients.get(base_url)
+        if http_client is None:
+            http_client = openai.DefaultHttpxClient(**self._pool_options())
+            self._http_clients[base_url] = http_client
+        return http_client
+
+    def get_openai(self, api_key, base_url):
+        """获取共享连接池的OpenAI兼容客户端"""
+        with self._lock:
+            client = self._openai_clients.get((base_url, api_key))
+            if client is None:
+                client = openai.OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    http_client=self._get_http_client(base_url)
+                )
+                self._openai_clients[(base_url, api_key)] = client
+            return client
+
+    def get_async_openai(self, api_key, base_url):
+        """获取共享连接池的异步OpenAI兼容客户端（只能在同一个事件循环中使用）"""
+        with self._lock:
+            client = self._async_openai_clients.get((base_url, api_key))
+            if client is None:
+                client = openai.AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    http_client=self._get_async_http_client(base_url)
+                )
+                self._async_openai_clients[(base_url, api_key)] = client
+            return client
+
+    def get_session(self, base_url):
+        """获取指定base URL的requests会话，用于非OpenAI格式的接口"""
+        with self._lock:
+            session = self._sessions.get(base_url)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_keepalive)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[base_url] = session
+            return session
+
+    def prewarm(self, base_urls, loop=None):
+        """后台预先建立连接，让第一轮对话不必承担DNS解析和TLS握手的耗时；传入事件循环时同时预热异步连接池"""
+        base_urls = [base_url for base_url in base_urls if base_url]
+    
+        def worker():
+            # 顺便在后台完成openai的导入，首轮对话不必再承担导入耗时
+            openai.load()
+            for base_url in base_urls:
+                start = time.perf_counter()
+                try:
+                    with self._lock:
+                        http_client = self._get_http_client(base_url)
+                    # 任意响应码都说明连接已建立并回到连接池
+                    http_client.head(base_url, timeout=self.connect_timeout)
+                    logger.debug(f"连接预热完成: {base_url} ({(time.perf_counter() - start) * 1000:.0f}ms)")
+                except Exception as e:
+                    logger.debug(f"连接预热失败: {base_url}: {e}")
+    
+        threading.Thread(target=worker, daemon=True).start()
+        if loop is not None:
+            self._loop = loop
+            asyncio.run_coroutine_threadsafe(self._prewarm_async(base_urls), loop)
+
+    async def _prewarm_async(self, base_urls):
+        """并发预热异步连接池"""
+        async def warm(base_url):
+            start = time.perf_counter()
+            try:
+                with self._lock:
+                    http_client = self._get_async_http_client(base_url)
+                await http_client.head(base_url, timeout=self.connect_timeout)
+                logger.debug(f"异步连接预热完成: {base_url} ({(time.perf_counter() - start) * 1000:.0f}ms)")
+            except Exception as e:
+                logger.debug(f"异步连接预热失败: {base_url}: {e}")
+    
+        await asyncio.gather(*(warm(base_url) for base_url in base_urls))
+
+    def close(self):
+        """关闭所有连接池，包括仍在宽限期内的旧连接池"""
+        with self._lock:
+            # 异步连接池只能在其事件循环中关闭（见aclose），这里仅丢弃引用
+            pools = [self._detach()] + self._retired
+            self._retired = []
+        for pool in pools:
+            self._close_sync(pool)
+
+    async def aclose(self):
+        """在创建异步连接池的事件循环中关闭它们"""
+        with self._lock:
+            http_clients = list(self._async_http_clients.values())
+            self._async_http_clients.clear()
+            self._async_openai_clients.clear()
+            for pools in self._retired:
+                http_clients += pools["async_http"]
+                pools["async_http"] = []
+        await self._aclose_all(http_clients)
+
+client_registry = ClientRegistry()
+
+class AsyncLoopThread:
+    """在后台线程中运行asyncio事件循环，同步代码通过submit/run提交协程"""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="asyncio", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """提交协程，立即返回concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """提交协程并阻塞等待结果"""
+        return self.submit(coro).result()
+
+    async def _shutdown(self):
+        """取消仍在进行的阶段并关闭异步连接池"""
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client_registry.aclose()
+
+    def stop(self, timeout=5):
+        """停止事件循环"""
+        if self.loop.is_closed():
+            return
+        try:
+            self.submit(self._shutdown()).result(timeout)
+        except Exception as e:
+            logger.warning(f"关闭事件循环时出错: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        if not self.loop.is_running():
+            self.loop.close()
+
+# --- 每轮对话的阶段耗时统计 ---
+
+METRIC_SPANS = {
+    "image_analysis": "图片分析",
+    "memory_search": "记忆检索",
+    "prompt_build": "构建提示词",
+    "llm_request": "模型请求",
+    "ttft": "首字延迟",
+    "memory_ops": "记忆操作",
+    "persistence": "保存记录",
+    "tts_synthesis": "语音合成",
+    "speed_adjust": "语音调速",
+    "playback_start": "开始播放",
+    "total": "整轮耗时",
+}
+
+def percentile(sorted_values, p):
+    """最近秩法计算分位数，sorted_values须已排序"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+class TurnMetrics:
+    """一轮对话各阶段的耗时（毫秒），可在多个线程中记录"""
+    def __init__(self):
+        self.timestamp = datetime.now().isoformat()
+        self.begin = time.perf_counter()
+        self.spans = {}
+        self.usage = None # 模型返回的token用量
+        self.lock = threading.Lock()
+
+    def record(self, name, elapsed_ms):
+        """累加一个阶段的耗时，同一阶段执行多次（如分段合成）时求和"""
+        with self.lock:
+            self.spans[name] = self.spans.get(name, 0.0) + elapsed_ms
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def record_usage(self, prompt_tokens, cached_tokens, completion_tokens):
+        """记录本轮的token用量，cached_tokens为命中服务端提示词缓存的部分"""
+        self.usage = {"prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens, "completion_tokens": completion_tokens}
+
+    async def timed(self, name, awaitable):
+        """等待awaitable并把耗时记为一个阶段，用于asyncio.gather中并发执行的阶段"""
+        with self.span(name):
+            return await awaitable
+
+    def as_dict(self):
+        with self.lock:
+            spans = {name: round(elapsed, 1) for name, elapsed in self.spans.items()}
+        spans["total"] = round((time.perf_counter() - self.begin) * 1000, 1)
+        record = {"timestamp": self.timestamp, "spans": spans}
+        if self.usage:
+            record["usage"] = self.usage
+        return record
+
+class MetricsRecorder:
+    """把每轮对话的阶段耗时追加到按大小轮转的JSONL文件，并保留最近window轮用于计算p50/p95/p99"""
+    def __init__(self, path, max_bytes=5 * 1024 * 1024, backup_count=3, window=200):
+        self.path = path
+        self.window = window
+        self.samples = None # {阶段: 最近的耗时}，首次查询时从文件末尾恢复
+        self.usage = None # 最近各轮的 (提示词token数, 命中缓存的token数)
+        self.lock = threading.Lock()
+        self.handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True
+        )
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+
+    def configure(self, max_bytes=None, window=None):
+        if max_bytes is not None:
+            self.handler.maxBytes = max_bytes
+        if window is not None and window != self.window:
+            with self.lock:
+                self.window = window
+                if self.samples is not None:
+                    self.samples = {name: deque(values, maxlen=window) for name, values in self.samples.items()}
+                    self.usage = deque(self.usage, maxlen=window)
+
+    def _add_sample(self, record):
+        for name, elapsed in record.get("spans", {}).items():
+            self.samples.setdefault(name, deque(maxlen=self.window)).append(elapsed)
+        usage = record.get("usage")
+        if usage:
+            self.usage.append((usage.get("prompt_tokens", 0), usage.get("cached_tokens", 0)))
+
+    def _load_recent(self):
+        """读取当前指标文件末尾的最近window条记录"""
+        self.samples = {}
+        self.usage = deque(maxlen=self.window)
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = deque(f, maxlen=self.window)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"读取性能指标失败: {e}")
+            return
+        for line in lines:
+            try:
+                self._add_sample(json.loads(line))
+            except ValueError:
+                continue
+
+    def record_turn(self, metrics):
+        """写入一轮对话的指标"""
+        record = metrics.as_dict()
+        self.handler.handle(logging.makeLogRecord({"msg": json.dumps(record, ensure_ascii=False)}))
+        with self.lock:
+            if self.samples is not None:
+                self._add_sample(record)
+        logger.debug(f"本轮耗时: {record['spans']}")
+
+    def summary(self):
+        """各阶段最近window轮的样本数与分位数（毫秒）"""
+        with self.lock:
+            if self.samples is None:
+                self._load_recent()
+            result = {}
+            for name, values in self.samples.items():
+                ordered = sorted(values)
+                result[name] = {"count": len(ordered), **{f"p{p}": percentile(ordered, p) for p in (50, 95, 99)}}
+            return result
+
+    def cache_hit_rate(self):
+        """最近各轮提示词token中命中缓存的比例，返回 (命中率, 轮数)；没有用量数据时命中率为None"""
+        with self.lock:
+            if self.samples is None:
+                self._load_recent()
+            prompt_tokens = sum(prompt for prompt, _ in self.usage)
+            cached_tokens = sum(cached for _, cached in self.usage)
+            return (cached_tokens / prompt_tokens if prompt_tokens else None), len(self.usage)
+
+    def format_summary(self):
+        """生成分位数表格文本"""
+        summary = self.summary()
+        if not summary:
+            return "暂无性能数据"
+        lines = [f"{'次数':>4}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}  阶段"]
+        for name in list(METRIC_SPANS) + sorted(set(summary) - set(METRIC_SPANS)):
+            if name in summary:
+                stats = summary[name]
+                lines.append(f"{stats['count']:>6}{stats['p50']:>10.0f}{stats['p95']:>10.0f}{stats['p99']:>10.0f}  {METRIC_SPANS.get(name, name)}")
+        hit_rate, turns = self.cache_hit_rate()
+        if hit_rate is not None:
+            lines.append(f"提示词缓存命中率: {hit_rate:.1%}（最近 {turns} 轮）")
+        return "\n".join(lines)
+
+    def close(self):
+        self.handler.close()
+
 class FileProcessor:
     """文件处理类"""
-    def __init__(self, siliconflow_key):
+    MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif", "BMP": "image/bmp"}
+    VISION_MODEL = "Qwen/Qwen2.5-VL-72B-Instruct"
+    VISION_PROMPT = "请详细表述这幅图片的内容，包括场景、人物、物品、行为，以及场景可能想要表示的内容。"
+
+    def __init__(self, siliconflow_key, max_side=1568, image_format="JPEG", quality=85,
+                 cache_dir=os.path.join("data", "cache", "vision"), cache_max_bytes=50 * 1024 * 1024, max_concurrency=3):
         self.siliconflow_key = siliconflow_key
         self.image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+        self.max_side = max_side
+        self.image_format = image_format.upper().replace("JPG", "JPEG")
+        self.quality = quality
+        self.low_detail_max_side = 512 # 最终最长边不超过该值时使用 detail=low
+        self.analysis_cache = DiskLRUCache(cache_dir, cache_max_bytes, suffix=".txt")
+        self._inflight = {} # 缓存键 -> 正在进行的分析请求(Future)
+        self._inflight_lock = threading.Lock()
+        # 有界线程池，限制同时进行的图片分析请求数以符合服务商限流
+        self.max_concurrency = max(1, max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="vision")
+
+    def close(self):
+        """不再接受新的分析请求；已提交的分析仍会完成，线程随后退出"""
+        self._executor.shutdown(wait=False)
 
     def is_image_file(self, file_path):
         """判断是否为图片文件"""
@@ -138,40 +1453,308 @@ class FileProcessor:
             logger.error(f"图片编码失败: {e}")
             return None
 
-    def analyze_image(self, image_path):
-        """使用Qwen2.5-VL分析图片"""
+    def prepare_image(self, image_path):
+        """预处理图片：按EXIF方向旋转、限制最长边并重新编码，返回 (base64, MIME类型, detail)"""
         try:
-            client = OpenAI(
-                api_key=self.siliconflow_key,
-                base_url="https://api.siliconflow.cn/v1"
-            )
-            base64_image = self.encode_image_to_base64(image_path)
-            if not base64_image:
-                return "图片编码失败"
+            with Image.open(image_path) as original:
+                original_format = original.format
+                orientation = original.getexif().get(0x0112, 1)
+                img = ImageOps.exif_transpose(original)
+        
+            image_format = self.image_format
+            if orientation == 1 and original_format == image_format and max(img.size) <= self.max_side:
+                # 尺寸与格式都已符合要求，直接使用原图避免二次压缩
+                with open(image_path, "rb") as image_file:
+                    data = image_file.read()
+            else:
+                img.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+                if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+                    # JPEG不支持透明通道，合成到白色背景上
+                    rgba = img.convert("RGBA")
+                    img = Image.new("RGB", rgba.size, (255, 255, 255))
+                    img.paste(rgba, mask=rgba.getchannel("A"))
+                elif img.mode == "P":
+                    img = img.convert("RGBA")
             
-            response = client.chat.completions.create(
-                model="Qwen/Qwen2.5-VL-72B-Instruct",
-                messages=[{
-                    "role": "user",
-                    "content": [
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}", "detail": "high"}},
-                        {"type": "text", "text": "请详细表述这幅图片的内容，包括场景、人物、物品、行为，以及场景可能想要表示的内容。"}
-                    ]
-                }],
-                max_tokens=1000,
-                timeout=60
-            )
-            return response.choices[0].message.content
+                save_options = {"quality": self.quality} if image_format in ("JPEG", "WEBP") else {}
+                if image_format == "JPEG":
+                    save_options["optimize"] = True
+                buffer = io.BytesIO()
+                img.save(buffer, format=image_format, **save_options)
+                data = buffer.getvalue()
+        
+            detail = "low" if max(img.size) <= self.low_detail_max_side else "high"
+            logger.debug(f"图片预处理完成: {img.size[0]}x{img.size[1]}, {len(data)} 字节, detail={detail}")
+            return base64.b64encode(data).decode('utf-8'), self.MIME_TYPES.get(image_format, "image/jpeg"), detail
         except Exception as e:
+            logger.warning(f"图片预处理失败，改为上传原图: {e}")
+            base64_image = self.encode_image_to_base64(image_path)
+            if not base64_image:
+                return None, None, None
+            mime_type = self.MIME_TYPES.get(Path(image_path).suffix.lower().lstrip('.').upper().replace("JPG", "JPEG"), "image/jpeg")
+            return base64_image, mime_type, "high"
+
+    def _analysis_cache_key(self, image_path):
+        """由图片内容、模型、提示词和预处理参数计算缓存键"""
+        digest = hashlib.sha256()
+        with open(image_path, "rb") as image_file:
+            for block in iter(lambda: image_file.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(f"\0{self.VISION_MODEL}\0{self.VISION_PROMPT}\0{self.max_side}\0{self.image_format}\0{self.quality}".encode('utf-8'))
+        return digest.hexdigest()
+
+    def _claim_inflight(self, cache_key):
+        """登记进行中的分析请求，返回 (Future, 是否由调用方负责请求)"""
+        with self._inflight_lock:
+            future = self._inflight.get(cache_key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._inflight[cache_key] = future
+            return future, True
+
+    def _release_inflight(self, cache_key, future, result):
+        """结束进行中的分析请求，唤醒所有等待者"""
+        with self._inflight_lock:
+            del self._inflight[cache_key]
+        future.set_result(result)
+
+    async def analyze_image_async(self, image_path, client):
+        """分析图片：优先读缓存，相同图片的并发请求合并为一次API调用"""
+        loop = asyncio.get_running_loop()
+        try:
+            cache_key = await loop.run_in_executor(self._executor, self._analysis_cache_key, image_path)
+        except OSError as e:
             logger.error(f"图片分析失败: {e}")
             return f"图片分析失败: {str(e)}"
+    
+        cached = self.analysis_cache.get_bytes(cache_key)
+        if cached is not None:
+            logger.info(f"命中图片分析缓存: {image_path}")
+            return cached.decode('utf-8')
+    
+        future, is_owner = self._claim_inflight(cache_key)
+        if not is_owner:
+            logger.info(f"相同图片正在分析，等待其结果: {image_path}")
+            return await asyncio.wrap_future(future)
+    
+        result = None
+        try:
+            # 解码与缩放属于CPU密集操作，放到线程池中执行以免阻塞事件循环
+            messages = await loop.run_in_executor(self._executor, self._build_vision_messages, image_path)
+            if messages is None:
+                result = "图片编码失败"
+            else:
+                response = await client.chat.completions.create(
+                    model=self.VISION_MODEL,
+                    messages=messages,
+                    max_tokens=1000,
+                    timeout=60
+                )
+                result = response.choices[0].message.content
+                self.analysis_cache.put(cache_key, result.encode('utf-8'))
+        except Exception as e:
+            logger.error(f"图片分析失败: {e}")
+            result = f"图片分析失败: {str(e)}"
+        finally:
+            self._release_inflight(cache_key, future, result)
+        return result
+
+    async def analyze_images_async(self, image_paths, client):
+        """异步并发分析多张图片，同时进行的请求数不超过max_concurrency，结果按输入顺序返回"""
+        slots = asyncio.Semaphore(self.max_concurrency)
+    
+        async def analyze(image_path):
+            async with slots:
+                return await self.analyze_image_async(image_path, client)
+    
+        return list(await asyncio.gather(*(analyze(path) for path in image_paths)))
+
+    def _build_vision_messages(self, image_path):
+        """构建图片分析请求的消息列表，编码失败时返回None"""
+        base64_image, mime_type, detail = self.prepare_image(image_path)
+        if not base64_image:
+            return None
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mime_type};base64,{base64_image}",
+                            "detail": detail
+                        }
+                    },
+                    {"type": "text", "text": self.VISION_PROMPT}
+                ]
+            }
+        ]
+
+class HashingEmbedder:
+    """本地哈希嵌入器：对字符 n-gram 做特征哈希，离线可用且无需模型文件"""
+    default_min_score = 0.08 # 只有字面重合才有相似度，相关记忆的得分通常只有0.1左右；单字偶然重合约0.06
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def _features(self, text):
+        """提取特征：英文/数字按词，中文等按单字和双字"""
+        features = []
+        for token in re.findall(r"\w+", text.lower()):
+            if token.isascii():
+                features.append(token)
+            else:
+                features.extend(token)
+                features.extend(token[i:i + 2] for i in range(len(token) - 1))
+        return features
+
+    def embed(self, texts):
+        """将文本列表编码为L2归一化的向量矩阵"""
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode('utf-8'))
+                vectors[row, h % self.dim] += -1.0 if h & 0x80000000 else 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+class SentenceTransformerEmbedder:
+    """基于 sentence-transformers 的本地嵌入器（需预先下载模型）"""
+    default_min_score = 0.3
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        """将文本列表编码为L2归一化的向量矩阵"""
+        return np.asarray(self.model.encode(list(texts), normalize_embeddings=True), dtype=np.float32)
+
+def create_embedder(spec="hashing"):
+    """根据配置创建嵌入器，如 "hashing"、"hashing:1024"、"sentence-transformers:<模型名>" """
+    name, _, arg = (spec or "hashing").partition(":")
+    if name == "sentence-transformers" and arg:
+        try:
+            return SentenceTransformerEmbedder(arg)
+        except Exception as e:
+            logger.error(f"加载嵌入模型失败，改用哈希嵌入: {e}")
+    elif name == "hashing" and arg.isdigit():
+        return HashingEmbedder(int(arg))
+    return HashingEmbedder()
+
+class MemoryIndex:
+    """记忆向量索引，维护 NumPy 嵌入矩阵并随记忆增删改增量更新"""
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self.ids = []
+        self.rows = {}
+        self.matrix = np.zeros((16, embedder.dim), dtype=np.float32)
+
+    def rebuild(self, memory):
+        """根据全部记忆重建索引"""
+        self.ids = list(memory.keys())
+        self.rows = {mem_id: row for row, mem_id in enumerate(self.ids)}
+        self.matrix = np.zeros((max(16, len(self.ids)), self.embedder.dim), dtype=np.float32)
+        if self.ids:
+            self.matrix[:len(self.ids)] = self.embedder.embed([memory[i]['content'] for i in self.ids])
+
+    def upsert(self, memory_id, content):
+        """新增或更新一条记忆的向量"""
+        row = self.rows.get(memory_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self.matrix):
+                # 容量翻倍扩展，均摊O(1)
+                grown = np.zeros((row * 2, self.matrix.shape[1]), dtype=np.float32)
+                grown[:row] = self.matrix
+                self.matrix = grown
+            self.ids.append(memory_id)
+            self.rows[memory_id] = row
+        self.matrix[row] = self.embedder.embed([content])[0]
+
+    def remove(self, memory_id):
+        """删除一条记忆的向量（与末行交换后删除）"""
+        row = self.rows.pop(memory_id, None)
+        if row is None:
+            return
+        last = len(self.ids) - 1
+        if row != last:
+            moved_id = self.ids[last]
+            self.matrix[row] = self.matrix[last]
+            self.ids[row] = moved_id
+            self.rows[moved_id] = row
+        self.ids.pop()
+
+    def search(self, query, top_k, min_score):
+        """返回与查询最相似的记忆 [(记忆ID, 相似度)]，按相似度降序"""
+        count = len(self.ids)
+        if count == 0:
+            return []
+        scores = self.matrix[:count] @ self.embedder.embed([query])[0]
+        k = min(top_k, count)
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(self.ids[i], float(scores[i])) for i in candidates if scores[i] >= min_score]
 
 class MemoryManager:
     """记忆管理类"""
-    def __init__(self, config_manager):
+    _versions = itertools.count(1) # 所有实例共用的版本号序列，记忆每次变化都取新值
+
+    def __init__(self, config_manager, embedder=None):
         self.config_manager = config_manager
         self.memory = self.config_manager.load_memory()
+        self.version = next(self._versions) # 渲染好的记忆上下文按版本号缓存
         self.next_id = max([int(k) for k in self.memory.keys()] + [0]) + 1
+        self.top_k = 8
+        self.min_score = None # 为None时使用嵌入器自己的默认阈值
+        self.min_results = 3 # 检索结果不足时用最近修改的记忆补足
+        self.embedder = embedder
+        self.embedder_spec = None
+        self._index = None
+
+    @property
+    def index(self):
+        """记忆向量索引，首次检索或修改记忆时才建立，未安装NumPy时为None"""
+        if self._index is None and HAS_NUMPY:
+            if self.embedder is None:
+                self.embedder = create_embedder(self.embedder_spec)
+            index = MemoryIndex(self.embedder)
+            index.rebuild(self.memory)
+            self._index = index
+        return self._index
+
+    def configure_retrieval(self, top_k=None, min_score=None, embedder_spec=None, min_results=None):
+        """配置记忆检索参数，更换嵌入器时重建索引"""
+        if top_k is not None: self.top_k = top_k
+        if min_score is not None: self.min_score = min_score
+        if min_results is not None: self.min_results = min_results
+        if embedder_spec and embedder_spec != self.embedder_spec and HAS_NUMPY:
+            # 嵌入器在下次使用索引时才创建，避免启动时加载模型
+            self.embedder_spec = embedder_spec
+            self.embedder = None
+            self._index = None
+
+    def search_memory(self, query, top_k=None, min_score=None):
+        """检索与当前输入最相关的记忆，返回 [(记忆ID, 记忆数据)]"""
+        top_k = self.top_k if top_k is None else top_k
+        # 记忆总数不超过top_k或无法检索时，直接返回全部记忆
+        if not query or self.index is None or len(self.memory) <= top_k:
+            return list(self.memory.items())
+        if min_score is None:
+            min_score = self.embedder.default_min_score if self.min_score is None else self.min_score
+        items = [(mem_id, self.memory[mem_id]) for mem_id, _ in self.index.search(query, top_k, min_score)]
+        # 没有足够相关的记忆时（如寒暄），补充最近修改的记忆，避免模型完全看不到记忆
+        if len(items) < self.min_results:
+            items += self.recent_memories(self.min_results - len(items), exclude={mem_id for mem_id, _ in items})
+        return items
+
+    def recent_memories(self, count, exclude=()):
+        """最近修改的count条记忆，按修改时间降序"""
+        candidates = ((mem_id, mem_data) for mem_id, mem_data in self.memory.items() if mem_id not in exclude)
+        return heapq.nlargest(count, candidates, key=lambda item: item[1]['last_modified'])
 
     def add_memory(self, content):
         """添加新记忆"""
@@ -179,14 +1762,18 @@ class MemoryManager:
         current_time = datetime.now().isoformat()
         self.memory[memory_id] = {"content": content, "created_time": current_time, "last_modified": current_time}
         self.next_id += 1
-        self.config_manager.save_memory(self.memory)
+        self.version = next(self._versions)
+        if self.index is not None: self.index.upsert(memory_id, content)
+        self.config_manager.append_memory_journal({"op": "put", "id": memory_id, "data": self.memory[memory_id]}, self.memory)
         return memory_id
 
     def delete_memory(self, memory_id):
         """删除记忆"""
         if memory_id in self.memory:
             del self.memory[memory_id]
-            self.config_manager.save_memory(self.memory)
+            self.version = next(self._versions)
+            if self.index is not None: self.index.remove(memory_id)
+            self.config_manager.append_memory_journal({"op": "del", "id": memory_id}, self.memory)
             return True
         return False
 
@@ -195,53 +1782,159 @@ class MemoryManager:
         if memory_id in self.memory:
             self.memory[memory_id]["content"] = new_content
             self.memory[memory_id]["last_modified"] = datetime.now().isoformat()
-            self.config_manager.save_memory(self.memory)
+            self.version = next(self._versions)
+            if self.index is not None: self.index.upsert(memory_id, new_content)
+            self.config_manager.append_memory_journal({"op": "put", "id": memory_id, "data": self.memory[memory_id]}, self.memory)
             return True
         return False
 
-    def get_memory_prompt(self):
-        """获取记忆提示词"""
-        if not self.memory:
-            return ""
-        memory_text = "永久记忆:\n"
-        for mem_id, mem_data in self.memory.items():
-            memory_text += f"[{mem_id}] {mem_data['content']} (创建: {mem_data['created_time'][:19]}, 修改: {mem_data['last_modified'][:19]})\n"
-        return memory_text
+def time_stretch_pcm(samples, speed, frame_size=1024, hop_size=512, tolerance=256):
+    """WSOLA时间伸缩：改变语速而不改变音调，输入输出均为int16单声道采样。
+    每一帧在名义位置前后tolerance个采样内寻找与上一帧自然延续波形最相关的位置，避免直接重叠相加产生的相位抵消和咔嗒声"""
+    if speed == 1.0 or len(samples) < frame_size + hop_size:
+        return samples
+    analysis_hop = max(1, int(round(hop_size * speed)))
+    frame_count = 1 + (len(samples) - frame_size - hop_size) // analysis_hop
+    padded = np.pad(samples.astype(np.float32), (tolerance, tolerance + frame_size + hop_size))
+    positions = np.empty(frame_count, dtype=np.int64)
+    position = tolerance
+    for index in range(frame_count):
+        positions[index] = position
+        natural = padded[position + hop_size:position + hop_size + frame_size]
+        nominal = tolerance + (index + 1) * analysis_hop
+        region = padded[nominal - tolerance:nominal + tolerance + frame_size]
+        position = nominal - tolerance + int(np.argmax(np.correlate(region, natural, "valid")))
+    window = np.hanning(frame_size).astype(np.float32)
+    offsets = np.arange(frame_size)[None, :]
+    frames = padded[offsets + positions[:, None]] * window
+    output_index = offsets + hop_size * np.arange(frame_count)[:, None]
+    output_length = hop_size * (frame_count - 1) + frame_size
+    output = np.zeros(output_length, dtype=np.float32)
+    weights = np.zeros(output_length, dtype=np.float32)
+    np.add.at(output, output_index, frames)
+    np.add.at(weights, output_index, np.broadcast_to(window, frames.shape))
+    weights[weights < 1e-3] = 1.0
+    return np.clip(output / weights, -32768, 32767).astype(np.int16)
 
 class VoiceManager:
     """语音管理类 (GUI适配版)"""
-    def __init__(self, siliconflow_key):
+    PCM_SAMPLE_RATE = 32000 # 快速路径请求的PCM采样率（16位单声道）
+
+    def __init__(self, siliconflow_key, cache_max_bytes=200 * 1024 * 1024, fast_path=True, audio_ttl_seconds=7 * 24 * 3600,
+                 catalog_file=os.path.join("data", "cache", "voices.json"), catalog_ttl_seconds=3600):
         self.siliconflow_key = siliconflow_key
-        self.client = OpenAI(api_key=siliconflow_key, base_url="https://api.siliconflow.cn/v1")
+        # data/audio 下的所有语音文件（MP3/PCM）统一按容量与存活时间管理
+        self.audio_store = AudioStore(os.path.join("data", "audio"), cache_max_bytes, ttl_seconds=audio_ttl_seconds)
+        self.audio_store.start_cleanup()
+        self.fast_path = fast_path and HAS_NUMPY
         self.available_voices = {
             "Alex": "FunAudioLLM/CosyVoice2-0.5B:alex", "Anna": "FunAudioLLM/CosyVoice2-0.5B:anna",
             "Bella": "FunAudioLLM/CosyVoice2-0.5B:bella", "Benjamin": "FunAudioLLM/CosyVoice2-0.5B:benjamin",
             "Charles": "FunAudioLLM/CosyVoice2-0.5B:charles", "Claire": "FunAudioLLM/CosyVoice2-0.5B:claire",
             "David": "FunAudioLLM/CosyVoice2-0.5B:david", "Diana": "FunAudioLLM/CosyVoice2-0.5B:diana"
         }
-        self.custom_voices = {}
-        self.all_voices = {}
         self.selected_voice_uri = self.available_voices["Alex"]
-
-    def refresh_voices(self):
-        """获取所有可用音色"""
-        self.custom_voices = self._get_custom_voices()
+        self.catalog_file = catalog_file
+        self.catalog_ttl_seconds = catalog_ttl_seconds
+        # 先用本地缓存的音色目录，过期后由refresh_voices在后台刷新
+        catalog = self._load_voice_catalog()
+        self._apply_voice_catalog(catalog["voices"] if catalog else [])
+
+    @property
+    def client(self):
+        """语音服务客户端，首次使用时才创建（并导入openai）"""
+        return client_registry.get_openai(self.siliconflow_key, SILICONFLOW_BASE_URL)
+
+    def _apply_voice_catalog(self, voices):
+        """用音色目录更新可选音色，返回全部音色名称"""
+        self.custom_voices = {voice["customName"]: voice["uri"] for voice in voices if voice.get("uri") and voice.get("customName")}
         self.all_voices = {**self.available_voices, **self.custom_voices}
         return list(self.all_voices.keys())
 
+    def _catalog_owner(self):
+        """音色目录缓存所属的API Key指纹，切换账号后旧缓存自动失效"""
+        return hashlib.sha256(self.siliconflow_key.encode('utf-8')).hexdigest()[:16]
+
+    def _load_voice_catalog(self):
+        """读取本地音色目录缓存，不存在、已损坏或属于其他账号时返回None"""
+        try:
+            with open(self.catalog_file, 'r', encoding='utf-8') as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(catalog, dict) or catalog.get("owner") != self._catalog_owner(): return None
+        return catalog
+
+    def _save_voice_catalog(self, catalog):
+        """原子写入音色目录缓存"""
+        tmp_path = f"{self.catalog_file}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.catalog_file), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(catalog, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.catalog_file)
+        except OSError as e:
+            logger.warning(f"保存音色目录缓存失败: {e}")
+
+    def voice_names(self):
+        """当前可选的全部音色名称"""
+        return list(self.all_voices.keys())
+
+    def refresh_voices(self, force=False):
+        """获取所有可用音色；缓存未过期时直接使用缓存"""
+        catalog = self._load_voice_catalog()
+        if not force and catalog and time.time() - catalog.get("fetched_at", 0) < self.catalog_ttl_seconds:
+            return self._apply_voice_catalog(catalog["voices"])
+        return self._apply_voice_catalog(self._get_custom_voices())
+
     def _get_custom_voices(self):
-        """获取用户自定义音色列表"""
-        custom_voices_map = {}
-        try:
-            response = requests.get("https://api.siliconflow.cn/v1/audio/voice/list", headers={"Authorization": f"Bearer {self.siliconflow_key}"})
-            if response.status_code == 200:
-                for voice in response.json().get("result", []):
-                    if voice.get("uri") and voice.get("customName"):
-                        custom_voices_map[voice.get("customName")] = voice.get("uri")
-                logger.info(f"成功获取 {len(custom_voices_map)} 个自定义音色")
+        """获取用户自定义音色列表：带超时的条件请求，未变化时沿用缓存，失败时返回旧缓存"""
+        catalog = self._load_voice_catalog() or {"owner": self._catalog_owner(), "etag": None, "voices": [], "fetched_at": 0}
+        headers = {"Authorization": f"Bearer {self.siliconflow_key}"}
+        if catalog.get("etag"): headers["If-None-Match"] = catalog["etag"]
+        try:
+            response = client_registry.get_session(SILICONFLOW_BASE_URL).get(
+                f"{SILICONFLOW_BASE_URL}/audio/voice/list", headers=headers, timeout=(client_registry.connect_timeout, 10)
+            )
+            if response.status_code == 304:
+                logger.debug("自定义音色列表未变化")
+            elif response.status_code == 200:
+                catalog["voices"] = [voice for voice in response.json().get("result", []) if voice.get("uri")]
+                catalog["etag"] = response.headers.get("ETag")
+                logger.info(f"成功获取 {len(catalog['voices'])} 个自定义音色")
+            else:
+                logger.error(f"获取自定义音色失败: HTTP {response.status_code}")
+                return catalog["voices"]
+            catalog["fetched_at"] = time.time()
+            self._save_voice_catalog(catalog)
         except Exception as e:
             logger.error(f"获取自定义音色失败: {e}")
-        return custom_voices_map
+        return catalog["voices"]
+
+    def split_sentences(self, text, min_chars=8):
+        """按句末标点切分文本，过短的句子与后一句合并，减少请求次数"""
+        sentences, buffer = [], ""
+        for piece in re.split(r'(?<=[。！？!?；;…\n])|(?<=\.)\s+', text):
+            buffer += piece
+            if len(buffer.strip()) >= min_chars:
+                sentences.append(buffer.strip())
+                buffer = ""
+        if buffer.strip():
+            if sentences and len(buffer.strip()) < min_chars: sentences[-1] += buffer.rstrip()
+            else: sentences.append(buffer.strip())
+        return sentences
+
+    def synthesize_pipelined(self, text, speed=1.0, lookahead=2, metrics=None):
+        """按句切分并以有限预取并发合成，按原顺序逐段产出音频文件路径"""
+        sentences = iter(self.split_sentences(text))
+        with ThreadPoolExecutor(max_workers=lookahead, thread_name_prefix="tts") as executor:
+            futures = deque(executor.submit(self.text_to_speech, sentence, speed, metrics) for sentence in itertools.islice(sentences, lookahead))
+            while futures:
+                voice_file = futures.popleft().result()
+                next_sentence = next(sentences, None)
+                if next_sentence is not None:
+                    futures.append(executor.submit(self.text_to_speech, next_sentence, speed, metrics))
+                yield voice_file
 
     def set_voice(self, voice_name):
         """根据名称设置音色"""
@@ -249,41 +1942,223 @@ class VoiceManager:
             self.selected_voice_uri = self.all_voices[voice_name]
             logger.info(f"音色已切换为: {voice_name}")
 
-    def text_to_speech(self, text, speed=1.0):
-        """文本转语音，并支持调速"""
+    def speech_cache_key(self, text, speed=1.0, audio_format="mp3"):
+        """语音缓存键：(音色, 规范化文本, 语速, 格式) 的哈希"""
+        normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+        return hashlib.sha256(f"{self.selected_voice_uri}\0{normalized}\0{speed:.2f}\0{audio_format}".encode('utf-8')).hexdigest()
+
+    def _request_pcm(self, text, speed):
+        """请求PCM格式的合成音频，返回int16采样数组"""
+        response = self.client.audio.speech.create(
+            model="FunAudioLLM/CosyVoice2-0.5B", voice=self.selected_voice_uri,
+            input=text, response_format="pcm", speed=speed,
+            extra_body={"sample_rate": self.PCM_SAMPLE_RATE}
+        )
+        return np.frombuffer(response.content, dtype=np.int16)
+
+    def text_to_speech_pcm(self, text, speed=1.0, metrics=None):
+        """快速路径：请求PCM并由服务端调速，音频全程保存在内存中，返回PCM字节"""
+        metrics = metrics or TurnMetrics()
+        speed = round(speed, 2)
+        cache_key = self.speech_cache_key(text, speed, f"pcm{self.PCM_SAMPLE_RATE}")
+        cached = self.audio_store.get_bytes(f"{cache_key}.pcm")
+        if cached is not None:
+            logger.info("命中语音缓存，跳过合成")
+            return cached
         try:
-            output_dir = "data/audio"
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # 使用 时间戳-内容哈希 生成唯一文件名，避免文件冲突
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            content_hash = hashlib.md5(text.encode('utf-8')).hexdigest()[:16]
-            base_filename = f"{timestamp}-{content_hash}"
-            speech_path = Path(output_dir) / f"{base_filename}.mp3"
-
-            with self.client.audio.speech.with_streaming_response.create(
-                model="FunAudioLLM/CosyVoice2-0.5B", voice=self.selected_voice_uri,
-                input=text, response_format="mp3"
-            ) as response:
-                response.stream_to_file(speech_path)
+            samples = self._request_pcm(text, speed)
+        except openai.BadRequestError as e:
+            if speed == 1.0: raise
+            # 服务端不支持该语速时，取原速音频在本地做时间伸缩
+            logger.warning(f"服务端调速失败，改为本地调速: {e}")
+            samples = self._request_pcm(text, 1.0)
+            with metrics.span("speed_adjust"):
+                samples = time_stretch_pcm(samples, speed)
+        pcm = samples.tobytes()
+        self.audio_store.put(f"{cache_key}.pcm", pcm)
+        return pcm
+
+    def text_to_speech(self, text, speed=1.0, metrics=None):
+        """文本转语音，并支持调速；快速路径返回内存中的PCM字节，否则返回MP3文件路径"""
+        metrics = metrics or TurnMetrics()
+        if self.fast_path:
+            try:
+                return self.text_to_speech_pcm(text, speed, metrics)
+            except Exception as e:
+                logger.warning(f"PCM快速路径失败，改用MP3路径: {e}")
+        speed = round(speed, 2)
+        cache_key = self.speech_cache_key(text, speed)
+        # 返回的文件由调用方在播放结束后取消固定，在此之前不会被后台清理删除
+        self.audio_store.pin(f"{cache_key}.mp3")
+        try:
+            cached_path = self.audio_store.get_path(f"{cache_key}.mp3")
+            if cached_path:
+                logger.info("命中语音缓存，跳过合成")
+                return cached_path
+
+            # 原速音频也单独缓存，调整语速时无需重新请求合成
+            raw_key = self.speech_cache_key(text, 1.0)
+            speech_path = self.audio_store.get_path(f"{raw_key}.mp3")
+            if speech_path is None:
+                tmp_path = os.path.join(self.audio_store.directory, f"{raw_key}.{uuid.uuid4().hex[:8]}.tmp")
+                with self.client.audio.speech.with_streaming_response.create(
+                    model="FunAudioLLM/CosyVoice2-0.5B", voice=self.selected_voice_uri,
+                    input=text, response_format="mp3"
+                ) as response:
+                    response.stream_to_file(tmp_path)
+                speech_path = self.audio_store.put_file(f"{raw_key}.mp3", tmp_path)
 
             if speed == 1.0:
-                return str(speech_path)
+                return speech_path
             
             # 使用pydub调速
-            sound = AudioSegment.from_mp3(speech_path)
-            fast_sound = sound.speedup(playback_speed=speed)
-            speed_adjusted_path = Path(output_dir) / f"{base_filename}_x{speed:.1f}.mp3"
-            fast_sound.export(speed_adjusted_path, format="mp3")
+            with metrics.span("speed_adjust"):
+                sound = pydub.AudioSegment.from_mp3(speech_path)
+                fast_sound = sound.speedup(playback_speed=speed)
+                tmp_path = os.path.join(self.audio_store.directory, f"{cache_key}.{uuid.uuid4().hex[:8]}.tmp")
+                fast_sound.export(tmp_path, format="mp3")
             logger.info(f"语音已调速至 {speed}x")
-            return str(speed_adjusted_path)
+            return self.audio_store.put_file(f"{cache_key}.mp3", tmp_path)
 
         except Exception as e:
+            self.audio_store.unpin(f"{cache_key}.mp3")
             logger.error(f"语音合成失败: {e}")
             return None
 
+class SpeechPlayer:
+    """语音播放队列：在独立声道上排队播放分段语音，实现无缝衔接。
+    声道只有一个排队槽，再次调用queue会替换已排队的片段，因此到达的片段先放入pending，由pump在槽空出时逐个移入"""
+    def __init__(self, release=None):
+        self.pending = deque()
+        self.channel = None
+        self.paused = False
+        self.music_playing = False # 是否正在用pygame.mixer.music播放无法作为Sound加载的MP3
+        self.music_path = None
+        self.release = release # 语音文件不再需要时回调（参数为文件路径）：Sound已载入内存，或music播放结束/被停止
+
+    def _get_channel(self):
+        if self.channel is None:
+            # 混音器在第一次播放语音时才初始化，未开启语音时不加载pygame
+            if not pygame.mixer.get_init(): pygame.mixer.init()
+            pygame.mixer.set_reserved(1) # 保留0号声道专供语音播放
+            self.channel = pygame.mixer.Channel(0)
+        return self.channel
+
+    def enqueue(self, audio):
+        """加入一段语音（MP3文件路径或PCM字节），空闲时立即开始播放"""
+        self._get_channel()
+        if isinstance(audio, bytes):
+            self.pending.append(pygame.mixer.Sound(buffer=self._to_mixer_format(audio)))
+        else:
+            try:
+                self.pending.append(pygame.mixer.Sound(audio))
+                self._release(audio)
+            except pygame.error as e:
+                # 部分SDL_mixer构建的Sound不支持MP3，保留文件路径，轮到它时改用music播放
+                logger.debug(f"MP3无法作为Sound加载，改用music播放: {e}")
+                self.pending.append(audio)
+        self.pump()
+
+    def _release(self, path):
+        if path and self.release: self.release(path)
+
+    def _to_mixer_format(self, pcm, sample_rate=VoiceManager.PCM_SAMPLE_RATE):
+        """将16位单声道PCM转换为混音器的采样率和声道数"""
+        frequency, _, channels = pygame.mixer.get_init()
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        if frequency != sample_rate and len(samples):
+            positions = np.arange(int(len(samples) * frequency / sample_rate)) * (sample_rate / frequency)
+            samples = np.interp(positions, np.arange(len(samples)), samples).astype(np.int16)
+        if channels > 1:
+            samples = np.repeat(samples[:, None], channels, axis=1)
+        return np.ascontiguousarray(samples).tobytes()
+
+    def pump(self):
+        """把待播片段交给声道：空闲时直接播放，播放中则填入声道的排队槽；music播放的片段要等声道和music都空闲。
+        暂停期间不开始新的片段，恢复后继续"""
+        channel = self._get_channel()
+        if self.music_playing and not self.paused and not pygame.mixer.music.get_busy(): self._finish_music()
+        if self.paused or self.music_playing or not self.pending: return
+        if isinstance(self.pending[0], str):
+            if channel.get_busy(): return
+            path = self.pending.popleft()
+            try:
+                pygame.mixer.music.load(path)
+                pygame.mixer.music.play()
+            except pygame.error as e:
+                logger.error(f"播放音频失败: {e}")
+                self._release(path)
+                return
+            self.music_playing, self.music_path = True, path
+            return
+        if not channel.get_busy():
+            channel.play(self.pending.popleft())
+        if self.pending and not isinstance(self.pending[0], str) and channel.get_busy() and channel.get_queue() is None:
+            channel.queue(self.pending.popleft())
+
+    def _finish_music(self):
+        self.music_playing = False
+        self._release(self.music_path)
+        self.music_path = None
+
+    def is_active(self):
+        """是否仍有语音在播放或等待播放"""
+        return bool(self.pending) or self.music_playing or self._get_channel().get_busy()
+
+    def toggle_pause(self):
+        """切换暂停/继续，返回切换后是否处于暂停状态"""
+        channel = self._get_channel()
+        if self.paused:
+            channel.unpause()
+            if self.music_playing: pygame.mixer.music.unpause()
+        else:
+            channel.pause()
+            if self.music_playing: pygame.mixer.music.pause()
+        self.paused = not self.paused
+        return self.paused
+
+    def stop(self):
+        """停止播放并清空队列"""
+        for audio in self.pending:
+            if isinstance(audio, str): self._release(audio)
+        self.pending.clear()
+        self.paused = False
+        if self.channel is not None: self.channel.stop()
+        if self.music_playing:
+            pygame.mixer.music.stop()
+            self._finish_music()
+
+    def close(self):
+        """停止播放并关闭混音器"""
+        self.stop()
+        if self.channel is not None:
+            pygame.mixer.quit()
+            self.channel = None
+
+def estimate_tokens(text):
+    """在本地估算文本的token数：中日韩等宽字符约1个token，其余字符约4个字符1个token"""
+    if not text: return 0
+    wide = sum(1 for ch in text if ch >= "\u2e80")
+    return wide + (len(text) - wide + 3) // 4
+
 class PromptBuilder:
-    """提示词构建类 (保持不变)"""
+    """提示词构建类"""
+    RENDER_CACHE_SIZE = 64
+    _render_cache = OrderedDict() # 渲染好的偏好/记忆文本，键中包含配置内容或记忆版本号，变化后自然失效
+    _render_lock = threading.Lock()
+
+    @classmethod
+    def _memoize(cls, key, render):
+        with cls._render_lock:
+            if key in cls._render_cache:
+                cls._render_cache.move_to_end(key)
+                return cls._render_cache[key]
+        text = render()
+        with cls._render_lock:
+            cls._render_cache[key] = text
+            if len(cls._render_cache) > cls.RENDER_CACHE_SIZE: cls._render_cache.popitem(last=False)
+        return text
+
     @staticmethod
     def build_system_prompt():
         return """你是一个智能助手，需要根据用户的偏好和历史记录提供个性化回复。
@@ -307,27 +2182,49 @@ class PromptBuilder:
         if preferences.get('additional_info') and preferences['additional_info'] != "None": context_parts.append(f"其他信息: {preferences['additional_info']}")
         return "\n".join(context_parts) if context_parts else "用户信息: 暂无特殊偏好"
 
+    @classmethod
+    def build_cached_user_context(cls, preferences):
+        """偏好文本按偏好内容缓存，修改配置后自动重新渲染"""
+        key = ("preferences", json.dumps(preferences, ensure_ascii=False, sort_keys=True))
+        return cls._memoize(key, lambda: cls.build_user_context(preferences))
+
     @staticmethod
-    def build_memory_context(memory_manager):
-        if not memory_manager.memory: return "永久记忆: 暂无"
-        memory_lines = ["永久记忆:"]
-        for mem_id, mem_data in memory_manager.memory.items():
+    def build_memory_line(mem_id, mem_data, detail="full"):
+        """渲染一条记忆；detail为full时带创建和修改时间，date时只带修改日期，none时不带时间"""
+        if detail == "full":
             created = mem_data['created_time'][:19].replace('T', ' ')
             modified = mem_data['last_modified'][:19].replace('T', ' ')
-            memory_lines.append(f"[{mem_id}] {mem_data['content']} (创建:{created}, 修改:{modified})")
-        return "\n".join(memory_lines)
+            return f"[{mem_id}] {mem_data['content']} (创建:{created}, 修改:{modified})"
+        if detail == "date": return f"[{mem_id}] {mem_data['content']} ({mem_data['last_modified'][:10]})"
+        return f"[{mem_id}] {mem_data['content']}"
+
+    @classmethod
+    def build_memory_context(cls, memory_manager, query=None, items=None, detail="full"):
+        """构建记忆上下文，可直接传入选好的记忆items；相同记忆版本下选中相同记忆时直接复用渲染结果"""
+        if not memory_manager.memory: return "永久记忆: 暂无"
+        if items is None: items = memory_manager.search_memory(query)
+        if not items: return "永久记忆: 无与当前输入相关的记忆"
+        def render():
+            return "\n".join(["永久记忆:"] + [cls.build_memory_line(mem_id, mem_data, detail) for mem_id, mem_data in items])
+        return cls._memoize(("memory", memory_manager.version, tuple(mem_id for mem_id, _ in items), detail), render)
 
     @staticmethod
     def build_chat_history_context(chat_history, limit=4):
+        """limit为None时包含传入的全部记录"""
         if not chat_history: return "聊天历史: 这是第一次对话"
         history_lines = ["最近的聊天记录:"]
-        recent_chats = chat_history[-limit:] if len(chat_history) > limit else chat_history
+        recent_chats = chat_history[-limit:] if limit and len(chat_history) > limit else chat_history
         for i, chat in enumerate(recent_chats, 1):
             history_lines.append(f"{i}. 用户: {chat['user']}")
             history_lines.append(f"   AI: {chat['ai']}")
             history_lines.append("")
         return "\n".join(history_lines)
 
+    @staticmethod
+    def build_summary_context(summary):
+        """较早对话的滚动摘要，没有摘要时为空"""
+        return f"较早的对话摘要:\n{summary}" if summary else ""
+
     @staticmethod
     def build_json_format_instruction():
         return """请严格按照以下JSON格式回复：
@@ -339,44 +2236,781 @@ class PromptBuilder:
 }"""
 
     @classmethod
-    def build_complete_prompt(cls, user_input, preferences, memory_manager, chat_history):
+    def build_complete_prompt(cls, user_input, preferences, memory_manager, chat_history, memory_context=None, history_limit=4, summary=""):
+        if memory_context is None: memory_context = cls.build_memory_context(memory_manager, user_input)
         current_time = datetime.now().strftime("%Y年%m月%d日 %H:%M:%S")
+        summary_parts = [cls.build_summary_context(summary), ""] if summary else []
         prompt_parts = [
             cls.build_system_prompt(), "", f"当前时间: {current_time}", "",
-            cls.build_user_context(preferences), "", cls.build_memory_context(memory_manager), "",
-            cls.build_chat_history_context(chat_history), "", f"用户当前输入: {user_input}", "",
+            cls.build_user_context(preferences), "", memory_context, "", *summary_parts,
+            cls.build_chat_history_context(chat_history, history_limit), "", f"用户当前输入: {user_input}", "",
             cls.build_json_format_instruction()
         ]
         return "\n".join(prompt_parts)
 
+    @classmethod
+    def build_static_system_message(cls):
+        """系统规则与回复格式说明，与用户和对话无关"""
+        return cls._memoize("system", lambda: cls.build_system_prompt() + "\n" + cls.build_json_format_instruction())
+
+    @classmethod
+    def build_messages(cls, user_input, preferences, memory_manager, chat_history, memory_context=None, history_limit=4, summary=""):
+        """构建结构化消息，按变化频率从低到高排列：固定的系统规则、偏好与记忆（以及较早对话的摘要）、聊天历史，
+        最后才是每轮都不同的当前时间和用户输入，使连续请求共享尽可能长的前缀以命中服务端提示词缓存"""
+        if memory_context is None: memory_context = cls.build_memory_context(memory_manager, user_input)
+        messages = [
+            {"role": "system", "content": cls.build_static_system_message()},
+            {"role": "system", "content": "\n\n".join(filter(None, [cls.build_cached_user_context(preferences), memory_context, cls.build_summary_context(summary)]))}
+        ]
+        for chat in chat_history[-history_limit:] if history_limit else chat_history:
+            messages.append({"role": "user", "content": chat['user']})
+            messages.append({"role": "assistant", "content": chat['ai']})
+        current_time = datetime.now().strftime("%Y年%m月%d日 %H:%M:%S")
+        messages.append({"role": "user", "content": f"当前时间: {current_time}\n\n用户当前输入: {user_input}"})
+        return messages
+
+
+class ContextPacker:
+    """按token预算组装上下文：先放最近几轮对话，再放相关记忆，剩余空间再放更早的对话；
+    空间紧张时记忆的时间戳依次压缩为日期、去掉，仍放不下时只保留最相关的若干条"""
+    TURN_OVERHEAD = 8 # 每轮对话的角色标记等额外开销
+    MEMORY_DETAILS = ("full", "date", "none")
+
+    def __init__(self, token_budget=3000, recent_turns=4, max_turns=20, min_reply_tokens=1024, max_reply_tokens=2000):
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.max_turns = max_turns
+        self.min_reply_tokens = min_reply_tokens
+        self.max_reply_tokens = max_reply_tokens
+
+    def turn_tokens(self, turn):
+        return estimate_tokens(turn['user']) + estimate_tokens(turn['ai']) + self.TURN_OVERHEAD
+
+    def _take_turns(self, turns, budget):
+        """从最新的一轮开始往前取，直到放不下，返回 (选中的轮次(新到旧), 用掉的token, 是否全部放下)"""
+        chosen, used = [], 0
+        for turn in reversed(turns):
+            cost = self.turn_tokens(turn)
+            if used + cost > budget: return chosen, used, False
+            chosen.append(turn)
+            used += cost
+        return chosen, used, True
+
+    def _pack_memory(self, memory_manager, items, budget):
+        """在预算内渲染尽可能详细的记忆上下文，返回 (记忆上下文, 用掉的token)"""
+        if not memory_manager.memory or not items:
+            context = PromptBuilder.build_memory_context(memory_manager, items=[])
+            return context, estimate_tokens(context)
+        for detail in self.MEMORY_DETAILS:
+            context = PromptBuilder.build_memory_context(memory_manager, items=items, detail=detail)
+            tokens = estimate_tokens(context)
+            if tokens <= budget: return context, tokens
+        # 最简格式也放不下时，按相关度从高到低保留
+        kept, used = [], estimate_tokens("永久记忆:")
+        for mem_id, mem_data in items:
+            cost = estimate_tokens(PromptBuilder.build_memory_line(mem_id, mem_data, "none")) + 1
+            if used + cost > budget: break
+            kept.append((mem_id, mem_data))
+            used += cost
+        context = PromptBuilder.build_memory_context(memory_manager, items=kept, detail="none")
+        return context, estimate_tokens(context)
+
+    def pack(self, memory_manager, memory_items, chat_history, fixed_texts):
+        """fixed_texts为必须完整发送的部分（系统规则、偏好、用户输入等），返回 (记忆上下文, 按时间顺序选中的聊天记录)"""
+        budget = self.token_budget - sum(estimate_tokens(text) for text in fixed_texts)
+        turns = chat_history[-self.max_turns:] if self.max_turns else chat_history
+        recent, older = turns[-self.recent_turns:], turns[:-self.recent_turns]
+        # 一条记忆都放不下时仍会发送一行占位说明，先为它留出空间
+        reserve = estimate_tokens(PromptBuilder.build_memory_context(memory_manager, items=[]))
+        chosen, used, complete = self._take_turns(recent, budget - reserve)
+        budget -= used
+        memory_context, used = self._pack_memory(memory_manager, memory_items, max(0, budget))
+        budget -= used
+        # 最近的几轮全部放下后，才用剩余空间补充更早的对话，保证历史连续
+        if complete and older: chosen += self._take_turns(older, budget)[0]
+        return memory_context, chosen[::-1]
+
+    def reply_tokens(self, chat_history):
+        """按最近几次回复的长度确定max_tokens：取最长回复的两倍再加上JSON格式和记忆操作的余量"""
+        recent = chat_history[-self.recent_turns:]
+        if not recent: return self.max_reply_tokens
+        longest = max(estimate_tokens(turn['ai']) for turn in recent)
+        return max(self.min_reply_tokens, min(self.max_reply_tokens, longest * 2 + 256))
+
+
+class HistorySummarizer:
+    """滚动对话摘要：移出最近keep_turns轮的对话每积累batch_turns轮，就在后台事件循环中合并进持久化的摘要；
+    前台对话只读取已有的摘要，从不等待摘要生成"""
+    def __init__(self, config_manager, async_loop, summarize, keep_turns=8, batch_turns=4, max_fold_turns=20):
+        self.config_manager = config_manager
+        self.async_loop = async_loop
+        self.summarize = summarize # 协程函数 (已有摘要, 若干轮对话) -> 新摘要
+        self.keep_turns = max(1, keep_turns)
+        self.batch_turns = max(1, batch_turns)
+        self.max_fold_turns = max_fold_turns # 单次合并的轮数上限，积压较多时分批合并
+        self.state = config_manager.load_summary() or self.empty_state()
+        self._lock = threading.Lock()
+        self._running = False
+        self._latest = None # 合并进行期间到达的最新聊天记录
+        self._generation = 0 # 清空聊天记录后丢弃仍在进行的合并结果
+
+    @staticmethod
+    def empty_state():
+        return {"text": "", "covered_until": "", "turns": 0}
+
+    @property
+    def text(self):
+        return self.state["text"]
+
+    def unsummarized(self, chat_history):
+        """尚未并入摘要的对话（按时间戳判断）"""
+        covered_until = self.state["covered_until"]
+        if not covered_until:
+            return chat_history
+        return [turn for turn in chat_history if turn.get('timestamp', '') > covered_until]
+
+    def schedule(self, chat_history):
+        """每轮对话保存后调用；待合并的对话够一批时提交后台合并，已有合并在进行时只记下最新的聊天记录"""
+        history = list(chat_history)
+        with self._lock:
+            if self._running:
+                self._latest = history
+                return
+            pending = self.unsummarized(history[:-self.keep_turns])
+            if len(pending) < self.batch_turns:
+                return
+            self._running = True
+            generation = self._generation
+        self.async_loop.submit(self._fold(pending[:self.max_fold_turns], history, generation))
+
+    async def _fold(self, turns, history, generation):
+        """后台合并一批对话并保存；失败时保留原摘要，下一轮对话后重试"""
+        start_time = time.perf_counter()
+        succeeded = False
+        try:
+            text = await self.summarize(self.state["text"], turns)
+            state = {
+                "text": text,
+                "covered_until": turns[-1].get('timestamp', ''),
+                "turns": self.state["turns"] + len(turns),
+                "updated": datetime.now().isoformat()
+            }
+            with self._lock:
+                succeeded = generation == self._generation
+                if succeeded:
+                    self.state = state
+            if succeeded:
+                self.config_manager.save_summary(state)
+                logger.info(f"已将 {len(turns)} 轮较早的对话并入摘要（累计 {state['turns']} 轮, {len(text)} 字, 用时 {time.perf_counter() - start_time:.1f}s）")
+        except Exception as e:
+            logger.warning(f"更新对话摘要失败，将在下一轮对话后重试: {e}")
+        with self._lock:
+            self._running = False
+            latest, self._latest = self._latest, None
+        # 期间有新对话或仍有积压时继续合并
+        if succeeded:
+            self.schedule(latest or history)
+
+    def reset(self):
+        """清空聊天记录时同时清空摘要"""
+        with self._lock:
+            self._generation += 1
+            self._latest = None
+            self.state = self.empty_state()
+        self.config_manager.save_summary(self.state)
+
+    def close(self):
+        """停止后续合并并丢弃仍在进行的合并结果，避免与新的摘要器同时写入摘要"""
+        with self._lock:
+            self._generation += 1
+            self._latest = None
+
+class StreamingResponseParser:
+    """流式JSON解析类，从逐块到达的JSON中增量提取顶层 response 字段"""
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, field="response"):
+        self.field = field
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escape = None
+        self.expect_key = False
+        self.after_colon = False
+        self.string_chars = []
+        self.last_key = None
+        self.capturing = False
+        self.done = False
+        self.pending_high = None
+
+    def feed(self, chunk):
+        """输入新的文本块，返回本次新解析出的 response 文本"""
+        self.buffer.append(chunk)
+        output = []
+        for ch in chunk:
+            if self.in_string:
+                self._feed_string_char(ch, output)
+                continue
+            if ch == '"':
+                self.in_string = True
+                self.string_chars = []
+                # 顶层 response 字段的字符串值开始
+                self.capturing = self.depth == 1 and self.after_colon and self.last_key == self.field and not self.done
+                self.after_colon = False
+            elif ch in '{[':
+                self.depth += 1
+                self.expect_key = ch == '{' and self.depth == 1
+                self.after_colon = False
+            elif ch in '}]':
+                self.depth -= 1
+                self.after_colon = False
+            elif ch == ',' and self.depth == 1:
+                self.expect_key = True
+                self.after_colon = False
+            elif ch == ':' and self.depth == 1:
+                self.after_colon = True
+            elif not ch.isspace():
+                self.after_colon = False
+        return "".join(output)
+
+    def _feed_string_char(self, ch, output):
+        """处理字符串内部的字符（含转义序列）"""
+        target = output if self.capturing else self.string_chars
+        if self.escape is not None:
+            if self.escape == "":
+                if ch == 'u':
+                    self.escape = "u"
+                    return
+                self.escape = None
+                self._emit(self.ESCAPES.get(ch, ch), target)
+                return
+            self.escape += ch
+            if len(self.escape) == 5:
+                hex_digits, self.escape = self.escape[1:], None
+                try:
+                    code = int(hex_digits, 16)
+                except ValueError:
+                    return
+                if 0xD800 <= code <= 0xDBFF:
+                    self.pending_high = code
+                    return
+                if 0xDC00 <= code <= 0xDFFF and self.pending_high is not None:
+                    code = 0x10000 + ((self.pending_high - 0xD800) << 10) + (code - 0xDC00)
+                    self.pending_high = None
+                self._emit(chr(code), target)
+            return
+        if ch == '\\':
+            self.escape = ""
+        elif ch == '"':
+            self.in_string = False
+            if self.capturing:
+                self.capturing = False
+                self.done = True
+            elif self.depth == 1 and self.expect_key:
+                self.last_key = "".join(self.string_chars)
+                self.expect_key = False
+        else:
+            self._emit(ch, target)
+
+    def _emit(self, text, target):
+        """输出解码后的字符，丢弃未配对的代理项"""
+        self.pending_high = None
+        target.append(text)
+
+    @property
+    def text(self):
+        """目前为止收到的完整原始文本"""
+        return "".join(self.buffer)
+
+
+class ConversationEngine:
+    """异步对话引擎：把一轮对话拆成可等待的阶段，互不依赖的阶段（图片分析、记忆检索、音色刷新）并发执行"""
+    def __init__(self, openai_key, api_gateway, siliconflow_key, file_processor, memory_manager, voice_manager=None,
+                 prompt_layout="messages", report_usage=True, packer=None, summary_model="gpt-4o", summary_max_chars=600):
+        self.openai_key = openai_key
+        self.api_gateway = api_gateway
+        self.siliconflow_key = siliconflow_key
+        self.file_processor = file_processor
+        self.memory_manager = memory_manager
+        self.voice_manager = voice_manager
+        self.prompt_layout = prompt_layout # messages: 分层的结构化消息；single: 旧版单条用户消息
+        self.report_usage = report_usage # 流式请求时让服务端在最后返回token用量
+        self.packer = packer or ContextPacker()
+        self.summarizer = None # HistorySummarizer，未启用滚动摘要时为None
+        self.summary_model = summary_model
+        self.summary_max_chars = summary_max_chars
+        self.voice_refresh = None # 最近一次启动的音色列表刷新任务，直到需要语音时才等待
+        self.voice_ready = None # 最近一次成功完成的刷新任务
+        self.voice_refreshed_at = 0.0
+
+    @property
+    def chat_client(self):
+        """对话模型的异步客户端，在事件循环线程中首次使用时才创建"""
+        return client_registry.get_async_openai(self.openai_key, self.api_gateway)
+
+    @property
+    def vision_client(self):
+        """图片分析的异步客户端"""
+        return client_registry.get_async_openai(self.siliconflow_key, SILICONFLOW_BASE_URL)
+
+    def _voice_stage(self):
+        """返回音色列表刷新任务：首次调用时在后台启动刷新；上次刷新超过目录有效期后重新刷新，
+        期间继续返回上一次的结果，不让对话等待新的刷新"""
+        pending = self.voice_refresh is not None and not self.voice_refresh.done()
+        expired = time.monotonic() - self.voice_refreshed_at >= self.voice_manager.catalog_ttl_seconds
+        if not pending and (self.voice_ready is None or expired):
+            self.voice_refresh = asyncio.ensure_future(asyncio.to_thread(self.voice_manager.refresh_voices))
+            self.voice_refresh.add_done_callback(self._voices_refreshed)
+        return self.voice_ready or self.voice_refresh
+
+    def _voices_refreshed(self, task):
+        """刷新成功后记录结果与完成时间；失败时保留上一次的结果，下次调用会重试"""
+        if not task.cancelled() and task.exception() is None:
+            self.voice_ready = task
+            self.voice_refreshed_at = time.monotonic()
+
+    def close(self):
+        """重新初始化客户端时由旧引擎调用，停止其后台摘要"""
+        if self.summarizer:
+            self.summarizer.close()
+
+    async def load_voices(self):
+        """等待音色列表刷新完成，返回音色名称列表"""
+        if not self.voice_manager: return []
+        return await self._voice_stage()
+
+    @staticmethod
+    def compose_input(user_input, file_paths, analyses):
+        """按附件顺序拼接图片分析结果，非图片附件只注明文件名"""
+        processed_input = user_input
+        for file_path in file_paths:
+            if file_path in analyses:
+                processed_input += f"\n\n[图片分析结果 ({os.path.basename(file_path)})]:\n{analyses[file_path]}"
+            else:
+                processed_input += f"\n\n[附加文件: {os.path.basename(file_path)}]"
+        return processed_input
+
+    async def run_turn(self, user_input, file_paths, preferences, chat_history, on_delta=None, streaming=True, metrics=None):
+        """执行一轮对话直到拿到模型回复，返回原始回复文本；各阶段耗时记录到metrics"""
+        metrics = metrics or TurnMetrics()
+        if self.voice_manager: self._voice_stage()
+        image_paths = [path for path in file_paths if self.file_processor.is_image_file(path)]
+        if image_paths: logger.info(f"开始分析图片: {', '.join(image_paths)}")
+
+        # 图片分析与记忆检索互不依赖，并发执行；记忆按用户原话检索
+        # 没有图片时不创建视觉模型的客户端
+        if image_paths: image_stage = metrics.timed("image_analysis", self.file_processor.analyze_images_async(image_paths, self.vision_client))
+        else: image_stage = asyncio.sleep(0, result=[])
+        analyses, memory_items = await asyncio.gather(
+            image_stage,
+            metrics.timed("memory_search", asyncio.to_thread(self.memory_manager.search_memory, user_input))
+        )
+        if image_paths: logger.info("图片分析完成。")
+
+        logger.info("开始构建完整的提示词...")
+        with metrics.span("prompt_build"):
+            composed_input = self.compose_input(user_input, file_paths, dict(zip(image_paths, analyses)))
+            # 已并入摘要的对话由摘要代替，其余的在token预算内挑选
+            summary = self.summarizer.text if self.summarizer else ""
+            candidates = self.summarizer.unsummarized(chat_history) if self.summarizer else chat_history
+            memory_context, history = self.packer.pack(
+                self.memory_manager, memory_items, candidates,
+                [PromptBuilder.build_static_system_message(), PromptBuilder.build_cached_user_context(preferences),
+                 PromptBuilder.build_summary_context(summary), composed_input]
+            )
+            build = PromptBuilder.build_complete_prompt if self.prompt_layout == "single" else PromptBuilder.build_messages
+            prompt = build(composed_input, preferences, self.memory_manager, history, memory_context=memory_context, history_limit=None, summary=summary)
+            messages = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+        logger.debug("上下文: 记忆 %d 条候选, 历史 %d/%d 轮", len(memory_items), len(history), len(chat_history))
+        with metrics.span("llm_request"):
+            return await self.complete(messages, on_delta, streaming, metrics, self.packer.reply_tokens(history))
+
+    def record_usage(self, usage, metrics=None):
+        """记录token用量与提示词缓存命中情况"""
+        if usage is None: return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        prompt_tokens = usage.prompt_tokens or 0
+        if metrics: metrics.record_usage(prompt_tokens, cached_tokens, usage.completion_tokens or 0)
+        if prompt_tokens: logger.info(f"提示词缓存命中: {cached_tokens}/{prompt_tokens} tokens ({cached_tokens / prompt_tokens:.0%})")
+
+    async def complete(self, messages, on_delta=None, streaming=True, metrics=None, max_tokens=2000):
+        """调用对话模型；流式模式下每解析出新的response文本就回调on_delta"""
+        request_payload = {
+            "model": "gpt-4o",
+            "messages": messages,
+            "response_format": {"type": "json_object"},
+            "max_tokens": max_tokens
+        }
+        if streaming and self.report_usage: request_payload["stream_options"] = {"include_usage": True}
+        logger.debug("发送到 OpenAI 的请求体:\n%s", LazyJson(request_payload))
+        logger.info("正在向 OpenAI 发送请求...")
+        if not streaming:
+            response = await self.chat_client.chat.completions.create(**request_payload, timeout=120)
+            logger.info("已收到 OpenAI 的回复。")
+            self.record_usage(response.usage, metrics)
+            return response.choices[0].message.content
+    
+        parser = StreamingResponseParser()
+        start_time = time.perf_counter()
+        first_token_time = None
+    
+        try:
+            stream = await self.chat_client.chat.completions.create(**request_payload, stream=True, timeout=120)
+        except openai.BadRequestError as e:
+            if "stream_options" not in request_payload: raise
+            # 部分网关不接受stream_options，本次会话内不再请求用量并重试
+            logger.warning(f"网关拒绝stream_options，已关闭用量统计: {e}")
+            self.report_usage = False
+            del request_payload["stream_options"]
+            stream = await self.chat_client.chat.completions.create(**request_payload, stream=True, timeout=120)
+        async for chunk in stream:
+            if chunk.usage: self.record_usage(chunk.usage, metrics)
+            if not chunk.choices: continue
+            delta = chunk.choices[0].delta.content
+            if not delta: continue
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+                logger.info(f"首字延迟(TTFT): {first_token_time - start_time:.2f}s")
+                if metrics: metrics.record("ttft", (first_token_time - start_time) * 1000)
+        
+            new_text = parser.feed(delta)
+            if new_text and on_delta: on_delta(new_text)
+    
+        logger.debug(f"流式回复完成，总耗时: {time.perf_counter() - start_time:.2f}s")
+        return parser.text
+
+    async def summarize(self, summary, turns):
+        """把若干轮对话合并进已有摘要，返回新摘要"""
+        dialogue = "\n\n".join(f"用户: {turn['user']}\nAI: {turn['ai']}" for turn in turns)
+        messages = [
+            {"role": "system", "content": f"你负责维护一段对话摘要。把新的对话合并进已有摘要，保留用户的目标、已做的决定、提到的事实和未完成的事项，"
+                                          f"删去寒暄和重复内容，不超过{self.summary_max_chars}字，只输出摘要本身。"},
+            {"role": "user", "content": f"已有摘要:\n{summary or '暂无'}\n\n新的对话:\n{dialogue}"}
+        ]
+        response = await self.chat_client.chat.completions.create(model=self.summary_model, messages=messages, max_tokens=self.summary_max_chars * 2, timeout=120)
+        return response.choices[0].message.content.strip()
+
+    async def speak(self, text, speed, on_audio, pipelined=True, metrics=None):
+        """语音阶段：合成的每段音频就绪后立即回调on_audio，分段模式下首句合成完成即可开始播放"""
+        metrics = metrics or TurnMetrics()
+        def synthesize():
+            if pipelined:
+                voice_files = self.voice_manager.synthesize_pipelined(text, speed, metrics=metrics)
+            else:
+                voice_files = [self.voice_manager.text_to_speech(text, speed, metrics)]
+            for voice_file in voice_files:
+                if voice_file: on_audio(voice_file)
+
+        with metrics.span("tts_synthesis"):
+            await asyncio.to_thread(synthesize)
+
 
 # --- GUI 主应用 ---
 
+STREAM_REDRAW_MS = 50 # 流式输出时AI气泡的最小重绘间隔(毫秒)
+HISTORY_PAGE_SIZE = 20 # 每次从存储读取的聊天记录轮数
+HISTORY_RENDER_BATCH = 10 # 每个空闲回调渲染的消息条数
+
+
+def earlier_turns(page, chat_history):
+    """首页记录中早于内存中对话的部分：读取期间发送的对话已写入存储，也会出现在页中，按ID或时间戳去掉"""
+    ids = {turn['id'] for turn in chat_history if turn.get('id') is not None}
+    timestamps = {turn['timestamp'] for turn in chat_history if turn.get('timestamp')}
+    return [turn for turn in page if turn.get('id') not in ids and turn.get('timestamp') not in timestamps]
+
+
+class ChatView(ctk.CTkFrame):
+    """虚拟化的消息列表：只为可见区域及上下少量缓冲行创建气泡控件，滚动时回收复用，控件数量与消息总数无关"""
+    BUFFER_ROWS = 4 # 可见区域上下额外渲染的行数
+    ROW_SPACING = 4 # 行间距(像素)
+    RESIZE_DEBOUNCE_MS = 120 # 窗口大小停止变化后才重新换行
+
+    def __init__(self, master, title="对话", on_near_top=None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.on_near_top = on_near_top # 滚动到距顶部不足一屏时回调，用于加载更早的记录
+        self.grid_rowconfigure(1, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+        ctk.CTkLabel(self, text=title).grid(row=0, column=0, columnspan=2, pady=(5, 0))
+
+        self.canvas = ctk.CTkCanvas(self, highlightthickness=0, yscrollincrement=20,
+                                    bg=self._apply_appearance_mode(self._fg_color))
+        self.canvas.grid(row=1, column=0, sticky="nsew", padx=(5, 0), pady=5)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.canvas.yview)
+        self.scrollbar.grid(row=1, column=1, sticky="ns", pady=5)
+        self.canvas.configure(yscrollcommand=self._on_yview)
+
+        self.messages = [] # [{"sender", "text", "widths", "height", "wrap", "measured", "version"}]，wrap与当前换行宽度不同的高度已过期
+        self.offsets = [0] # offsets[i] 为第i条消息顶部的y坐标，最后一项为内容总高度
+        self.rows = {} # 消息下标 -> 正在显示该消息的行控件
+        self.pool = [] # 空闲的行控件
+        self.wraplength = 400
+        font = ctk.CTkFont()
+        self.char_width = max(1, font.measure("0"))
+        self.line_height = max(1, font.metrics("linespace"))
+        self._width = 0
+        self._render_job = None
+        self._measure_job = None
+        self._resize_job = None
+
+        self.canvas.bind("<Configure>", self._on_configure)
+        self._bind_scroll(self.canvas)
+
+    # -- 对外接口 --
+    def add_message(self, sender, text):
+        """追加一条消息并滚动到底部，返回消息记录（用于之后更新文本）"""
+        message = self._new_message(sender, text)
+        self.messages.append(message)
+        self._relayout()
+        self.scroll_to_bottom()
+        return message
+
+    def prepend_messages(self, messages):
+        """在顶部插入更早的消息 [(发送者, 文本)]，当前可见的内容保持不动"""
+        if not messages: return
+        follow = self._at_bottom()
+        top = self.canvas.canvasy(0)
+        records = [self._new_message(sender, text) for sender, text in messages]
+        self.messages[:0] = records
+        self.rows = {index + len(records): row for index, row in self.rows.items()}
+        self._relayout()
+        if follow: self.scroll_to_bottom()
+        else: self._scroll_to_y(top + self.offsets[len(records)])
+
+    def update_message(self, message, text):
+        """更新一条消息的文本（流式输出），位于底部时保持跟随"""
+        if message["text"] == text: return
+        follow = self._at_bottom()
+        message.update(text=text, widths=self._paragraph_widths(text), version=message["version"] + 1)
+        self._reestimate(message)
+        self._relayout()
+        if follow: self.scroll_to_bottom()
+        else: self._schedule_render()
+
+    def clear(self):
+        """清空全部消息"""
+        for index in list(self.rows): self._release(index)
+        self.messages.clear()
+        self._relayout()
+
+    def scroll_to_bottom(self):
+        self.canvas.yview_moveto(1.0)
+        self._schedule_render()
+
+    def _scroll_to_y(self, y):
+        self.canvas.yview_moveto(y / max(1, self.offsets[-1], self.canvas.winfo_height()))
+        self._schedule_render()
+
+    # -- 高度估算与布局 --
+    def _new_message(self, sender, text):
+        message = {"sender": sender, "text": text, "widths": self._paragraph_widths(text), "version": 0}
+        self._reestimate(message)
+        return message
+
+    @staticmethod
+    def _paragraph_widths(text):
+        """每个段落的宽度（以半角字符计，全角字符按2计），换行宽度变化时据此重新估算行数"""
+        return [sum(2 if unicodedata.east_asian_width(ch) in "WF" else 1 for ch in paragraph) for paragraph in text.split("\n")]
+
+    def _estimate_height(self, message):
+        """未实际渲染前按换行宽度估算气泡高度：发送者一行 + 正文行数 + 内边距"""
+        chars_per_line = max(1, self.wraplength // self.char_width)
+        lines = sum(max(1, math.ceil(width / chars_per_line)) for width in message["widths"])
+        return (lines + 1) * self.line_height + 20
+
+    def _reestimate(self, message):
+        """按当前换行宽度重新估算高度，渲染后再测量实际高度"""
+        message.update(height=self._estimate_height(message), wrap=self.wraplength, measured=False)
+
+    def _relayout(self):
+        """重新计算所有消息的位置和滚动区域"""
+        self.offsets = [0, *itertools.accumulate(message["height"] + self.ROW_SPACING for message in self.messages)]
+        height = max(self.offsets[-1], self.canvas.winfo_height())
+        self.canvas.configure(scrollregion=(0, 0, self._width, height))
+        for index, row in self.rows.items(): self._place(row, index)
+
+    def _at_bottom(self):
+        return self.canvas.yview()[1] >= 0.999
+
+    # -- 渲染与控件复用 --
+    def _on_yview(self, first, last):
+        self.scrollbar.set(first, last)
+        self._schedule_render()
+        if self.on_near_top and self.messages and self.canvas.canvasy(0) < self.canvas.winfo_height():
+            self.on_near_top()
+
+    def _schedule_render(self):
+        if self._render_job is None:
+            self._render_job = self.after_idle(self._render)
+
+    def _render(self):
+        """只为可见范围（含缓冲行）绑定行控件，离开范围的行回收到空闲池"""
+        self._render_job = None
+        if not self.messages: return
+        first, last = self._refresh_stale()
+        for index in [index for index in self.rows if index < first or index > last]:
+            self._release(index)
+        for index in range(first, last + 1):
+            row = self.rows.get(index)
+            if row is None:
+                row = self.pool.pop() if self.pool else self._create_row()
+                self.rows[index] = row
+            self._bind(row, index)
+        if self._measure_job is None and any(not self.messages[index]["measured"] for index in self.rows):
+            self._measure_job = self.after_idle(self._measure)
+
+    def _visible_range(self):
+        """可见范围（含缓冲行）的首尾消息下标"""
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first = max(0, bisect.bisect_right(self.offsets, top) - 1 - self.BUFFER_ROWS)
+        last = min(len(self.messages) - 1, bisect.bisect_left(self.offsets, bottom) + self.BUFFER_ROWS)
+        return first, last
+
+    def _refresh_stale(self):
+        """按新宽度重新估算进入可见范围的过期消息，顶部消息保持不动，直到范围内不再有过期消息"""
+        while True:
+            first, last = self._visible_range()
+            stale = [index for index in range(first, last + 1) if self.messages[index]["wrap"] != self.wraplength]
+            if not stale: return first, last
+            follow = self._at_bottom()
+            top = self.canvas.canvasy(0)
+            anchor = max(0, bisect.bisect_right(self.offsets, top) - 1)
+            shift = top - self.offsets[anchor]
+            for index in stale: self._reestimate(self.messages[index])
+            self._relayout()
+            if follow: self.canvas.yview_moveto(1.0)
+            else: self.canvas.yview_moveto((self.offsets[anchor] + shift) / max(1, self.offsets[-1], self.canvas.winfo_height()))
+
+    def _create_row(self):
+        frame = ctk.CTkFrame(self.canvas, corner_radius=10)
+        sender = ctk.CTkLabel(frame, text="", font=ctk.CTkFont(weight="bold"))
+        sender.pack(anchor="w", padx=10, pady=(5, 0))
+        body = ctk.CTkLabel(frame, text="", justify="left", wraplength=self.wraplength)
+        body.pack(anchor="w", fill="x", padx=10, pady=(0, 5))
+        for widget in (frame, sender, body): self._bind_scroll(widget)
+        window = self.canvas.create_window(0, 0, window=frame, anchor="nw", state="hidden")
+        return {"frame": frame, "sender": sender, "body": body, "window": window, "key": None}
+
+    def _bind(self, row, index):
+        """把行控件绑定到指定消息；内容与换行宽度都未变时跳过重新配置"""
+        message = self.messages[index]
+        key = (id(message), message["version"], self.wraplength)
+        if row["key"] != key:
+            is_user = message["sender"] == "您"
+            row["frame"].configure(fg_color=("#dcdcdc", "#333333") if is_user else ("#efefef", "#2b2b2b"))
+            row["sender"].configure(text=f"{message['sender']}:")
+            row["body"].configure(text=message["text"], wraplength=self.wraplength)
+            row["key"] = key
+        self._place(row, index)
+
+    def _place(self, row, index):
+        # 用户消息靠右，其余靠左，另一侧留出50像素空白
+        is_user = self.messages[index]["sender"] == "您"
+        self.canvas.coords(row["window"], self._width - 5 if is_user else 5, self.offsets[index])
+        self.canvas.itemconfigure(row["window"], anchor="ne" if is_user else "nw", state="normal")
+
+    def _release(self, index):
+        row = self.rows.pop(index)
+        self.canvas.itemconfigure(row["window"], state="hidden")
+        self.pool.append(row)
+
+    def _measure(self):
+        """用已渲染气泡的实际高度替换估算值，有变化时重新布局"""
+        self._measure_job = None
+        changed = False
+        for index, row in self.rows.items():
+            message = self.messages[index]
+            height = row["frame"].winfo_reqheight()
+            message.update(measured=True, wrap=self.wraplength)
+            if height > 1 and abs(height - message["height"]) > 1:
+                message["height"] = height
+                changed = True
+        if changed:
+            follow = self._at_bottom()
+            self._relayout()
+            if follow: self.scroll_to_bottom()
+            else: self._schedule_render()
+
+    # -- 尺寸变化与滚轮 --
+    def _on_configure(self, event):
+        if self._width == 0:
+            self._apply_resize(event.width) # 首次显示时立即确定宽度
+        elif event.width != self._width:
+            # 宽度变化时防抖：停止拖动后才重新估算可见行的高度并重绘
+            if self._resize_job is not None: self.after_cancel(self._resize_job)
+            self._resize_job = self.after(self.RESIZE_DEBOUNCE_MS, self._apply_resize, event.width)
+        else:
+            self._relayout()
+            self._schedule_render()
+
+    def _apply_resize(self, width):
+        """只重新估算可见范围（含缓冲行，顶部锚点消息也在其中）的高度；其余消息保留旧高度，
+        因换行宽度不同而视为过期，滚动到它们时再估算（见_refresh_stale）"""
+        self._resize_job = None
+        first, last = self._visible_range()
+        anchor = max(0, bisect.bisect_right(self.offsets, self.canvas.canvasy(0)) - 1)
+        follow = self._at_bottom()
+        self._width = width
+        self.wraplength = max(100, width - 80) # 减去各种内边距，确保文本不会紧贴边缘
+        for index in range(first, last + 1): self._reestimate(self.messages[index])
+        self._relayout()
+        if follow or not self.messages:
+            self.scroll_to_bottom()
+        else:
+            # 保持原先位于顶部的消息仍在顶部
+            self._scroll_to_y(self.offsets[anchor])
+
+    def _bind_scroll(self, widget):
+        widget.bind("<MouseWheel>", self._on_mousewheel)
+        widget.bind("<Button-4>", self._on_mousewheel)
+        widget.bind("<Button-5>", self._on_mousewheel)
+
+    def _on_mousewheel(self, event):
+        if event.num == 4: steps = -1
+        elif event.num == 5: steps = 1
+        elif abs(event.delta) >= 120: steps = -event.delta // 120 # Windows
+        else: steps = -event.delta # macOS
+        self.canvas.yview_scroll(steps * 3, "units")
+
+
 class App(ctk.CTk):
     def __init__(self):
         super().__init__()
         self.title("PVenus GUI")
         self.geometry("1200x800")
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
+        startup_timer.mark("创建主窗口")
         
         # 初始化
-        pygame.mixer.init()
+        self.speech_player = SpeechPlayer(release=self.release_audio_file)
+        self.speech_synthesizing = False # 分段合成是否仍在进行
+        self.speech_start_time = None
+        self.tts_pipelined = True
         self.config_manager = ConfigManager()
         self.memory_manager = MemoryManager(self.config_manager)
-        self.openai_client = None
+        self.engine = None
+        self.async_loop = AsyncLoopThread() # 对话引擎运行在后台事件循环中
+        self.metrics = MetricsRecorder(os.path.join("logs", "metrics.jsonl"))
+        self.turn_metrics = None # 正在合成语音的一轮对话的指标，语音合成结束后写入
         self.file_processor = None
         self.voice_manager = None
         self.chat_history = []
-        self.attached_file_path = None
-        self.chat_bubbles = [] # 用于存储所有消息气泡以更新换行
+        self.history_cursor = None # 已显示的最早一轮记录的ID，向上翻页时从这里继续读取
+        self.history_loading = False
+        self.history_exhausted = True
+        self.attached_file_paths = []
+        self.streaming_enabled = True
+        startup_timer.mark("加载存储与记忆")
         
         # 创建组件
         self.create_widgets()
         self.setup_gui_logger()
+        startup_timer.mark("创建界面")
+        self.after_idle(startup_timer.mark, "首次绘制")
         
         # 加载配置
         self.after(100, self.load_and_initialize)
-        self.bind("<Configure>", self.on_chat_resize) # 绑定窗口大小调整事件
 
     def create_widgets(self):
         # ... UI布局 ...
@@ -416,7 +3050,9 @@ class App(ctk.CTk):
         self.settings_frame = ctk.CTkFrame(self.left_frame)
         self.settings_frame.grid(row=1, column=0, padx=10, pady=(0, 10), sticky="ew")
         self.settings_button = ctk.CTkButton(self.settings_frame, text="打开设置", command=self.open_settings_window)
-        self.settings_button.pack(fill="x", padx=10, pady=10)
+        self.settings_button.pack(fill="x", padx=10, pady=(10, 5))
+        self.stats_button = ctk.CTkButton(self.settings_frame, text="性能统计", command=self.open_stats_window)
+        self.stats_button.pack(fill="x", padx=10, pady=(5, 10))
 
         # -- 右侧聊天面板 --
         self.right_frame = ctk.CTkFrame(self, corner_radius=0)
@@ -424,8 +3060,8 @@ class App(ctk.CTk):
         self.right_frame.grid_rowconfigure(0, weight=1)
         self.right_frame.grid_columnconfigure(0, weight=1)
 
-        self.chat_box = ctk.CTkScrollableFrame(self.right_frame, label_text="对话")
-        self.chat_box.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+        self.chat_view = ChatView(self.right_frame, title="对话", on_near_top=self.load_older_history)
+        self.chat_view.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
         
         self.input_frame = ctk.CTkFrame(self.right_frame, fg_color="transparent")
         self.input_frame.grid(row=1, column=0, padx=10, pady=10, sticky="sew")
@@ -448,27 +3084,64 @@ class App(ctk.CTk):
         log_frame.grid_rowconfigure(1, weight=1)
         log_frame.grid_columnconfigure(0, weight=1)
         
-        ctk.CTkLabel(log_frame, text="日志输出").grid(row=0, column=0, padx=10, pady=5)
+        ctk.CTkLabel(log_frame, text="日志输出").grid(row=0, column=0, padx=10, pady=5, sticky="w")
+        self.log_level_selector = ctk.CTkOptionMenu(log_frame, values=LOG_LEVELS, width=100, command=self.set_gui_log_level)
+        self.log_level_selector.grid(row=0, column=1, padx=10, pady=5, sticky="e")
         
         log_textbox = ctk.CTkTextbox(log_frame, wrap=tkinter.WORD)
-        log_textbox.grid(row=1, column=0, padx=10, pady=(0,10), sticky="nsew")
+        log_textbox.grid(row=1, column=0, columnspan=2, padx=10, pady=(0,10), sticky="nsew")
         
-        gui_handler = GuiLogger(log_textbox)
-        gui_handler.setFormatter(formatter)
-        logger.addHandler(gui_handler)
+        self.gui_handler = GuiLogger(log_textbox)
+        self.gui_handler.setFormatter(formatter)
+        logger.addHandler(self.gui_handler)
+        self.set_gui_log_level("INFO")
+
+    def set_gui_log_level(self, level):
+        """设置日志输出框显示的最低级别"""
+        self.gui_handler.setLevel(level)
+        self.log_level_selector.set(level)
+        sync_logger_level()
+
+    def open_stats_window(self):
+        """打开性能统计面板，显示最近各轮对话每个阶段耗时的p50/p95/p99，窗口打开期间定时刷新"""
+        if hasattr(self, 'stats_window') and self.stats_window.winfo_exists():
+            self.stats_window.focus()
+            return
+
+        self.stats_window = ctk.CTkToplevel(self)
+        self.stats_window.title("性能统计")
+        self.stats_window.geometry("460x360")
+        self.stats_window.transient(self)
+
+        stats_textbox = ctk.CTkTextbox(self.stats_window, font=ctk.CTkFont(family="Consolas"), wrap="none")
+        stats_textbox.pack(fill="both", expand=True, padx=15, pady=15)
+
+        def refresh():
+            if not self.stats_window.winfo_exists(): return
+            stats_textbox.configure(state="normal")
+            stats_textbox.delete("1.0", tkinter.END)
+            stats_textbox.insert("1.0", self.metrics.format_summary())
+            stats_textbox.configure(state="disabled")
+            self.stats_window.after(2000, refresh)
+
+        refresh()
 
     # ... 其他方法 ...
 
     def load_and_initialize(self):
         """加载配置并初始化客户端"""
+        startup_timer.skip() # 首次绘制后的空闲等待不计入
         config = self.config_manager.load_config()
         if not config or not config.get('siliconflow_key') or not config.get('openai_key'):
             logger.warning("未找到有效配置，需要用户输入。")
+            startup_timer.report()
             self.open_settings_window(is_initial_setup=True)
             return
 
         self.setup_clients(config)
         self.load_chat_history()
+        startup_timer.mark("加载配置与客户端")
+        startup_timer.report()
 
     def open_settings_window(self, is_initial_setup=False):
         """打开设置窗口，用于输入API Keys和用户偏好。"""
@@ -536,11 +3209,15 @@ class App(ctk.CTk):
         info_entry.insert("1.0", current_prefs.get("additional_info", "None"))
         
         def save_and_close():
+            # 在已有配置上更新界面中的字段，保留配置文件中其他的调优项
+            saved_config = self.config_manager.load_config() or {}
             new_config = {
+                **saved_config,
                 "siliconflow_key": sf_key_entry.get(),
                 "openai_key": oai_key_entry.get(),
                 "openai_api_gateway": oai_gw_entry.get(),
                 "preferences": {
+                    **saved_config.get("preferences", {}),
                     "profession": profession_entry.get(),
                     "preferred_title": title_entry.get(),
                     "reply_style": style_entry.get(),
@@ -569,21 +3246,93 @@ class App(ctk.CTk):
             logger.error("API Keys不完整，客户端初始化失败。")
             return
 
-        self.file_processor = FileProcessor(sf_key)
-        self.voice_manager = VoiceManager(sf_key)
-        self.openai_client = OpenAI(api_key=oai_key, base_url=oai_gw)
+        self.streaming_enabled = config.get('streaming', True)
+        self.tts_pipelined = config.get('tts_pipelined', True)
+        file_handler.setLevel(config.get('file_log_level', "INFO"))
+        sync_logger_level()
+        self.metrics.configure(
+            max_bytes=config.get('metrics_max_mb', 5) * 1024 * 1024,
+            window=config.get('metrics_window', 200)
+        )
+        client_registry.configure(
+            max_connections=config.get('http_max_connections', 20),
+            max_keepalive=config.get('http_max_keepalive', 10),
+            timeout=config.get('http_timeout', 60.0),
+            connect_timeout=config.get('http_connect_timeout', 10.0)
+        )
+        client_registry.prewarm([oai_gw, SILICONFLOW_BASE_URL], loop=self.async_loop.loop)
+        self.config_manager.configure_persistence(fsync=config.get('persistence_fsync', "normal"), delay=config.get('persistence_delay_ms', 200) / 1000)
+        self.memory_manager.configure_retrieval(
+            top_k=config.get('memory_top_k', 8),
+            min_score=config.get('memory_min_score'),
+            embedder_spec=config.get('memory_embedder'),
+            min_results=config.get('memory_min_results', 3)
+        )
+        # 重新初始化时关闭上一次创建的线程池和引擎，进行中的任务仍会完成
+        if self.file_processor: self.file_processor.close()
+        if self.engine: self.engine.close()
+        self.file_processor = FileProcessor(
+            sf_key,
+            max_side=config.get('image_max_side', 1568),
+            image_format=config.get('image_format', "JPEG"),
+            quality=config.get('image_quality', 85),
+            cache_max_bytes=config.get('vision_cache_max_mb', 50) * 1024 * 1024,
+            max_concurrency=config.get('vision_concurrency', 3)
+        )
+        if self.voice_manager: self.voice_manager.audio_store.stop_cleanup()
+        self.voice_manager = VoiceManager(
+            sf_key,
+            cache_max_bytes=config.get('tts_cache_max_mb', 200) * 1024 * 1024,
+            fast_path=config.get('tts_fast_path', True),
+            audio_ttl_seconds=config.get('audio_ttl_days', 7) * 24 * 3600,
+            catalog_ttl_seconds=config.get('voice_catalog_ttl_minutes', 60) * 60
+        )
+        self.engine = ConversationEngine(
+            oai_key, oai_gw, sf_key, self.file_processor, self.memory_manager, self.voice_manager,
+            prompt_layout=config.get('prompt_layout', "messages"), report_usage=config.get('report_usage', True),
+            packer=ContextPacker(
+                token_budget=config.get('context_token_budget', 3000), recent_turns=config.get('context_recent_turns', 4),
+                max_turns=config.get('context_max_turns', 20),
+                min_reply_tokens=config.get('reply_min_tokens', 1024), max_reply_tokens=config.get('reply_max_tokens', 2000)
+            ),
+            summary_model=config.get('summary_model', "gpt-4o"), summary_max_chars=config.get('summary_max_chars', 600)
+        )
+        if config.get('summary_enabled', True):
+            self.engine.summarizer = HistorySummarizer(
+                self.config_manager, self.async_loop, self.engine.summarize,
+                keep_turns=config.get('summary_keep_turns', 8), batch_turns=config.get('summary_batch_turns', 4)
+            )
         
         logger.info("API客户端初始化成功。")
+        self.update_voice_list(self.voice_manager.voice_names()) # 先显示缓存的音色目录
         self.refresh_voice_list()
         
+    def run_async(self, coro, on_done=None, on_error=None):
+        """在后台事件循环中执行协程，完成后通过after回到Tk主线程回调"""
+        def callback(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                if on_error: self.after(0, on_error, e)
+                else: logger.error(f"后台任务出错: {e}", exc_info=True)
+                return
+            if on_done: self.after(0, on_done, result)
+
+        future = self.async_loop.submit(coro)
+        future.add_done_callback(callback)
+        return future
+
     def refresh_voice_list(self):
-        """刷新音色下拉列表"""
-        if self.voice_manager:
-            voices = self.voice_manager.refresh_voices()
-            self.voice_selector.configure(values=voices, state="normal")
-            if voices:
-                self.voice_selector.set(voices[0])
-                self.voice_manager.set_voice(voices[0])
+        """在后台刷新音色列表，完成后更新下拉列表"""
+        if self.engine:
+            self.run_async(self.engine.load_voices(), on_done=self.update_voice_list)
+
+    def update_voice_list(self, voices):
+        """更新音色下拉列表，已选音色仍然可用时保持选择"""
+        self.voice_selector.configure(values=voices, state="normal")
+        if voices and self.voice_selector.get() not in voices:
+            self.voice_selector.set(voices[0])
+        if voices: self.voice_manager.set_voice(self.voice_selector.get())
 
     def on_voice_selected(self, choice):
         if self.voice_manager:
@@ -597,78 +3346,88 @@ class App(ctk.CTk):
         self.speed_label.configure(text=f"语速: {float(value):.1f}x")
 
     def attach_file(self):
-        filepath = filedialog.askopenfilename()
-        if filepath:
-            self.attached_file_path = filepath
-            filename = os.path.basename(filepath)
+        filepaths = filedialog.askopenfilenames()
+        if filepaths:
+            self.attached_file_paths = list(filepaths)
+            filename = os.path.basename(filepaths[0])
+            if len(filepaths) > 1: filename += f" 等 {len(filepaths)} 个文件"
             self.user_input.delete(0, tkinter.END)
             self.user_input.insert(0, f"文件: {filename}")
-            logger.info(f"已附加文件: {filepath}")
+            logger.info(f"已附加文件: {', '.join(filepaths)}")
 
     def send_message(self, event=None):
         user_text = self.user_input.get().strip()
-        if not user_text and not self.attached_file_path:
+        if not user_text and not self.attached_file_paths:
             return
 
         self.add_message_to_chatbox("您", user_text)
         self.user_input.delete(0, tkinter.END)
         self.set_input_state("disabled")
 
-        thread = threading.Thread(target=self._send_message_thread, args=(user_text, self.attached_file_path))
-        thread.daemon = True
-        thread.start()
-        self.attached_file_path = None
-
-    def _send_message_thread(self, user_text, file_path):
-        """处理消息的后台线程"""
-        try:
-            processed_input = user_text
-            if file_path:
-                if self.file_processor.is_image_file(file_path):
-                    self.after(0, lambda: self.add_message_to_chatbox("系统", "正在分析图片..."))
-                    logger.info(f"开始分析图片: {file_path}")
-                    analysis = self.file_processor.analyze_image(file_path)
-                    logger.info("图片分析完成。")
-                    processed_input += f"\n\n[图片分析结果 ({os.path.basename(file_path)})]:\n{analysis}"
-                else:
-                    processed_input += f"\n\n[附加文件: {os.path.basename(file_path)}]"
-
-            logger.info("开始构建完整的提示词...")
-            prompt = PromptBuilder.build_complete_prompt(
-                processed_input,
+        file_paths = self.attached_file_paths
+        self.attached_file_paths = []
+        if not self.engine:
+            self.on_turn_failed(RuntimeError("API客户端未初始化，请先完成设置。"))
+            return
+        image_count = sum(1 for path in file_paths if self.file_processor.is_image_file(path))
+        if image_count:
+            self.add_message_to_chatbox("系统", f"正在分析 {image_count} 张图片...")
+
+        stream_state, on_delta = self._create_stream_sink() if self.streaming_enabled else (None, None)
+        metrics = TurnMetrics()
+        self.run_async(
+            self.engine.run_turn(
+                user_text, file_paths,
                 self.config_manager.load_config().get('preferences', {}),
-                self.memory_manager,
-                self.chat_history
-            )
-            logger.debug(f"构建的完整提示词:\n---\n{prompt}\n---")
+                self.chat_history, on_delta=on_delta, streaming=self.streaming_enabled, metrics=metrics
+            ),
+            on_done=lambda ai_response_text: self.process_ai_response(ai_response_text, user_text, stream_state, metrics),
+            on_error=lambda e: self.on_turn_failed(e, stream_state)
+        )
 
-            request_payload = {
-                "model": "gpt-4o",
-                "messages": [{"role": "user", "content": prompt}],
-                "response_format": {"type": "json_object"},
-                "max_tokens": 2000
-            }
-            logger.debug(f"发送到 OpenAI 的请求体:\n{json.dumps(request_payload, ensure_ascii=False, indent=2)}")
+    def on_turn_failed(self, error, stream_state=None):
+        """一轮对话失败时显示错误并恢复输入"""
+        logger.error(f"消息处理出错: {error}", exc_info=error)
+        if stream_state: stream_state["closed"] = True
+        self.add_message_to_chatbox("错误", str(error))
+        self.set_input_state("normal")
+
+    def _create_stream_sink(self):
+        """创建流式输出状态与增量回调：回调在事件循环线程中执行，按节流频率在AI气泡中增量显示回复"""
+        stream_state = {"text": "", "message": None, "scheduled": False, "closed": False}
+
+        def redraw():
+            stream_state["scheduled"] = False
+            if stream_state["closed"]: return
+            if stream_state["message"] is None:
+                stream_state["message"] = self.add_message_to_chatbox("AI", stream_state["text"])
+            else:
+                self.chat_view.update_message(stream_state["message"], stream_state["text"])
 
-            logger.info("正在向 OpenAI 发送请求...")
-            response = self.openai_client.chat.completions.create(
-                **request_payload, timeout=120
-            )
-            logger.info("已收到 OpenAI 的回复。")
-            ai_response_text = response.choices[0].message.content
-            logger.debug(f"从 OpenAI 收到的原始回复:\n{ai_response_text}")
+        def on_delta(new_text):
+            stream_state["text"] += new_text
+            if not stream_state["scheduled"]:
+                stream_state["scheduled"] = True
+                self.after(STREAM_REDRAW_MS, redraw)
 
-            self.after(0, self.process_ai_response, ai_response_text, user_text)
-        except Exception as e:
-            logger.error(f"消息处理线程出错: {e}", exc_info=True)
-            self.after(0, lambda: self.add_message_to_chatbox("错误", str(e)))
-            self.after(0, self.set_input_state, "normal")
+        return stream_state, on_delta
 
+    def show_ai_message(self, text, stream_state=None):
+        """显示AI回复；流式模式下更新已有气泡而不是新建"""
+        if stream_state is None:
+            self.add_message_to_chatbox("AI", text)
+            return
+        stream_state["closed"] = True
+        if stream_state["message"] is None:
+            stream_state["message"] = self.add_message_to_chatbox("AI", text)
+        else:
+            self.chat_view.update_message(stream_state["message"], text)
 
-    def process_ai_response(self, ai_response_text, original_user_input):
+    def process_ai_response(self, ai_response_text, original_user_input, stream_state=None, metrics=None):
         """处理并显示AI的回复"""
+        metrics = metrics or TurnMetrics()
         try:
-            logger.debug(f"开始处理AI回复JSON: {ai_response_text}")
+            logger.debug("开始处理AI回复JSON: %s", ai_response_text)
             response_data = json.loads(ai_response_text)
             display_response = response_data.get("response", "AI回复格式错误，请检查日志。")
 
@@ -676,6 +3435,7 @@ class App(ctk.CTk):
             memory_ops = response_data.get("memory_operations", [])
             if memory_ops:
                 logger.info(f"检测到 {len(memory_ops)} 个记忆操作。")
+            with metrics.span("memory_ops"):
                 for op in memory_ops:
                     action = op.get("action")
                     op_id = op.get("id")
@@ -685,123 +3445,134 @@ class App(ctk.CTk):
                     elif action == "delete": self.memory_manager.delete_memory(op['id'])
                     elif action == "modify": self.memory_manager.modify_memory(op['id'], op['content'])
             
-            self.add_message_to_chatbox("AI", display_response)
+            self.show_ai_message(display_response, stream_state)
             
-            self.chat_history.append({"user": original_user_input, "ai": display_response, "timestamp": datetime.now().isoformat()})
-            self.config_manager.save_chat_history(self.chat_history)
+            turn = {"user": original_user_input, "ai": display_response, "timestamp": datetime.now().isoformat()}
+            self.chat_history.append(turn)
+            with metrics.span("persistence"):
+                self.config_manager.append_chat_history(turn, self.chat_history)
+            if self.engine.summarizer: self.engine.summarizer.schedule(self.chat_history)
             
             if self.voice_enabled_switch.get() == 1 and self.voice_manager:
                 logger.info("语音回复已启用，开始生成语音。")
-                self.generate_and_play_speech(display_response)
+                self.generate_and_play_speech(display_response, metrics)
             else:
+                self.metrics.record_turn(metrics)
                 self.set_input_state("normal")
 
         except json.JSONDecodeError:
             logger.error(f"AI回复JSON解析失败: {ai_response_text}")
-            self.add_message_to_chatbox("AI", ai_response_text) # 直接显示原始文本
+            self.show_ai_message(ai_response_text, stream_state) # 直接显示原始文本
             self.set_input_state("normal")
         except Exception as e:
             logger.error(f"处理AI回复时出错: {e}", exc_info=True)
             self.set_input_state("normal")
 
 
-    def generate_and_play_speech(self, text):
-        """生成并播放语音"""
-        def task():
-            speed = self.speed_slider.get()
-            voice_file = self.voice_manager.text_to_speech(text, speed)
-            if voice_file:
-                self.after(0, self.play_audio, voice_file)
-            else:
-                self.after(0, self.set_input_state, "normal")
-        
-        thread = threading.Thread(target=task)
-        thread.daemon = True
-        thread.start()
+    def generate_and_play_speech(self, text, metrics=None):
+        """生成并播放语音：分段模式下首句合成完成即开始播放，后续句子排队衔接"""
+        self.speech_synthesizing = True
+        self.speech_start_time = time.perf_counter()
+        self.turn_metrics = metrics
+        self.check_music_status()
+        self.run_async(
+            self.engine.speak(text, self.speed_slider.get(), lambda audio: self.after(0, self.play_audio, audio), self.tts_pipelined, metrics),
+            on_done=lambda _: self.finish_speech_synthesis(),
+            on_error=lambda e: self.finish_speech_synthesis()
+        )
+
+    def finish_speech_synthesis(self):
+        """全部语音片段合成结束，写入本轮对话的指标"""
+        self.speech_synthesizing = False
+        if self.turn_metrics:
+            self.metrics.record_turn(self.turn_metrics)
+            self.turn_metrics = None
 
-    def play_audio(self, filepath):
-        """用pygame播放音频"""
+    def play_audio(self, audio):
+        """将语音片段（文件路径或PCM字节）加入播放队列"""
         try:
-            pygame.mixer.music.load(filepath)
-            pygame.mixer.music.play()
-            self.play_pause_button.configure(text="❚❚ 暂停", state="normal")
-            self.check_music_status()
+            self.speech_player.enqueue(audio)
+            if self.speech_start_time is not None:
+                elapsed = time.perf_counter() - self.speech_start_time
+                logger.info(f"首段语音延迟(TTFA): {elapsed:.2f}s")
+                if self.turn_metrics: self.turn_metrics.record("playback_start", elapsed * 1000)
+                self.speech_start_time = None
+            if not self.speech_player.paused:
+                self.play_pause_button.configure(text="❚❚ 暂停", state="normal")
         except pygame.error as e:
             logger.error(f"播放音频失败: {e}")
-            self.set_input_state("normal")
-    
+            if isinstance(audio, str): self.release_audio_file(audio)
+
+    def release_audio_file(self, path):
+        """语音文件已载入内存或播放结束，取消合成时的固定（见VoiceManager.text_to_speech），之后可被清理"""
+        if self.voice_manager: self.voice_manager.audio_store.unpin(os.path.basename(path))
+
     def check_music_status(self):
-        """检查音乐播放是否结束"""
-        if pygame.mixer.music.get_busy():
-            self.after(100, self.check_music_status)
+        """推进播放队列，并在合成与播放全部结束后恢复输入"""
+        self.speech_player.pump()
+        if self.speech_synthesizing or self.speech_player.is_active():
+            self.after(50, self.check_music_status)
         else:
+            self.speech_start_time = None
             self.play_pause_button.configure(text="▶ 播放", state="disabled")
             self.set_input_state("normal")
 
     def toggle_playback(self):
         """切换播放/暂停状态"""
-        if pygame.mixer.music.get_busy():
-            if pygame.mixer.music.get_pos() > 0: # Is playing
-                pygame.mixer.music.pause()
-                self.play_pause_button.configure(text="▶ 播放")
-            else: # Is paused
-                pygame.mixer.music.unpause()
-                self.play_pause_button.configure(text="❚❚ 暂停")
+        if self.speech_player.is_active():
+            paused = self.speech_player.toggle_pause()
+            self.play_pause_button.configure(text="▶ 播放" if paused else "❚❚ 暂停")
 
     def add_message_to_chatbox(self, sender, message):
-        """向聊天框添加一条消息"""
-        is_user = sender == "您"
-        
-        # 为每条消息创建一个容器，该容器占满整行宽度
-        row_frame = ctk.CTkFrame(self.chat_box, fg_color="transparent")
-        row_frame.pack(fill="x", padx=5, pady=2)
-
-        # 消息气泡本身
-        bubble_frame = ctk.CTkFrame(
-            row_frame,
-            corner_radius=10,
-            fg_color=("#dcdcdc", "#333333") if is_user else ("#efefef", "#2b2b2b")
+        """向聊天框添加一条消息，返回消息记录（用于流式更新）"""
+        return self.chat_view.add_message(sender, message)
+
+    def load_chat_history(self):
+        """在后台读取最近一页聊天记录；向上滚动接近顶部时再按页加载更早的记录，启动耗时与记录总数无关"""
+        self.history_cursor = None
+        self.history_exhausted = False
+        self.history_loading = True
+        self.run_async(
+            asyncio.to_thread(self.config_manager.load_chat_history_range, limit=HISTORY_PAGE_SIZE),
+            on_done=self._on_first_history_page, on_error=self._on_history_error
         )
-        
-        # 使用 grid 来对齐气泡
-        if is_user:
-            # 用户消息，右对齐
-            row_frame.grid_columnconfigure(0, weight=1) # 左侧空白伸缩
-            row_frame.grid_columnconfigure(1, weight=0)
-            bubble_frame.grid(row=0, column=1, sticky="e", padx=(50, 0)) # 增加左边距，使其不会占满全宽
-        else:
-            # AI消息，左对齐
-            row_frame.grid_columnconfigure(0, weight=0)
-            row_frame.grid_columnconfigure(1, weight=1) # 右侧空白伸缩
-            bubble_frame.grid(row=0, column=0, sticky="w", padx=(0, 50)) # 增加右边距
-
-        # 发送者标签
-        label = ctk.CTkLabel(bubble_frame, text=f"{sender}:", font=ctk.CTkFont(weight="bold"))
-        label.pack(anchor="w", padx=10, pady=(5, 0))
-        
-        # 消息内容
-        # 初始加载时winfo_width可能不准，因此先给一个较大的默认值
-        wraplen = self.chat_box.winfo_width() - 80
-        if wraplen < 100:
-            wraplen = self.winfo_width() * 0.5 # 如果chat_box宽度无效，则根据主窗口估算
-
-        msg_bubble = ctk.CTkLabel(
-            bubble_frame, text=message, wraplength=wraplen,
-            justify="left"
+
+    def _on_first_history_page(self, turns):
+        # 读取期间可能已经发送了新消息，历史记录放在它们之前，已显示的对话不再重复加入
+        earlier = earlier_turns(turns, self.chat_history)
+        self.chat_history = earlier + self.chat_history
+        self._show_history_page(turns, earlier)
+        logger.info(f"成功加载 {len(turns)} 条聊天记录")
+
+    def load_older_history(self):
+        """在后台读取更早的一页聊天记录"""
+        if self.history_loading or self.history_exhausted: return
+        self.history_loading = True
+        self.run_async(
+            asyncio.to_thread(self.config_manager.load_chat_history_range, before_id=self.history_cursor, limit=HISTORY_PAGE_SIZE),
+            on_done=self._show_history_page, on_error=self._on_history_error
         )
-        msg_bubble.pack(anchor="w", fill="x", padx=10, pady=(0, 5))
-        self.chat_bubbles.append(msg_bubble) # 将消息标签添加到列表中以便后续更新
-        
-        # 滚动到底部
-        self.chat_box._parent_canvas.after(100, lambda: self.chat_box._parent_canvas.yview_moveto(1.0))
 
-    def load_chat_history(self):
-        """加载并显示聊天记录"""
-        self.chat_history = self.config_manager.load_chat_history()
-        for chat in self.chat_history:
-            self.add_message_to_chatbox("您", chat['user'])
-            self.add_message_to_chatbox("AI", chat['ai'])
-        logger.info(f"成功加载 {len(self.chat_history)} 条聊天记录")
+    def _on_history_error(self, error):
+        logger.error(f"加载聊天记录失败: {error}")
+        self.history_loading = False
+
+    def _show_history_page(self, turns, shown=None):
+        """在空闲时分批把一页记录插入到顶部：从最新的一批开始，已显示的内容保持不动；shown为页中需要显示的部分，默认整页"""
+        self.history_cursor = turns[0].get('id') if turns else None
+        # JSON存储的记录没有ID，只保留最近的若干轮，读完一页即结束
+        self.history_exhausted = len(turns) < HISTORY_PAGE_SIZE or self.history_cursor is None
+        messages = [message for chat in (turns if shown is None else shown) for message in (("您", chat['user']), ("AI", chat['ai']))]
+        batches = [messages[i:i + HISTORY_RENDER_BATCH] for i in range(0, len(messages), HISTORY_RENDER_BATCH)]
+
+        def render_next():
+            if not batches:
+                self.history_loading = False
+                return
+            self.chat_view.prepend_messages(batches.pop())
+            self.after_idle(render_next)
+
+        render_next()
 
     def set_input_state(self, state="normal"):
         """设置输入相关组件的状态"""
@@ -812,17 +3583,18 @@ class App(ctk.CTk):
     def on_closing(self):
         """关闭程序时的处理"""
         logger.info("程序正在关闭...")
-        pygame.mixer.quit()
+        self.speech_player.close()
+        if self.voice_manager: self.voice_manager.audio_store.stop_cleanup()
+        self.async_loop.stop()
+        client_registry.close()
+        self.metrics.close()
+        self.config_manager.close()
         self.destroy()
 
-    def on_chat_resize(self, event=None):
-        """当窗口或聊天框大小改变时，更新消息气泡的换行宽度"""
-        # 减去各种内边距，并留出一些空间，确保文本不会紧贴边缘
-        wraplen = self.chat_box.winfo_width() - 80 
-        if wraplen > 100: # 只有在宽度有效时才更新
-            for bubble in self.chat_bubbles:
-                bubble.configure(wraplength=wraplen)
-
 if __name__ == "__main__":
     app = App()
-    app.mainloop()
+    try:
+        app.mainloop()
+    except KeyboardInterrupt:
+        # 终端中按 Ctrl+C 时同样写完尚未落盘的数据再退出
+        app.on_closing()
@@ -0,0 +1,208 @@
+"""核心组件基准：用 10 到 10 万条的合成记忆与聊天记录测量提示词构建、记忆增删改与存储读写的耗时，结果输出为 JSON 便于跨提交比较
+
+用法:
+    python benchmarks/bench_core.py
+    python benchmarks/bench_core.py --sizes 10,1000,100000 --backends sqlite,json --ops 200 --json core.json
+    python benchmarks/bench_core.py --module GUI
+    python benchmarks/bench_core.py --write-behind   # 记忆增删改只计登记耗时，另计后台写完的等待时间
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MODULES = {"CLI": (ROOT / "CLI", "mainCLI"), "GUI": (ROOT / "GUI", "mainGUI")}
+
+WORDS = ("咖啡", "跑步", "Python", "周末", "猫", "旅行", "音乐", "数据库", "早起", "电影", "摄影", "火锅", "项目", "考试", "城市")
+
+
+def synthetic_text(i, length=8):
+    """生成可复现、内容各不相同的文本"""
+    return f"用户偏好{i}: " + " ".join(WORDS[(i * 7 + k * 3) % len(WORDS)] for k in range(length))
+
+
+def synthetic_memory(size):
+    start = datetime(2024, 1, 1)
+    memory = {}
+    for i in range(1, size + 1):
+        stamp = (start + timedelta(minutes=i)).isoformat()
+        memory[str(i)] = {"content": synthetic_text(i), "created_time": stamp, "last_modified": stamp}
+    return memory
+
+
+def synthetic_history(size):
+    start = datetime(2024, 1, 1)
+    return [{
+        "user": f"第{i}个问题: {synthetic_text(i, 12)}",
+        "ai": f"第{i}个回答: {synthetic_text(i + 1, 24)}",
+        "timestamp": (start + timedelta(minutes=i)).isoformat()
+    } for i in range(size)]
+
+
+def synthetic_config():
+    return {
+        "siliconflow_key": "sk-bench", "openai_key": "sk-bench", "openai_api_gateway": "https://api.openai.com/v1",
+        "preferences": {"profession": "工程师", "preferred_title": "你", "reply_style": "简洁",
+                        "additional_info": "None", "last_updated": datetime(2024, 1, 1).isoformat()}
+    }
+
+
+def measure(func, *args, repeat=1):
+    """执行 repeat 次，返回 (最后一次的返回值, 耗时中位数毫秒)"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append((time.perf_counter() - start) * 1000)
+    return result, statistics.median(timings)
+
+
+def throughput(func, items):
+    """依次对 items 调用 func，返回每秒操作数与单次平均耗时"""
+    start = time.perf_counter()
+    for item in items:
+        func(*item)
+    elapsed = time.perf_counter() - start
+    return {"ops": len(items), "ops_per_sec": len(items) / elapsed if elapsed else None,
+            "ms_per_op": elapsed * 1000 / len(items) if items else None}
+
+
+def directory_bytes(directory):
+    return {path.name: path.stat().st_size for path in Path(directory).iterdir() if path.is_file()}
+
+
+def bench_store(target, backend, size, ops, repeat, write_behind=False):
+    """在独立的临时目录中针对一个存储后端和数据规模运行全部测量"""
+    memory, history, config = synthetic_memory(size), synthetic_history(size), synthetic_config()
+    result = {"backend": backend, "size": size, "write_behind": write_behind}
+    with tempfile.TemporaryDirectory(prefix="pvenus-bench-", ignore_cleanup_errors=True) as workdir:
+        config_manager = target.ConfigManager(backend=backend, base_dir=workdir, history_limit=size, write_behind=write_behind)
+        try:
+            # 整体保存直接测量存储后端，与是否后台写入无关
+            storage = config_manager.storage
+            result["save_ms"] = {
+                "config": measure(storage.save_config, config)[1],
+                "memory": measure(storage.save_memory, memory)[1],
+                "chat_history": measure(storage.save_chat_history, history)[1]
+            }
+            result["load_ms"] = {
+                "config": measure(config_manager.load_config, repeat=repeat)[1],
+                "memory": measure(config_manager.load_memory, repeat=repeat)[1],
+                "chat_history": measure(config_manager.load_chat_history, None, repeat=repeat)[1]
+            }
+            result["file_bytes"] = directory_bytes(workdir)
+
+            memory_manager, result["load_ms"]["memory_manager"] = measure(target.MemoryManager, config_manager)
+            user_input = f"最近想去{WORDS[3]}{WORDS[5]}，推荐一下{WORDS[9]}"
+            build = target.PromptBuilder.build_complete_prompt
+            # 第一次构建包含记忆索引的建立
+            _, cold_ms = measure(build, user_input, config["preferences"], memory_manager, history)
+            prompt, warm_ms = measure(build, user_input, config["preferences"], memory_manager, history, repeat=repeat)
+            result["prompt"] = {"cold_ms": cold_ms, "warm_ms": warm_ms, "chars": len(prompt),
+                                "bytes": len(prompt.encode("utf-8"))}
+            messages, messages_ms = measure(target.PromptBuilder.build_messages, user_input, config["preferences"],
+                                            memory_manager, history, repeat=repeat)
+            result["messages"] = {"warm_ms": messages_ms, "count": len(messages),
+                                  "chars": sum(len(message["content"]) for message in messages),
+                                  "stable_prefix_chars": sum(len(message["content"]) for message in messages[:2])}
+
+            # 增删改都包含持久化（日志追加或数据库写入）
+            added = []
+            result["memory_ops"] = {
+                "add": throughput(lambda text: added.append(memory_manager.add_memory(text)),
+                                  [(synthetic_text(size + i),) for i in range(ops)]),
+                "modify": throughput(memory_manager.modify_memory,
+                                     [(str(i % size + 1), synthetic_text(i, 10)) for i in range(ops)]),
+            }
+            result["memory_ops"]["delete"] = throughput(memory_manager.delete_memory, [(memory_id,) for memory_id in added])
+            if write_behind:
+                result["memory_ops"]["flush_ms"] = measure(config_manager.flush)[1]
+        finally:
+            wait_for_compaction(config_manager)
+            config_manager.close()
+    return result
+
+
+def wait_for_compaction(config_manager, timeout=30):
+    """JSON 后端在后台线程中压缩记忆日志，删除临时目录前等待其结束"""
+    deadline = time.monotonic() + timeout
+    while getattr(config_manager.storage, "_compacting", False) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def load_target(name):
+    """在临时工作目录中导入入口模块，避免日志等文件写到当前目录"""
+    directory, module = MODULES[name]
+    sys.path.insert(0, str(directory))
+    target = importlib.import_module(module)
+    target.logger.setLevel(logging.WARNING)
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PVenus 核心组件基准")
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000", help="逗号分隔的记忆/聊天记录条数")
+    parser.add_argument("--backends", default="sqlite,json", help="逗号分隔的存储后端")
+    parser.add_argument("--ops", type=int, default=200, help="增删改各执行的次数")
+    parser.add_argument("--repeat", type=int, default=5, help="读取与提示词构建的重复次数，取中位数")
+    parser.add_argument("--module", choices=sorted(MODULES), default="CLI", help="测量哪个入口中的实现")
+    parser.add_argument("--write-behind", action="store_true", help="记忆增删改经后台线程合并写入")
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件，默认输出到标准输出")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+
+    with tempfile.TemporaryDirectory(prefix="pvenus-bench-", ignore_cleanup_errors=True) as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            target = load_target(args.module)
+            results = []
+            for backend in args.backends.split(","):
+                for size in (int(size) for size in args.sizes.split(",")):
+                    result = bench_store(target, backend, size, args.ops, args.repeat, args.write_behind)
+                    results.append(result)
+                    print(f"[{backend} {size:>6}] 提示词 {result['prompt']['warm_ms']:.2f} ms / {result['prompt']['chars']} 字符, "
+                          f"读取记忆 {result['load_ms']['memory']:.1f} ms, 保存记忆 {result['save_ms']['memory']:.1f} ms, "
+                          f"添加记忆 {result['memory_ops']['add']['ops_per_sec']:.0f} 次/秒", file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        "benchmark": "core",
+        "module": args.module,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.now().isoformat(),
+        "results": results
+    }
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
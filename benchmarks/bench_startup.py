@@ -0,0 +1,131 @@
+"""冷启动基准：在子进程中测量 CLI/GUI 的模块导入与初始化耗时，超出预算或重量级依赖被提前导入时以非零状态退出
+
+用法:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --cli-budget-ms 250 --gui-budget-ms 1500 --json startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# 这些依赖应当推迟到功能首次使用时再导入
+HEAVY_MODULES = ("openai", "httpx", "requests", "PIL", "pygame", "pydub", "numpy")
+# customtkinter 自身依赖 Pillow，GUI 启动时无法避免
+ALLOWED_EAGER = {"CLI": set(), "GUI": {"PIL"}}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {directory!r})
+import {module} as target
+imported = time.perf_counter()
+{init}
+ready = time.perf_counter()
+loaded = [name for name in {heavy!r} if name in sys.modules]
+{cleanup}
+print(json.dumps({{
+    "import_ms": (imported - start) * 1000,
+    "init_ms": (ready - imported) * 1000,
+    "total_ms": (ready - start) * 1000,
+    "eager_imports": loaded,
+    "startup_timer": target.startup_timer.as_dict()
+}}))
+"""
+
+TARGETS = {
+    "CLI": {
+        "directory": str(ROOT / "CLI"),
+        "module": "mainCLI",
+        "init": "app = target.AIChat()",
+        "cleanup": "app.async_loop.stop(); app.config_manager.close()"
+    },
+    "GUI": {
+        "directory": str(ROOT / "GUI"),
+        "module": "mainGUI",
+        # update() 处理完挂起事件，相当于完成首次绘制
+        "init": "app = target.App(); app.update()",
+        "cleanup": "app.async_loop.stop(); app.config_manager.close(); app.destroy()"
+    }
+}
+
+
+def run_once(name):
+    """在全新的工作目录中启动一次子进程，返回测量结果"""
+    target = TARGETS[name]
+    code = PROBE.format(heavy=HEAVY_MODULES, **target)
+    env = dict(os.environ)
+    env.pop("PVENUS_STARTUP_TIMING", None)
+    with tempfile.TemporaryDirectory(prefix="pvenus-startup-") as workdir:
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=env,
+                                capture_output=True, text=True, timeout=120)
+        wall_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"{name} 启动失败:\n{result.stderr}")
+    sample = json.loads(result.stdout.strip().splitlines()[-1])
+    sample["wall_ms"] = wall_ms
+    return sample
+
+
+def summarize(name, samples, budget_ms):
+    """取各次运行的中位数，并检查预算与提前导入"""
+    eager = sorted(set().union(*(sample["eager_imports"] for sample in samples)) - ALLOWED_EAGER[name])
+    summary = {
+        "target": name,
+        "runs": len(samples),
+        "budget_ms": budget_ms,
+        "import_ms": statistics.median(sample["import_ms"] for sample in samples),
+        "init_ms": statistics.median(sample["init_ms"] for sample in samples),
+        "total_ms": statistics.median(sample["total_ms"] for sample in samples),
+        "wall_ms": statistics.median(sample["wall_ms"] for sample in samples),
+        "eager_imports": eager,
+        "phases": samples[-1]["startup_timer"]["phases"]
+    }
+    summary["passed"] = summary["total_ms"] <= budget_ms and not eager
+    return summary
+
+
+def display_available():
+    return os.name == "nt" or sys.platform == "darwin" or bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PVenus 冷启动基准")
+    parser.add_argument("--runs", type=int, default=5, help="每个入口的运行次数，取中位数")
+    parser.add_argument("--cli-budget-ms", type=float, default=250, help="CLI 导入+初始化的预算(毫秒)")
+    parser.add_argument("--gui-budget-ms", type=float, default=1500, help="GUI 导入+首次绘制的预算(毫秒)")
+    parser.add_argument("--targets", default=None, help="逗号分隔的入口，默认 CLI，有图形环境时加上 GUI")
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    targets = args.targets.split(",") if args.targets else ["CLI"] + (["GUI"] if display_available() else [])
+    budgets = {"CLI": args.cli_budget_ms, "GUI": args.gui_budget_ms}
+    results = []
+    for name in targets:
+        samples = [run_once(name) for _ in range(args.runs)]
+        summary = summarize(name, samples, budgets[name])
+        results.append(summary)
+        status = "通过" if summary["passed"] else "超出预算"
+        print(f"[{name}] 导入 {summary['import_ms']:.1f} ms + 初始化 {summary['init_ms']:.1f} ms = "
+              f"{summary['total_ms']:.1f} ms (预算 {summary['budget_ms']:.0f} ms, 进程总耗时 {summary['wall_ms']:.0f} ms) {status}")
+        for phase in summary["phases"]:
+            print(f"    {phase['phase']}: {phase['ms']:.1f} ms")
+        if summary["eager_imports"]:
+            print(f"    提前导入了重量级依赖: {', '.join(summary['eager_imports'])}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0 if all(summary["passed"] for summary in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
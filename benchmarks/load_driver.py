@@ -0,0 +1,163 @@
+"""端到端压测：启动本地模拟服务（或使用 --base-url 指定的服务），并发运行多个无界面的 AIChat 会话，统计每轮延迟分位数与吞吐
+
+用法:
+    python benchmarks/load_driver.py --sessions 20 --turns 5
+    python benchmarks/load_driver.py --sessions 50 --turns 10 --latency-ms 400 --jitter-ms 150 --error-rate 0.05 --voice --image-every 3 --json load.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from mock_server import MockAPIServer, add_server_arguments, server_options
+
+ROOT = Path(__file__).resolve().parent.parent
+
+PROMPTS = ("今天天气怎么样", "帮我规划一下周末", "记住我喜欢喝咖啡", "推荐一本书", "解释一下什么是事务", "我昨天说过什么")
+
+
+def run_session(target, index, args, base_url, loop, workdir, results):
+    """一个会话：独立的存储目录，依次执行若干轮对话，记录每轮的耗时与结果"""
+    session_dir = os.path.join(workdir, f"session-{index}")
+    os.makedirs(session_dir)
+    rng = random.Random(index)
+    chat = target.AIChat(base_dir=session_dir, async_loop=loop)
+    config = {
+        "siliconflow_key": f"sk-mock-{index}", "openai_key": f"sk-mock-{index}", "openai_api_gateway": base_url,
+        "preferences": {"profession": "None", "preferred_title": "None", "reply_style": "None", "additional_info": "None"},
+        "streaming": not args.no_streaming,
+        # 所有会话共享连接池，按并发数放大
+        "http_max_connections": max(20, args.sessions * 2),
+        "http_max_keepalive": max(10, args.sessions)
+    }
+    try:
+        chat.setup_clients(config)
+        for turn in range(args.turns):
+            user_input = rng.choice(PROMPTS)
+            if args.image_every and turn % args.image_every == args.image_every - 1:
+                user_input += " " + make_image(session_dir, index, turn)
+            metrics = target.TurnMetrics()
+            start = time.perf_counter()
+            try:
+                response = chat.chat_turn(user_input, config["preferences"], metrics=metrics)
+                if args.voice:
+                    chat.async_loop.run(chat.engine.speak(response, metrics))
+                chat.metrics.record_turn(metrics)
+                ok = True
+            except Exception as e:
+                logging.getLogger(__name__).debug(f"会话 {index} 第 {turn} 轮失败: {e}")
+                ok = False
+            results.append({"session": index, "turn": turn, "ok": ok,
+                            "latency_ms": (time.perf_counter() - start) * 1000,
+                            "spans": metrics.as_dict()["spans"]})
+            if args.think_ms:
+                time.sleep(rng.uniform(0, 2 * args.think_ms) / 1000)
+    finally:
+        chat.metrics.close()
+        chat.config_manager.close()
+
+
+def make_image(directory, session, turn):
+    """生成内容各不相同的小图片，避免命中图片分析缓存"""
+    from PIL import Image
+    path = os.path.join(directory, f"image-{turn}.png")
+    Image.new("RGB", (64, 48), ((session * 37) % 256, (turn * 59) % 256, 128)).save(path)
+    return path
+
+
+def percentiles(target, values):
+    ordered = sorted(values)
+    return {f"p{p}": target.percentile(ordered, p) for p in (50, 95, 99)}
+
+
+def summarize(target, results, elapsed):
+    succeeded = [result for result in results if result["ok"]]
+    summary = {
+        "turns": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "elapsed_s": elapsed,
+        "throughput_turns_per_sec": len(succeeded) / elapsed if elapsed else None,
+        "latency_ms": percentiles(target, [result["latency_ms"] for result in succeeded]),
+        "spans_ms": {}
+    }
+    if succeeded:
+        summary["latency_ms"]["mean"] = statistics.fmean(result["latency_ms"] for result in succeeded)
+    names = sorted({name for result in succeeded for name in result["spans"]})
+    for name in names:
+        values = [result["spans"][name] for result in succeeded if name in result["spans"]]
+        summary["spans_ms"][name] = {"count": len(values), **percentiles(target, values)}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PVenus 端到端压测")
+    parser.add_argument("--sessions", type=int, default=10, help="并发会话数")
+    parser.add_argument("--turns", type=int, default=5, help="每个会话的对话轮数")
+    parser.add_argument("--think-ms", type=float, default=0, help="两轮之间的平均停顿(毫秒)")
+    parser.add_argument("--no-streaming", action="store_true", help="使用非流式请求")
+    parser.add_argument("--voice", action="store_true", help="每轮回复后合成语音")
+    parser.add_argument("--image-every", type=int, default=0, help="每N轮附带一张图片，0为不附带")
+    parser.add_argument("--base-url", help="使用已运行的服务而不是启动内置模拟服务")
+    parser.add_argument("--json", dest="json_path", help="把汇总与每轮明细写入 JSON 文件")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+
+    server = None
+    if args.base_url:
+        base_url = args.base_url
+    else:
+        server = MockAPIServer(**server_options(args))
+        base_url = server.start()
+    # 模块在导入时读取 SiliconFlow 地址
+    os.environ["PVENUS_SILICONFLOW_BASE_URL"] = base_url
+
+    with tempfile.TemporaryDirectory(prefix="pvenus-load-", ignore_cleanup_errors=True) as workdir:
+        try:
+            sys.path.insert(0, str(ROOT / "CLI"))
+            import mainCLI as target
+            target.logger.setLevel(logging.WARNING)
+            # 会话数据都在workdir中，压测不写入当前目录下的app.log
+            target.logger.removeHandler(target.file_handler)
+
+            loop = target.AsyncLoopThread()
+            results = []
+            threads = [threading.Thread(target=run_session, args=(target, index, args, base_url, loop, workdir, results))
+                       for index in range(args.sessions)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            loop.stop()
+            target.client_registry.close()
+        finally:
+            if server:
+                server.stop()
+
+    summary = summarize(target, results, elapsed)
+    summary["sessions"] = args.sessions
+    summary["server_requests"] = dict(server.requests) if server else None
+    latency = summary["latency_ms"]
+    print(f"{summary['succeeded']}/{summary['turns']} 轮成功，用时 {elapsed:.1f}s，吞吐 {summary['throughput_turns_per_sec'] or 0:.2f} 轮/秒")
+    if latency["p50"] is not None:
+        print(f"每轮延迟 p50 {latency['p50']:.0f} ms, p95 {latency['p95']:.0f} ms, p99 {latency['p99']:.0f} ms")
+    for name, stats in summary["spans_ms"].items():
+        print(f"    {name}: p50 {stats['p50']:.0f} ms, p95 {stats['p95']:.0f} ms, p99 {stats['p99']:.0f} ms ({stats['count']} 次)")
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "turns": results}, f, ensure_ascii=False, indent=2)
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
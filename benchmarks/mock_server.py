@@ -0,0 +1,285 @@
+"""本地模拟服务：实现本项目用到的 OpenAI / SiliconFlow 接口，用于在不消耗真实额度的情况下压测对话链路
+
+支持的接口:
+    POST /v1/chat/completions   对话（流式/非流式）、图片分析（消息内容为列表时按视觉请求处理）与对话摘要（未要求JSON格式时）
+    POST /v1/audio/speech       语音合成（mp3 或 pcm）
+    GET  /v1/audio/voice/list   自定义音色列表（支持 ETag 条件请求）
+
+用法:
+    python benchmarks/mock_server.py --port 8765 --latency-ms 300 --jitter-ms 100 --error-rate 0.02 --tokens-per-sec 80
+    然后设置 PVENUS_SILICONFLOW_BASE_URL=http://127.0.0.1:8765/v1，并把 OpenAI 网关配置为同一地址
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLIES = (
+    "好的，我记住了。", "这个问题可以分三步来看：先确认目标，再拆分任务，最后逐一验证。",
+    "今天适合出去走走，记得带伞。", "推荐你试试先写测试再实现功能，这样改动更有把握。",
+)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    # -- 通用 --
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _begin(self, endpoint):
+        """统计请求、模拟排队与网络延迟，按错误率返回错误；返回False表示已经以错误响应"""
+        server = self.server
+        server.count(endpoint)
+        server.slots.acquire()
+        self._holding_slot = True
+        server.delay()
+        if random.random() < server.error_rate:
+            server.count(f"{endpoint}:error")
+            status = random.choice((429, 500, 503))
+            self._send_json(status, {"error": {"message": "mock server injected error", "type": "mock_error", "code": status}})
+            self._finish()
+            return False
+        return True
+
+    def _finish(self):
+        if getattr(self, "_holding_slot", False):
+            self._holding_slot = False
+            self.server.slots.release()
+
+    # -- 路由 --
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/audio/voice/list"):
+            if not self._begin("voice_list"):
+                return
+            try:
+                etag = '"mock-voices-v1"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                else:
+                    self._send_json(200, {"result": [{"uri": "speech:mock-voice:1", "customName": "mock"}]}, {"ETag": etag})
+            finally:
+                self._finish()
+        else:
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def do_POST(self):
+        try:
+            request = self._read_json()
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid json"}})
+            return
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            self._chat_completions(request)
+        elif self.path.rstrip("/").endswith("/audio/speech"):
+            self._speech(request)
+        else:
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    # -- 接口实现 --
+    def _chat_completions(self, request):
+        is_vision = any(isinstance(message.get("content"), list) for message in request.get("messages", []))
+        endpoint = "vision" if is_vision else "chat" if request.get("response_format") else "summary"
+        if not self._begin(endpoint):
+            return
+        try:
+            text = {"vision": self.server.vision_reply, "chat": self.server.chat_reply, "summary": self.server.summary_reply}[endpoint]()
+            if request.get("stream"):
+                self._stream_chat(request, text)
+            else:
+                self._send_json(200, {
+                    "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": request.get("model", "mock"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": self.server.usage(request, text)
+                })
+        finally:
+            self._finish()
+
+    def _stream_chat(self, request, text):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        interval = 1 / self.server.tokens_per_sec if self.server.tokens_per_sec > 0 else 0
+        chunk_chars = self.server.chunk_chars
+        for start in range(0, len(text), chunk_chars):
+            chunk = {
+                "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "delta": {"content": text[start:start + chunk_chars]}, "finish_reason": None}]
+            }
+            self._send_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            if interval:
+                time.sleep(interval)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            usage = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model", "mock"),
+                     "choices": [], "usage": self.server.usage(request, text)}
+            self._send_chunk(f"data: {json.dumps(usage)}\n\n".encode("utf-8"))
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+
+    def _speech(self, request):
+        if not self._begin("speech"):
+            return
+        try:
+            # 合成耗时与文本长度成正比，音频内容为静音
+            text = request.get("input", "")
+            time.sleep(len(text) * self.server.speech_ms_per_char / 1000)
+            if request.get("response_format") == "pcm":
+                sample_rate = (request.get("sample_rate") or 32000)
+                audio = bytes(int(sample_rate * 2 * min(len(text) * 0.15, 30)))
+                content_type = "audio/pcm"
+            else:
+                audio = bytes(max(1, len(text)) * 600)
+                content_type = "audio/mpeg"
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(audio)))
+            self.end_headers()
+            self.wfile.write(audio)
+        finally:
+            self._finish()
+
+
+class MockAPIServer(ThreadingHTTPServer):
+    """可配置延迟、抖动、错误率与吞吐的模拟服务"""
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=200, jitter_ms=50, error_rate=0.0,
+                 tokens_per_sec=100, chunk_chars=4, max_inflight=64, speech_ms_per_char=5, memory_op_rate=0.1):
+        super().__init__((host, port), MockHandler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.tokens_per_sec = tokens_per_sec
+        self.chunk_chars = chunk_chars
+        self.speech_ms_per_char = speech_ms_per_char
+        self.memory_op_rate = memory_op_rate
+        # 同时处理的请求数上限，超出的请求排队等待，用于模拟服务端吞吐
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.requests = Counter()
+        self._counter_lock = threading.Lock()
+        self._sequence = 0
+        self._recent_prompts = deque(maxlen=32)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, endpoint):
+        with self._counter_lock:
+            self.requests[endpoint] += 1
+
+    def delay(self):
+        time.sleep(max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000 if self.jitter_ms else self.latency_ms / 1000)
+
+    def chat_reply(self):
+        """对话回复：本项目要求的 JSON 格式，按比例附带记忆操作；每次文本都不同，避免语音缓存命中"""
+        with self._counter_lock:
+            self._sequence += 1
+            sequence = self._sequence
+        reply = {"response": f"{REPLIES[sequence % len(REPLIES)]}（第{sequence}条）", "memory_operations": []}
+        if random.random() < self.memory_op_rate:
+            reply["memory_operations"].append({"action": "add", "content": f"压测记忆 {sequence}"})
+        return json.dumps(reply, ensure_ascii=False)
+
+    def vision_reply(self):
+        return "图片中是一块纯色区域，没有文字或人物。"
+
+    def summary_reply(self):
+        with self._counter_lock:
+            self._sequence += 1
+            sequence = self._sequence
+        return f"用户先后询问了天气、周末安排和读书推荐，偏好简洁的回答。（摘要版本{sequence}）"
+
+    def usage(self, request, text):
+        """按字符近似token数；与最近请求的最长公共前缀达到1024时按128的整数倍计为缓存命中，模拟服务端提示词缓存"""
+        prompt = "".join(f"{message.get('role')}:{message.get('content')}\n" for message in request.get("messages", [])
+                         if isinstance(message.get("content"), str))
+        with self._counter_lock:
+            common = max((len(os.path.commonprefix([prompt, previous])) for previous in self._recent_prompts), default=0)
+            self._recent_prompts.append(prompt)
+        cached = common // 128 * 128 if common >= 1024 else 0
+        return {"prompt_tokens": len(prompt), "completion_tokens": len(text), "total_tokens": len(prompt) + len(text),
+                "prompt_tokens_details": {"cached_tokens": cached}}
+
+    def start(self):
+        """在后台线程中运行，返回服务地址"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_server_arguments(parser):
+    """模拟服务的可调参数，压测脚本复用"""
+    parser.add_argument("--latency-ms", type=float, default=200, help="每个请求的基础延迟(毫秒)")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="延迟的标准差(毫秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="以429/500/503失败的请求比例")
+    parser.add_argument("--tokens-per-sec", type=float, default=100, help="流式输出的分片速率，0为不限速")
+    parser.add_argument("--max-inflight", type=int, default=64, help="同时处理的请求数上限，超出则排队")
+    parser.add_argument("--speech-ms-per-char", type=float, default=5, help="语音合成每个字符的耗时(毫秒)")
+    parser.add_argument("--memory-op-rate", type=float, default=0.1, help="附带记忆操作的回复比例")
+
+
+def server_options(args):
+    return {
+        "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "error_rate": args.error_rate,
+        "tokens_per_sec": args.tokens_per_sec, "max_inflight": args.max_inflight,
+        "speech_ms_per_char": args.speech_ms_per_char, "memory_op_rate": args.memory_op_rate
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PVenus 本地模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockAPIServer(args.host, args.port, **server_options(args))
+    print(f"模拟服务已启动: {server.base_url}（Ctrl+C 退出）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"请求统计: {dict(server.requests)}")
+
+
+if __name__ == "__main__":
+    main()
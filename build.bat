@@ -16,6 +16,13 @@ nuitka GUI/mainGUI.py ^
 --onefile ^
 --windows-disable-console ^
 --enable-plugin=tk-inter ^
+--include-package=openai ^
+--include-package=requests ^
+--include-package=pygame ^
+--include-package=pydub ^
+--include-package=numpy ^
+--include-module=PIL.Image ^
+--include-module=PIL.ImageOps ^
 --output-dir=build ^
 --show-progress
 
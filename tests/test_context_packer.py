@@ -0,0 +1,114 @@
+"""上下文组装测试：不超过token预算，优先保留最近的对话，记忆按详细程度逐级压缩
+
+运行: python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "CLI"))
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="pvenus-test-")) # 模块导入时会在当前目录创建日志文件
+try:
+    import mainCLI
+finally:
+    os.chdir(_cwd)
+
+estimate_tokens = mainCLI.estimate_tokens
+
+
+def make_memory_manager(count):
+    memory = {
+        str(index): {
+            "content": f"第{index}条记忆的内容",
+            "created_time": "2024-01-01T08:00:00.000000",
+            "last_modified": "2024-02-01T09:30:00.000000",
+        }
+        for index in range(1, count + 1)
+    }
+    # 渲染结果按版本号缓存，每个测试取新的版本号
+    return SimpleNamespace(memory=memory, version=next(mainCLI.MemoryManager._versions))
+
+
+def make_turn(index, length=10):
+    return {"user": f"问题{index}" + "问" * length, "ai": f"回答{index}" + "答" * length}
+
+
+class ContextPackerTest(unittest.TestCase):
+    def setUp(self):
+        self.memory_manager = make_memory_manager(5)
+        self.items = list(self.memory_manager.memory.items())
+        self.fixed_texts = ["系统规则" * 20, "用户输入"]
+
+    def memory_tokens(self, detail, items=None):
+        context = mainCLI.PromptBuilder.build_memory_context(self.memory_manager, items=items or self.items, detail=detail)
+        return estimate_tokens(context)
+
+    def used_tokens(self, packer, memory_context, history):
+        return (sum(estimate_tokens(text) for text in self.fixed_texts) + estimate_tokens(memory_context)
+                + sum(packer.turn_tokens(turn) for turn in history))
+
+    def test_everything_fits(self):
+        history = [make_turn(index) for index in range(6)]
+        packer = mainCLI.ContextPacker(token_budget=10000, recent_turns=2)
+        memory_context, chosen = packer.pack(self.memory_manager, self.items, history, self.fixed_texts)
+        self.assertEqual(chosen, history)
+        self.assertIn("创建:2024-01-01 08:00:00", memory_context)
+
+    def test_max_turns_limits_history(self):
+        history = [make_turn(index) for index in range(6)]
+        packer = mainCLI.ContextPacker(token_budget=10000, recent_turns=2, max_turns=3)
+        _, chosen = packer.pack(self.memory_manager, self.items, history, self.fixed_texts)
+        self.assertEqual(chosen, history[-3:])
+
+    def test_memory_detail_degrades_within_budget(self):
+        fixed = sum(estimate_tokens(text) for text in self.fixed_texts)
+        for detail, marker in (("date", "(2024-02-01)"), ("none", "[5] 第5条记忆的内容")):
+            with self.subTest(detail=detail):
+                packer = mainCLI.ContextPacker(token_budget=fixed + self.memory_tokens(detail), recent_turns=2)
+                memory_context, chosen = packer.pack(self.memory_manager, self.items, [], self.fixed_texts)
+                self.assertNotIn("创建:", memory_context)
+                self.assertTrue(memory_context.endswith(marker))
+                self.assertEqual(chosen, [])
+
+    def test_most_relevant_memories_are_kept(self):
+        fixed = sum(estimate_tokens(text) for text in self.fixed_texts)
+        # 逐条累加的估算偏保守，预算给到比三条少一点时只保留最相关的两条
+        packer = mainCLI.ContextPacker(token_budget=fixed + self.memory_tokens("none", self.items[:3]) - 1, recent_turns=2)
+        memory_context, _ = packer.pack(self.memory_manager, self.items, [], self.fixed_texts)
+        self.assertEqual(memory_context, "永久记忆:\n[1] 第1条记忆的内容\n[2] 第2条记忆的内容")
+
+    def test_recent_turns_come_first_and_budget_is_respected(self):
+        history = [make_turn(index) for index in range(8)]
+        packer = mainCLI.ContextPacker(token_budget=1, recent_turns=3)
+        for budget in range(150, 600, 25):
+            with self.subTest(budget=budget):
+                packer.token_budget = budget
+                memory_context, chosen = packer.pack(self.memory_manager, self.items, history, self.fixed_texts)
+                self.assertLessEqual(self.used_tokens(packer, memory_context, chosen), budget)
+                # 选中的总是连续的最近若干轮
+                self.assertEqual(chosen, history[len(history) - len(chosen):])
+
+    def test_older_turns_skipped_when_recent_turns_do_not_fit(self):
+        # 倒数第二轮很长放不下时，不用剩余空间补更早的对话，避免历史出现断档
+        history = [make_turn(0), make_turn(1), make_turn(2, length=2000), make_turn(3)]
+        packer = mainCLI.ContextPacker(token_budget=1000, recent_turns=2)
+        _, chosen = packer.pack(self.memory_manager, self.items, history, self.fixed_texts)
+        self.assertEqual(chosen, history[-1:])
+
+    def test_reply_tokens(self):
+        packer = mainCLI.ContextPacker(recent_turns=2, min_reply_tokens=300, max_reply_tokens=2000)
+        self.assertEqual(packer.reply_tokens([]), 2000)
+        self.assertEqual(packer.reply_tokens([{"user": "", "ai": "好"}]), 300)
+        history = [{"user": "", "ai": "答" * 500}, {"user": "", "ai": "答" * 100}]
+        self.assertEqual(packer.reply_tokens(history), 500 * 2 + 256)
+        # 只看最近几轮
+        self.assertEqual(packer.reply_tokens(history + [{"user": "", "ai": "好"}] * 2), 300)
+        self.assertEqual(packer.reply_tokens([{"user": "", "ai": "答" * 5000}]), 2000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""GUI首页聊天记录的合并测试：首页读取完成前发送的对话已写入存储，不能在内存和界面中出现两次
+
+运行: python -m unittest discover tests
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+HAS_GUI = importlib.util.find_spec("customtkinter") is not None
+if HAS_GUI:
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "GUI"))
+    _cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="pvenus-test-")) # 模块导入时会在当前目录创建日志目录
+    try:
+        import mainGUI
+    finally:
+        os.chdir(_cwd)
+
+
+@unittest.skipUnless(HAS_GUI, "GUI模块需要customtkinter")
+class FirstHistoryPageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="pvenus-test-")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_race(self, backend, write_behind):
+        config_manager = mainGUI.ConfigManager(backend=backend, base_dir=self.directory.name, write_behind=write_behind)
+        try:
+            history = []
+            for index in range(3):
+                turn = {"user": f"旧问题{index}", "ai": f"旧回答{index}", "timestamp": f"2024-01-0{index + 1}T00:00:00"}
+                history.append(turn)
+                config_manager.append_chat_history(turn, history)
+            # 首页读取完成前用户发送了一轮对话：它已在内存中，读取时也会从存储中返回
+            chat_history = []
+            turn = {"user": "新问题", "ai": "新回答", "timestamp": datetime.now().isoformat()}
+            chat_history.append(turn)
+            config_manager.append_chat_history(turn, chat_history)
+            page = config_manager.load_chat_history_range(limit=mainGUI.HISTORY_PAGE_SIZE)
+            self.assertEqual(len(page), 4)
+            merged = mainGUI.earlier_turns(page, chat_history) + chat_history
+            self.assertEqual([turn["user"] for turn in merged], ["旧问题0", "旧问题1", "旧问题2", "新问题"])
+        finally:
+            config_manager.close()
+
+    def test_sqlite_write_behind(self):
+        self.run_race("sqlite", True)
+
+    def test_sqlite_sync(self):
+        self.run_race("sqlite", False)
+
+    def test_turns_without_timestamp_are_kept(self):
+        page = [{"user": "a", "ai": "b"}, {"user": "c", "ai": "d", "timestamp": "t1"}]
+        self.assertEqual(mainGUI.earlier_turns(page, [{"user": "c", "ai": "d", "timestamp": "t1"}, {"user": "x", "ai": "y"}]), page[:1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+"""滚动对话摘要测试：攒够一批才合并，合并期间到达的对话随后接着合并且不重复，失败与清空时的处理
+
+运行: python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "CLI"))
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="pvenus-test-")) # 模块导入时会在当前目录创建日志文件
+try:
+    import mainCLI
+finally:
+    os.chdir(_cwd)
+
+
+class FakeConfigManager:
+    def __init__(self, summary=None):
+        self.summary = summary
+        self.saved = []
+
+    def load_summary(self):
+        return self.summary
+
+    def save_summary(self, summary):
+        self.summary = summary
+        self.saved.append(summary)
+
+
+def make_history(count):
+    return [{"user": f"问题{index}", "ai": f"回答{index}", "timestamp": f"2024-01-01T00:{index:02d}:00"} for index in range(count)]
+
+
+class HistorySummarizerTest(unittest.TestCase):
+    def setUp(self):
+        self.async_loop = mainCLI.AsyncLoopThread()
+        self.config_manager = FakeConfigManager()
+        self.calls = [] # 每次合并收到的对话
+        self.gate = threading.Event() # 未放行时摘要请求一直挂起
+        self.gate.set()
+        self.fail = False
+
+    def tearDown(self):
+        self.gate.set()
+        self.async_loop.stop()
+
+    async def summarize(self, text, turns):
+        self.calls.append([turn["user"] for turn in turns])
+        while not self.gate.is_set():
+            await asyncio.sleep(0.005)
+        if self.fail:
+            raise RuntimeError("模型调用失败")
+        return text + "".join(turn["user"] for turn in turns)
+
+    def make_summarizer(self, **kwargs):
+        return mainCLI.HistorySummarizer(self.config_manager, self.async_loop, self.summarize, **kwargs)
+
+    def wait_until(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertTrue(condition())
+
+    def wait_idle(self, summarizer):
+        # 合并结束后可能立即接着提交下一批，连续一段时间空闲才算结束
+        self.wait_until(lambda: not summarizer._running)
+        time.sleep(0.05)
+        self.wait_until(lambda: not summarizer._running)
+
+    def test_waits_for_a_full_batch(self):
+        summarizer = self.make_summarizer(keep_turns=2, batch_turns=3)
+        summarizer.schedule(make_history(4))
+        self.assertFalse(summarizer._running)
+        summarizer.schedule(make_history(5))
+        self.wait_idle(summarizer)
+        self.assertEqual(self.calls, [["问题0", "问题1", "问题2"]])
+        self.assertEqual(summarizer.text, "问题0问题1问题2")
+        self.assertEqual(summarizer.state["covered_until"], "2024-01-01T00:02:00")
+        self.assertEqual(summarizer.state["turns"], 3)
+        self.assertEqual(self.config_manager.summary, summarizer.state)
+        self.assertEqual([turn["user"] for turn in summarizer.unsummarized(make_history(5))], ["问题3", "问题4"])
+
+    def test_turns_arriving_during_a_fold_are_folded_once(self):
+        summarizer = self.make_summarizer(keep_turns=2, batch_turns=2)
+        self.gate.clear()
+        summarizer.schedule(make_history(4))
+        self.wait_until(lambda: self.calls)
+        # 合并进行中时只记下最新的聊天记录，不会再提交同一批
+        summarizer.schedule(make_history(5))
+        summarizer.schedule(make_history(6))
+        self.assertEqual(len(self.calls), 1)
+        self.gate.set()
+        self.wait_idle(summarizer)
+        self.assertEqual(self.calls, [["问题0", "问题1"], ["问题2", "问题3"]])
+        self.assertEqual(summarizer.state["turns"], 4)
+
+    def test_backlog_is_folded_in_bounded_batches(self):
+        summarizer = self.make_summarizer(keep_turns=1, batch_turns=2, max_fold_turns=3)
+        summarizer.schedule(make_history(8))
+        self.wait_idle(summarizer)
+        self.assertEqual(self.calls, [["问题0", "问题1", "问题2"], ["问题3", "问题4", "问题5"]])
+        # 剩下一轮不够一批，留到之后
+        self.assertEqual(summarizer.state["covered_until"], "2024-01-01T00:05:00")
+
+    def test_failure_keeps_summary_and_retries(self):
+        summarizer = self.make_summarizer(keep_turns=1, batch_turns=2)
+        self.fail = True
+        summarizer.schedule(make_history(3))
+        self.wait_idle(summarizer)
+        self.assertEqual(summarizer.state, mainCLI.HistorySummarizer.empty_state())
+        self.assertEqual(self.config_manager.saved, [])
+        self.fail = False
+        summarizer.schedule(make_history(3))
+        self.wait_idle(summarizer)
+        self.assertEqual(self.calls, [["问题0", "问题1"], ["问题0", "问题1"]])
+        self.assertEqual(summarizer.text, "问题0问题1")
+
+    def test_reset_discards_fold_in_progress(self):
+        summarizer = self.make_summarizer(keep_turns=1, batch_turns=2)
+        self.gate.clear()
+        summarizer.schedule(make_history(3))
+        self.wait_until(lambda: self.calls)
+        summarizer.reset()
+        self.gate.set()
+        self.wait_idle(summarizer)
+        self.assertEqual(summarizer.state, mainCLI.HistorySummarizer.empty_state())
+        self.assertEqual(self.config_manager.saved, [mainCLI.HistorySummarizer.empty_state()])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_loads_saved_summary(self):
+        self.config_manager.summary = {"text": "之前的摘要", "covered_until": "2024-01-01T00:01:00", "turns": 2}
+        summarizer = self.make_summarizer(keep_turns=1, batch_turns=2)
+        summarizer.schedule(make_history(4))
+        self.assertFalse(summarizer._running)
+        summarizer.schedule(make_history(5))
+        self.wait_idle(summarizer)
+        self.assertEqual(self.calls, [["问题2", "问题3"]])
+        self.assertEqual(summarizer.text, "之前的摘要问题2问题3")
+
+
+if __name__ == "__main__":
+    unittest.main()
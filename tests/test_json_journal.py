@@ -0,0 +1,100 @@
+"""JSON存储的记忆日志测试：快照 + 日志重放、残缺的最后一行、后台压缩以及压缩中断后的恢复
+
+运行: python -m unittest discover tests
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "CLI"))
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="pvenus-test-")) # 模块导入时会在当前目录创建日志文件
+try:
+    import mainCLI
+finally:
+    os.chdir(_cwd)
+
+
+def put(memory, mem_id, content):
+    memory[mem_id] = {"content": content}
+    return {"op": "put", "id": mem_id, "data": memory[mem_id]}
+
+
+def delete(memory, mem_id):
+    memory.pop(mem_id)
+    return {"op": "del", "id": mem_id}
+
+
+class JsonJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="pvenus-test-")
+        self.storage = mainCLI.JsonStorage(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def reopen(self):
+        return mainCLI.JsonStorage(self.directory.name).load_memory()
+
+    def wait_for_compaction(self):
+        deadline = time.monotonic() + 5
+        while self.storage._compacting and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(self.storage._compacting)
+
+    def test_replay_applies_operations_in_order(self):
+        memory = {}
+        self.storage.append_memory_journal(put(memory, "1", "喜欢猫"), memory)
+        self.storage.append_memory_journal(put(memory, "2", "住在成都"), memory)
+        self.storage.append_memory_records([put(memory, "1", "喜欢狗"), delete(memory, "2"), put(memory, "3", "早上喝咖啡")], memory)
+        self.assertFalse(os.path.exists(self.storage.memory_file))
+        self.assertEqual(self.reopen(), {"1": {"content": "喜欢狗"}, "3": {"content": "早上喝咖啡"}})
+
+    def test_torn_last_line_is_skipped(self):
+        memory = {}
+        self.storage.append_memory_journal(put(memory, "1", "喜欢猫"), memory)
+        with open(self.storage.memory_journal_file, "a", encoding="utf-8") as f:
+            f.write('{"op":"put","id":"2","da') # 写到一半时崩溃
+        self.assertEqual(self.reopen(), {"1": {"content": "喜欢猫"}})
+        # 重放时补上的换行让之后追加的记录不会与半行粘连
+        storage = mainCLI.JsonStorage(self.directory.name)
+        memory = storage.load_memory()
+        storage.append_memory_journal(put(memory, "3", "住在成都"), memory)
+        self.assertEqual(self.reopen(), memory)
+
+    def test_compaction_writes_snapshot_and_drops_journal(self):
+        self.storage.journal_compact_threshold = 5
+        memory = {}
+        for index in range(5):
+            self.storage.append_memory_journal(put(memory, str(index), f"记忆{index}"), memory)
+        self.wait_for_compaction()
+        with open(self.storage.memory_file, encoding="utf-8") as f:
+            self.assertEqual(json.load(f), memory)
+        self.assertFalse(os.path.exists(f"{self.storage.memory_journal_file}.compacting"))
+        # 压缩之后的操作写入新日志
+        self.storage.append_memory_journal(delete(memory, "0"), memory)
+        self.assertEqual(self.reopen(), memory)
+
+    def test_interrupted_compaction_is_replayed_before_new_journal(self):
+        with open(self.storage.memory_file, "w", encoding="utf-8") as f:
+            json.dump({"1": {"content": "旧内容"}}, f)
+        with open(f"{self.storage.memory_journal_file}.compacting", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"op": "put", "id": "1", "data": {"content": "压缩中"}}) + "\n")
+        with open(self.storage.memory_journal_file, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"op": "put", "id": "1", "data": {"content": "最新"}}) + "\n")
+        self.assertEqual(self.reopen(), {"1": {"content": "最新"}})
+
+    def test_full_save_clears_journal(self):
+        memory = {}
+        self.storage.append_memory_journal(put(memory, "1", "喜欢猫"), memory)
+        self.storage.save_memory({"2": {"content": "住在成都"}})
+        self.assertFalse(os.path.exists(self.storage.memory_journal_file))
+        self.assertEqual(self.reopen(), {"2": {"content": "住在成都"}})
+
+
+if __name__ == "__main__":
+    unittest.main()
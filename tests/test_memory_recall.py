@@ -0,0 +1,72 @@
+"""记忆检索的召回测试：小规模中文记忆上，相关记忆要能被检索到，寒暄等无关输入也不能一条记忆都不注入
+
+运行: python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "CLI"))
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="pvenus-test-")) # 模块导入时会在当前目录创建日志文件
+try:
+    import mainCLI
+finally:
+    os.chdir(_cwd)
+
+MEMORIES = [
+    "用户喜欢吃川菜和火锅", "用户是一名Python后端工程师", "用户养了一只叫团子的猫", "用户每周末去跑步",
+    "用户对花生过敏", "用户住在成都", "用户正在准备英语考试", "用户喜欢看科幻电影",
+    "用户早上喝咖啡不加糖", "用户的生日是三月十二日",
+]
+
+# 输入 -> 必须召回的记忆
+CASES = {
+    "推荐点吃的，火锅怎么样": "用户喜欢吃川菜和火锅",
+    "我的猫最近不爱吃饭": "用户养了一只叫团子的猫",
+    "周末有什么运动建议": "用户每周末去跑步",
+    "帮我看看这段Python代码": "用户是一名Python后端工程师",
+    "今天成都天气如何": "用户住在成都",
+    "有什么电影推荐吗": "用户喜欢看科幻电影",
+}
+
+
+@unittest.skipUnless(mainCLI.HAS_NUMPY, "记忆检索需要NumPy")
+class MemoryRecallTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="pvenus-test-")
+        self.config_manager = mainCLI.ConfigManager(backend="json", base_dir=self.directory.name, write_behind=False)
+        self.memory_manager = mainCLI.MemoryManager(self.config_manager)
+        for day, content in enumerate(MEMORIES, 1):
+            memory_id = self.memory_manager.add_memory(content)
+            # 固定修改时间，避免同一时刻写入的记忆顺序不确定
+            self.memory_manager.memory[memory_id]["last_modified"] = f"2024-01-{day:02d}T00:00:00"
+        # top_k小于记忆总数，才会真正走检索
+        self.memory_manager.configure_retrieval(top_k=3)
+
+    def tearDown(self):
+        self.config_manager.close()
+        self.directory.cleanup()
+
+    def contents(self, query):
+        return [mem_data["content"] for _, mem_data in self.memory_manager.search_memory(query)]
+
+    def test_relevant_memory_is_recalled(self):
+        for query, expected in CASES.items():
+            with self.subTest(query=query):
+                self.assertIn(expected, self.contents(query))
+
+    def test_unrelated_input_falls_back_to_recent_memories(self):
+        contents = self.contents("hello")
+        self.assertEqual(len(contents), self.memory_manager.min_results)
+        self.assertEqual(contents[0], MEMORIES[-1])
+
+    def test_empty_selection_is_explicit_in_prompt(self):
+        context = mainCLI.PromptBuilder.build_memory_context(self.memory_manager, items=[])
+        self.assertEqual(context, "永久记忆: 无与当前输入相关的记忆")
+
+
+if __name__ == "__main__":
+    unittest.main()
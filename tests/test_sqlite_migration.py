@@ -0,0 +1,98 @@
+"""从旧版JSON文件迁移到SQLite的测试：数据完整迁移且只迁移一次，失败时整体回滚并继续使用JSON文件
+
+运行: python -m unittest discover tests
+"""
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "CLI"))
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="pvenus-test-")) # 模块导入时会在当前目录创建日志文件
+try:
+    import mainCLI
+finally:
+    os.chdir(_cwd)
+
+CONFIG = {"openai_key": "sk-test", "preferences": {"preferred_title": "小王"}}
+MEMORY = {
+    "1": {"content": "喜欢猫", "created_time": "2024-01-01T00:00:00", "last_modified": "2024-01-01T00:00:00"},
+    "2": {"content": "住在成都", "created_time": "2024-01-02T00:00:00", "last_modified": "2024-01-02T00:00:00"},
+}
+HISTORY = [
+    {"user": "你好", "ai": "你好！", "timestamp": "2024-01-01T10:00:00"},
+    {"user": "记住我喜欢猫", "ai": "好的", "timestamp": "2024-01-01T10:01:00"},
+]
+
+
+class SQLiteMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="pvenus-test-")
+        self.write_json("config.json", CONFIG)
+        self.write_json("memory.json", MEMORY)
+        self.write_json("chat_history.json", HISTORY)
+        # 快照之后的记忆操作只在日志中，迁移时也要带上
+        with open(os.path.join(self.directory.name, "memory.journal"), "w", encoding="utf-8") as f:
+            f.write(json.dumps({"op": "del", "id": "2"}) + "\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_json(self, name, data):
+        with open(os.path.join(self.directory.name, name), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    def open_manager(self):
+        return mainCLI.ConfigManager(backend="sqlite", base_dir=self.directory.name, write_behind=False)
+
+    def count_rows(self, table):
+        conn = sqlite3.connect(os.path.join(self.directory.name, "pvenus.db"))
+        try:
+            return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_migrates_config_memory_and_history_once(self):
+        for _ in range(2):
+            config_manager = self.open_manager()
+            try:
+                self.assertIsInstance(config_manager.storage, mainCLI.SQLiteStorage)
+                self.assertEqual(config_manager.load_config(), CONFIG)
+                memory = config_manager.load_memory()
+                self.assertEqual({str(mem_id): data["content"] for mem_id, data in memory.items()}, {"1": "喜欢猫"})
+                self.assertEqual([turn["user"] for turn in config_manager.load_chat_history()], ["你好", "记住我喜欢猫"])
+            finally:
+                config_manager.close()
+        # 再次打开时不会重复迁移
+        self.assertEqual(self.count_rows("chat_history"), len(HISTORY))
+
+    def test_failed_migration_rolls_back_and_keeps_json(self):
+        broken = {**MEMORY, "3": {"content": "缺少时间字段"}}
+        self.write_json("memory.json", broken)
+        config_manager = self.open_manager()
+        try:
+            self.assertIsInstance(config_manager.storage, mainCLI.JsonStorage)
+            self.assertEqual(config_manager.load_config(), CONFIG)
+        finally:
+            config_manager.close()
+        # 配置、记忆与聊天记录都没有写入一半
+        self.assertEqual(self.count_rows("kv"), 0)
+        self.assertEqual(self.count_rows("memory"), 0)
+        self.assertEqual(self.count_rows("chat_history"), 0)
+
+        # 修复JSON后下次启动重新迁移
+        self.write_json("memory.json", MEMORY)
+        config_manager = self.open_manager()
+        try:
+            self.assertIsInstance(config_manager.storage, mainCLI.SQLiteStorage)
+            self.assertEqual(len(config_manager.load_chat_history()), len(HISTORY))
+        finally:
+            config_manager.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
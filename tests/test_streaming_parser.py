@@ -0,0 +1,57 @@
+"""流式回复解析测试：无论JSON在哪里被切块，增量输出拼起来都等于顶层 response 字段
+
+运行: python -m unittest discover tests
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "CLI"))
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="pvenus-test-")) # 模块导入时会在当前目录创建日志文件
+try:
+    import mainCLI
+finally:
+    os.chdir(_cwd)
+
+REPLIES = [
+    {"response": "你好！今天想聊点什么？", "memory_operations": []},
+    # response 不在第一个字段，之前的嵌套对象中也有同名的键
+    {"memory_operations": [{"action": "add", "content": "用户喜欢猫", "response": "不应输出"}], "response": "记住了。"},
+    # 转义字符、\u 转义与代理对
+    {"response": "第一行\n第二行 \"引号\" \\ 反斜杠 \t制表 😀 é", "memory_operations": []},
+]
+
+
+def feed_in_chunks(text, size):
+    parser = mainCLI.StreamingResponseParser()
+    deltas = [parser.feed(text[start:start + size]) for start in range(0, len(text), size)]
+    return parser, "".join(deltas)
+
+
+class StreamingResponseParserTest(unittest.TestCase):
+    def test_every_chunk_size_yields_the_response(self):
+        for reply in REPLIES:
+            # ensure_ascii=True 时中文与表情都会变成 \u 转义，两种编码都要覆盖
+            for ensure_ascii in (False, True):
+                text = json.dumps(reply, ensure_ascii=ensure_ascii)
+                for size in (1, 2, 3, 5, 7, len(text)):
+                    with self.subTest(reply=reply["response"][:6], ensure_ascii=ensure_ascii, size=size):
+                        parser, streamed = feed_in_chunks(text, size)
+                        self.assertEqual(streamed, reply["response"])
+                        self.assertEqual(parser.text, text)
+
+    def test_later_fields_are_not_emitted(self):
+        _, streamed = feed_in_chunks('{"response": "A", "extra": {"response": "B"}, "response2": "C"}', 1)
+        self.assertEqual(streamed, "A")
+
+    def test_missing_field_yields_nothing(self):
+        _, streamed = feed_in_chunks('{"memory_operations": []}', 4)
+        self.assertEqual(streamed, "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""WSOLA语速调整测试：时长按倍速缩放，音调与音量不变，帧之间没有相位抵消或跳变
+
+运行: python -m unittest discover tests
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+HAS_GUI = importlib.util.find_spec("customtkinter") is not None and importlib.util.find_spec("numpy") is not None
+if HAS_GUI:
+    import numpy as np
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "GUI"))
+    _cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="pvenus-test-")) # 模块导入时会在当前目录创建日志目录
+    try:
+        import mainGUI
+    finally:
+        os.chdir(_cwd)
+
+SAMPLE_RATE = 32000
+FREQUENCY = 220
+AMPLITUDE = 8000
+
+
+def sine(seconds=1.0):
+    t = np.arange(int(SAMPLE_RATE * seconds)) / SAMPLE_RATE
+    return (AMPLITUDE * np.sin(2 * np.pi * FREQUENCY * t)).astype(np.int16)
+
+
+def zero_crossing_rate(samples):
+    signs = np.signbit(samples.astype(np.int32))
+    return np.count_nonzero(signs[1:] != signs[:-1]) * SAMPLE_RATE / len(samples)
+
+
+@unittest.skipUnless(HAS_GUI, "GUI模块需要customtkinter与NumPy")
+class TimeStretchTest(unittest.TestCase):
+    def test_normal_speed_and_short_input_are_unchanged(self):
+        samples = sine()
+        self.assertIs(mainGUI.time_stretch_pcm(samples, 1.0), samples)
+        short = samples[:1000]
+        self.assertIs(mainGUI.time_stretch_pcm(short, 1.5), short)
+
+    def test_stretch_keeps_pitch_and_level(self):
+        samples = sine()
+        input_step = np.abs(np.diff(samples.astype(np.int32))).max()
+        for speed in (0.75, 1.25, 1.5, 2.0):
+            with self.subTest(speed=speed):
+                output = mainGUI.time_stretch_pcm(samples, speed)
+                self.assertEqual(output.dtype, np.int16)
+                self.assertAlmostEqual(len(output) / len(samples), 1 / speed, delta=0.05)
+                # 去掉首尾各一帧后比较，那里参与加权的帧不完整
+                middle = output[1024:-1024].astype(np.float64)
+                self.assertAlmostEqual(zero_crossing_rate(middle), 2 * FREQUENCY, delta=2 * FREQUENCY * 0.03)
+                # 相邻帧相位不对齐时重叠相加会互相抵消，音量明显下降
+                self.assertAlmostEqual(np.sqrt(np.mean(middle ** 2)), AMPLITUDE / np.sqrt(2), delta=AMPLITUDE * 0.01)
+                # 帧之间的拼接不能产生比原波形更陡的跳变（咔嗒声）
+                self.assertLessEqual(np.abs(np.diff(middle)).max(), input_step * 1.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+"""后台写入测试：同一批改动合并为每类一次写入，按依赖顺序落盘，flush/stop时立即写完
+
+运行: python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "CLI"))
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="pvenus-test-")) # 模块导入时会在当前目录创建日志文件
+try:
+    import mainCLI
+finally:
+    os.chdir(_cwd)
+
+
+class RecordingStorage:
+    """只记录调用的存储后端"""
+    def __init__(self):
+        self.calls = []
+        self.fail_next = False
+        self.lock = threading.Lock()
+
+    def _record(self, *call):
+        with self.lock:
+            if self.fail_next:
+                self.fail_next = False
+                raise OSError("磁盘已满")
+            self.calls.append(call)
+
+    def save_config(self, config):
+        self._record("save_config", config)
+
+    def append_memory_records(self, records, memory):
+        self._record("append_memory_records", list(records), memory)
+
+    def clear_chat_history(self):
+        self._record("clear_chat_history")
+
+    def append_chat_turns(self, turns, chat_history):
+        self._record("append_chat_turns", list(turns), chat_history)
+
+    def save_summary(self, summary):
+        self._record("save_summary", summary)
+
+
+class WriteBehindWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = RecordingStorage()
+        # 合并窗口足够长，除非flush/stop否则不会在测试期间写入
+        self.writer = mainCLI.WriteBehindWriter(self.storage, delay=60)
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def test_batch_is_coalesced_in_dependency_order(self):
+        self.writer.append("chat_turns", "第1轮", state=["第1轮"])
+        self.writer.mark("summary", {"text": "旧"})
+        for version in range(3):
+            self.writer.mark("config", {"version": version})
+        self.writer.append("memory_records", {"op": "put", "id": "1"}, state={"1": 1})
+        self.writer.append("chat_turns", "第2轮", state=["第1轮", "第2轮"])
+        self.writer.append("memory_records", {"op": "del", "id": "1"}, state={})
+        self.writer.mark("summary", {"text": "新"})
+        self.assertEqual(self.storage.calls, [])
+        self.assertTrue(self.writer.pending)
+
+        self.assertTrue(self.writer.flush(5))
+        self.assertFalse(self.writer.pending)
+        self.assertEqual(self.storage.calls, [
+            ("save_config", {"version": 2}),
+            ("append_memory_records", [{"op": "put", "id": "1"}, {"op": "del", "id": "1"}], {}),
+            ("append_chat_turns", ["第1轮", "第2轮"], ["第1轮", "第2轮"]),
+            ("save_summary", {"text": "新"}),
+        ])
+
+    def test_clear_runs_before_turns_added_afterwards(self):
+        self.writer.append("chat_turns", "清空前", state=["清空前"])
+        # ConfigManager清空聊天记录时丢弃尚未写入的新对话
+        self.writer.discard("chat_turns")
+        self.writer.mark("clear_chat_history", True)
+        self.writer.append("chat_turns", "清空后", state=["清空后"])
+        self.assertTrue(self.writer.flush(5))
+        self.assertEqual(self.storage.calls, [("clear_chat_history",), ("append_chat_turns", ["清空后"], ["清空后"])])
+
+    def test_writes_after_delay_without_flush(self):
+        self.writer.delay = 0.05
+        self.writer.mark("config", {"version": 2})
+        deadline = time.monotonic() + 5
+        while not self.storage.calls and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.storage.calls, [("save_config", {"version": 2})])
+
+    def test_failed_batch_does_not_stop_the_writer(self):
+        self.storage.fail_next = True
+        self.writer.mark("config", {"version": 1})
+        self.assertTrue(self.writer.flush(5))
+        self.assertEqual(self.storage.calls, [])
+        self.writer.mark("config", {"version": 2})
+        self.assertTrue(self.writer.flush(5))
+        self.assertEqual(self.storage.calls, [("save_config", {"version": 2})])
+
+    def test_stop_writes_pending_changes(self):
+        self.writer.mark("summary", {"text": "摘要"})
+        self.writer.stop()
+        self.assertEqual(self.storage.calls, [("save_summary", {"text": "摘要"})])
+
+    def test_flush_without_changes_returns_immediately(self):
+        self.assertTrue(self.writer.flush(0))
+        self.assertEqual(self.storage.calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()